@@ -0,0 +1,161 @@
+"""A local stand-in for the crawled sites and for proxy_pool.
+
+One aiohttp app serves every site's list and download endpoints, routed by
+path, plus proxy_pool's /get/, /all/ and /delete/. The proxies it hands out
+point back to itself and it answers absolute-form proxy requests, so the
+example spiders keep their real URLs and never leave the machine.
+
+    python -m benchmarks.mock_site --port 18080 --pages 20 --latency 0.05
+"""
+import json
+import random
+import asyncio
+import hashlib
+import argparse
+from typing import NamedTuple
+
+from aiohttp import web
+
+
+class MockOptions(NamedTuple):
+    pages: int = 20
+    page_size: int = 10
+    latency: float = 0.0          # mean response delay in seconds, exponentially distributed
+    error_rate: float = 0.0       # share of site responses answered with a 503
+    file_size: int = 64 * 1024
+    duplicate_rate: float = 0.0   # share of documents sharing one attachment
+    seed: int = 0
+
+
+def make_content(document_id: str, options: MockOptions) -> bytes:
+    digest = hashlib.sha256(f"{options.seed}:{document_id}".encode()).digest()
+    if int.from_bytes(digest[:4], 'little') / 2 ** 32 < options.duplicate_rate:
+        digest = hashlib.sha256(b"duplicate").digest()
+    return (digest * (options.file_size // len(digest) + 1))[:options.file_size]
+
+
+def make_file_response(request: web.Request, content: bytes, filename: str) -> web.Response:
+    headers = {
+        "Content-Disposition": f'attachment; filename="{filename}"',
+        "ETag": f'"{hashlib.md5(content).hexdigest()}"',
+        "Accept-Ranges": "bytes",
+    }
+    range_header = request.headers.get('Range', '')
+    if range_header.startswith('bytes='):
+        start = int(range_header[len('bytes='):].split('-')[0] or 0)
+        if start >= len(content):
+            return web.Response(status=416, headers={"Content-Range": f"bytes */{len(content)}"})
+        headers["Content-Range"] = f"bytes {start}-{len(content) - 1}/{len(content)}"
+        return web.Response(status=206, body=content[start:], headers=headers)
+    return web.Response(body=content, headers=headers)
+
+
+def create_app(options: MockOptions = MockOptions(), port: int = 18080) -> web.Application:
+    rng = random.Random(options.seed)
+
+    def page_items(page_num: int):
+        if page_num < 1 or page_num > options.pages:
+            return []
+        return [f"{page_num}_{i}" for i in range(options.page_size)]
+
+    @web.middleware
+    async def site_behaviour(request: web.Request, handler):
+        if request.path in ('/get/', '/all/', '/delete/'):
+            return await handler(request)
+        if options.latency > 0:
+            await asyncio.sleep(rng.expovariate(1.0 / options.latency))
+        if options.error_rate > 0 and rng.random() < options.error_rate:
+            raise web.HTTPServiceUnavailable()
+        return await handler(request)
+
+    # proxy_pool
+    async def get_proxy(request):
+        return web.json_response({"proxy": f"127.0.0.1:{port}"})
+
+    async def all_proxies(request):
+        return web.json_response([{"proxy": f"127.0.0.1:{port}"}])
+
+    async def delete_proxy(request):
+        return web.json_response({"code": 0, "src": "success"})
+
+    # hebeieb
+    async def hebeieb_list(request):
+        data = await request.post()
+        items = ''.join(
+            f'<div><h4><a href="/infogk/newDetail.do?categoryid=1&infoid={item}" title="bid call {item}">{item}</a></h4></div>'
+            for item in page_items(int(data.get('page', 1)))
+        )
+        return web.Response(text=f'<html><body><div class="publicont">{items}</div></body></html>', content_type='text/html', charset='utf-8')
+
+    async def hebeieb_detail(request):
+        info_id = request.query['infoid']
+        rows = ''.join(f'<tr><td>{info_id}</td><td>{i}</td></tr>' for i in range(max(1, options.file_size // 64)))
+        html = f'<html><body><div id="article_con"><div><table>{rows}</table></div></div></body></html>'
+        return web.Response(text=html, content_type='text/html', charset='utf-8')
+
+    # cebpubservice
+    async def cebpubservice_list(request):
+        data = await request.post()
+        items = [{"documentid": f"ceb{item}"} for item in page_items(int(data.get('pageNo', 1)))]
+        return web.json_response({"object": {"page": {"totalPage": options.pages}, "list": items}})
+
+    async def cebpubservice_guid(request):
+        data = await request.post()
+        return web.json_response({"object": {"newFileId1": hashlib.md5(data['documentId'].encode()).hexdigest()}})
+
+    async def cebpubservice_download(request):
+        document_id = request.query['documentId']
+        return make_file_response(request, make_content(document_id, options), f"{document_id}.pdf")
+
+    # cninfo
+    async def cninfo_list(request):
+        # newest first, an hour apart, like `sortType=desc`
+        page_num = int(request.query.get('pageNum', 1))
+        items = [
+            {
+                "announcementId": f"cninfo{item}",
+                "announcementTitle": f"<em>fund</em> contract {item}",
+                "announcementTime": 1634688000000 - ((page_num - 1) * options.page_size + i) * 3600000,
+                "adjunctUrl": f"finalpage/2021-10-20/{item}.PDF",
+            }
+            for i, item in enumerate(page_items(page_num))
+        ]
+        return web.json_response({"announcements": items or None})
+
+    async def cninfo_download(request):
+        document_id = request.match_info['path']
+        return make_file_response(request, make_content(document_id, options), document_id.split('/')[-1])
+
+    app = web.Application(middlewares=[site_behaviour])
+    app.add_routes([
+        web.get('/get/', get_proxy),
+        web.get('/all/', all_proxies),
+        web.get('/delete/', delete_proxy),
+        web.post('/tender/xxgk/zbgg.do', hebeieb_list),
+        web.get('/infogk/newDetail.do', hebeieb_detail),
+        web.post('/tenderdocument/mhDocumentLibNoSessionAction/{name:queryTenderdocument.*}', cebpubservice_list),
+        web.post('/tenderdocument/mhDocumentLibNoSessionAction/queryMhDocumentLibDetails.do', cebpubservice_guid),
+        web.post('/tenderdocument/offerrewardAction/breakpointdownload.do', cebpubservice_download),
+        web.get('/new/fulltextSearch/full', cninfo_list),
+        web.get('/finalpage/{path:.*}', cninfo_download),
+    ])
+    return app
+
+
+def serve(options: MockOptions, port: int):
+    web.run_app(create_app(options, port), host='127.0.0.1', port=port, print=None, access_log=None)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--port', type=int, default=18080)
+    for name, default in MockOptions._field_defaults.items():
+        parser.add_argument(f"--{name.replace('_', '-')}", type=type(default), default=default)
+    args = parser.parse_args()
+    options = MockOptions(**{name: getattr(args, name) for name in MockOptions._fields})
+    print(json.dumps(options._asdict()))
+    serve(options, args.port)
+
+
+if __name__ == "__main__":
+    main()
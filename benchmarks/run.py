@@ -0,0 +1,257 @@
+"""Offline benchmark of the example spiders.
+
+Every spider runs unchanged in a fresh process against `mock_site`, which
+stands in for the target site and for proxy_pool, with the in-memory mongo
+backend, so numbers only depend on tspider and the machine.
+
+    python -m benchmarks.run --pages 20 --latency 0.02 --output results.json
+    python -m benchmarks.run --baseline results.json --tolerance 0.2
+
+With `--baseline`, exits non-zero when any spider's docs/s dropped by more
+than `--tolerance`, so it can gate CI.
+"""
+import sys
+import json
+import time
+import queue
+import socket
+import argparse
+import resource
+import importlib
+import statistics
+import tempfile
+import multiprocessing
+from pathlib import Path
+from typing import Dict, List, Optional
+
+import aiohttp
+from loguru import logger
+from omegaconf.omegaconf import OmegaConf
+
+from benchmarks.mock_site import MockOptions, serve
+
+
+EXAMPLES_DIR = Path(__file__).resolve().parent.parent.joinpath('examples')
+SPIDERS = {
+    "hebeieb": ("hebeieb", "HebeiebBidCallSpider"),
+    "cebpubservice": ("cebpubservice", "CebPubServiceSpider"),
+    "cninfo_fund_contract": ("cninfo_fund_contract", "CnInfoFundContractSpider"),
+}
+
+
+def get_free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def wait_for_port(port: int, timeout: float = 10.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            with socket.create_connection(('127.0.0.1', port), timeout=0.5):
+                return
+        except OSError:
+            time.sleep(0.1)
+    raise TimeoutError(f"Mock site did not start on port {port}")
+
+
+def write_config(name: str, port: int, output_dir: Path, keep_rate_limit: bool) -> Path:
+    config = OmegaConf.load(EXAMPLES_DIR.joinpath(name, 'config.yaml'))
+    config.output_dir = str(output_dir)
+    config.proxy_host = '127.0.0.1'
+    config.proxy_port = str(port)
+    config.mongo_backend = 'memory'
+    config.start_page_num = 1
+    # paginate past the end of the mock site, so discovery is measured too
+    config.tot_page_num = None
+    if not keep_rate_limit:
+        config.pop('rate_limit', None)
+    path = output_dir.joinpath(f'{name}.yaml')
+    OmegaConf.save(config, path)
+    return path
+
+
+def make_latency_trace_config(latencies: List[float]) -> aiohttp.TraceConfig:
+    trace_config = aiohttp.TraceConfig()
+
+    async def on_request_start(session, ctx, params):
+        ctx.benchmark_start_time = time.perf_counter()
+
+    async def on_request_end(session, ctx, params):
+        latencies.append(time.perf_counter() - ctx.benchmark_start_time)
+
+    trace_config.on_request_start.append(on_request_start)
+    trace_config.on_request_end.append(on_request_end)
+    return trace_config
+
+
+def percentile(values: List[float], q: float) -> Optional[float]:
+    if not values:
+        return None
+    if len(values) == 1:
+        return values[0]
+    return statistics.quantiles(values, n=100, method='inclusive')[int(q * 100) - 1]
+
+
+def run_spider(name: str, config_filepath: str, verbose: bool, results):
+    # runs in a fresh process, so peak RSS and CPU time belong to this spider alone
+    if not verbose:
+        logger.remove()
+    module_name, class_name = SPIDERS[name]
+    sys.path.insert(0, str(EXAMPLES_DIR.joinpath(name)))
+    spider_class = getattr(importlib.import_module(module_name), class_name)
+
+    start_usage = resource.getrusage(resource.RUSAGE_SELF)
+    start_time = time.perf_counter()
+    spider = spider_class(config_filepath)
+    latencies: List[float] = []
+    spider.session_manager.add_trace_config(make_latency_trace_config(latencies))
+    spider.start()
+    elapsed = time.perf_counter() - start_time
+
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    # parse pool workers and other children, reaped by the time start() returns
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    cpu_time = (usage.ru_utime - start_usage.ru_utime) + (usage.ru_stime - start_usage.ru_stime) \
+        + children.ru_utime + children.ru_stime
+    docs = spider.db_manager.collection.count_documents({"downloaded": True})
+    results.put({
+        "spider": name,
+        "docs": docs,
+        "requests": len(latencies),
+        "elapsed": elapsed,
+        "docs_per_sec": docs / elapsed,
+        "p50_latency": percentile(latencies, 0.5),
+        "p99_latency": percentile(latencies, 0.99),
+        # ru_maxrss is in KiB on Linux
+        "peak_rss_mb": usage.ru_maxrss / 1024,
+        "children_peak_rss_mb": children.ru_maxrss / 1024,
+        "cpu_time": cpu_time,
+        "cpu_percent": 100 * cpu_time / elapsed,
+    })
+
+
+def wait_for_result(process, results, timeout: float) -> dict:
+    # a child failing before it reports, e.g. on an import error, puts nothing
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            return results.get(timeout=1.0)
+        except queue.Empty:
+            if not process.is_alive():
+                break
+    try:
+        # the result of a child that exited right after putting it
+        return results.get(timeout=1.0)
+    except queue.Empty:
+        pass
+    if process.is_alive():
+        process.terminate()
+        process.join()
+        raise RuntimeError(f"no result after {timeout:.0f}s")
+    raise RuntimeError(f"exited with code {process.exitcode}")
+
+
+def benchmark(
+    names: List[str],
+    options: MockOptions,
+    keep_rate_limit: bool = False,
+    verbose: bool = False,
+    timeout: float = 600.0
+) -> List[dict]:
+    context = multiprocessing.get_context('spawn')
+    port = get_free_port()
+    server = context.Process(target=serve, args=(options, port), daemon=True)
+    server.start()
+    results = []
+    try:
+        wait_for_port(port)
+        with tempfile.TemporaryDirectory(prefix='tspider-benchmark-') as temp_dir:
+            for name in names:
+                output_dir = Path(temp_dir, name)
+                output_dir.mkdir()
+                config_filepath = write_config(name, port, output_dir, keep_rate_limit)
+                spider_results = context.Queue()
+                process = context.Process(target=run_spider, args=(name, str(config_filepath), verbose, spider_results))
+                process.start()
+                try:
+                    result = wait_for_result(process, spider_results, timeout)
+                except RuntimeError as err:
+                    raise RuntimeError(f"benchmark of {name} failed: {err}") from None
+                process.join()
+                results.append(result)
+    finally:
+        server.terminate()
+        server.join()
+    return results
+
+
+def format_results(results: List[dict]) -> str:
+    def ms(value: Optional[float]) -> str:
+        return f"{value * 1000:.1f}" if value is not None else "-"
+
+    lines = [f"{'spider':<22}{'docs':>6}{'docs/s':>9}{'p50 ms':>9}{'p99 ms':>9}{'rss MB':>9}{'cpu %':>8}"]
+    for result in results:
+        rss = result['peak_rss_mb'] + result['children_peak_rss_mb']
+        lines.append(
+            f"{result['spider']:<22}{result['docs']:>6}{result['docs_per_sec']:>9.1f}"
+            f"{ms(result['p50_latency']):>9}{ms(result['p99_latency']):>9}{rss:>9.1f}{result['cpu_percent']:>8.1f}"
+        )
+    return '\n'.join(lines)
+
+
+def find_regressions(results: List[dict], baseline: List[dict], tolerance: float) -> List[str]:
+    baseline_by_spider: Dict[str, dict] = {result['spider']: result for result in baseline}
+    regressions = []
+    for result in results:
+        previous = baseline_by_spider.get(result['spider'])
+        if previous is None:
+            continue
+        if result['docs'] < previous['docs']:
+            regressions.append(f"{result['spider']}: {result['docs']} docs, baseline {previous['docs']}")
+        if result['docs_per_sec'] < previous['docs_per_sec'] * (1 - tolerance):
+            regressions.append(
+                f"{result['spider']}: {result['docs_per_sec']:.1f} docs/s, baseline {previous['docs_per_sec']:.1f}"
+            )
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('spiders', nargs='*', help=f"any of {', '.join(SPIDERS)}, all by default")
+    for name, default in MockOptions._field_defaults.items():
+        parser.add_argument(f"--{name.replace('_', '-')}", type=type(default), default=default)
+    parser.add_argument('--keep-rate-limit', action='store_true', help="keep the spiders' rate_limit sections")
+    parser.add_argument('--verbose', action='store_true', help="keep the spiders' logs on stderr")
+    parser.add_argument('--output', help="write the results as JSON")
+    parser.add_argument('--baseline', help="results JSON of an earlier run to compare against")
+    parser.add_argument('--tolerance', type=float, default=0.2, help="allowed docs/s drop against the baseline")
+    parser.add_argument('--timeout', type=float, default=600.0, help="seconds a spider may run before it counts as failed")
+    args = parser.parse_args()
+    unknown = set(args.spiders) - set(SPIDERS)
+    if unknown:
+        parser.error(f"unknown spiders: {', '.join(sorted(unknown))}")
+
+    options = MockOptions(**{name: getattr(args, name) for name in MockOptions._fields})
+    try:
+        results = benchmark(args.spiders or list(SPIDERS), options, args.keep_rate_limit, args.verbose, args.timeout)
+    except RuntimeError as err:
+        print(f"error: {err}", file=sys.stderr)
+        sys.exit(1)
+    print(format_results(results))
+    if args.output is not None:
+        Path(args.output).write_text(json.dumps({"options": options._asdict(), "results": results}, indent=2))
+    if args.baseline is not None:
+        baseline = json.loads(Path(args.baseline).read_text())
+        if baseline['options'] != options._asdict():
+            print(f"warning: baseline ran with different options: {baseline['options']}", file=sys.stderr)
+        regressions = find_regressions(results, baseline['results'], args.tolerance)
+        for regression in regressions:
+            print(f"regression: {regression}", file=sys.stderr)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,39 +1,28 @@
-import re
 import uuid
-import random
-import asyncio
+import functools
 import urllib.parse
-from pathlib import Path
-from typing import Iterable
+from typing import AsyncIterator, Iterable
 
-import pymongo
 import aiohttp
 from loguru import logger
 
+from tspider.db.schema import CollectionSchema
 from tspider.spiders.base import SpiderBase
-from tspider.utils.proxy import ProxyManager
-from tspider.db.mongo import MongoDBCollection
+from tspider.utils.content import Field
 from tspider.utils.time import get_now
 
 
+FILENAME_FIELD = Field(regex=r'filename="(.*)"', strip=False)
+
+
 class CebPubServiceSpider(SpiderBase):
-    def __init__(self, config_filepath: str):
-        super().__init__(config_filepath)
+    schema = CollectionSchema(key='document_id', query_fields=['content_hash'])
+
+    def __init__(self, config_filepath: str, **kwargs):
+        super().__init__(config_filepath, **kwargs)
 
         self.base_list_url = self.config.base_list_url
         self.timeout = aiohttp.ClientTimeout(total=self.config.timeout)
-        self.proxy_manager = ProxyManager(self.config.proxy_host, self.config.proxy_port)
-        self.db_manager = MongoDBCollection(
-            self.config.mongo_host,
-            self.config.mongo_port,
-            self.config.mongo_db,
-            self.config.mongo_collection
-        )
-        self.db_manager.collection.create_index(
-            [("document_id", pymongo.TEXT)],
-            unique=True,
-            name="document_index"
-        )
 
     async def get_one_url_list(self, url: str, page_num: int) -> Iterable[str]:
         post_headers = {
@@ -46,53 +35,39 @@ class CebPubServiceSpider(SpiderBase):
             "row": "10",
             "page": "10",
         }
-        proxy = await self.proxy_manager.get_proxy()
-        for _ in range(self.config.max_request_attempt):
-            try:
-                logger.info(f"Crawling {url}, page: {page_num}, proxy: {proxy}")
-                async with aiohttp.ClientSession() as session:
-                    async with session.post(
-                        url,
-                        headers=post_headers,
-                        data=payload,
-                        proxy=proxy,
-                        timeout=self.timeout
-                    ) as response:
-                        if response.status != 200:
-                            return {"object": {"page": {"totalPage": 0}, "list": []}}
-                        return await response.json()
-            except aiohttp.client_exceptions.ClientProxyConnectionError:
-                logger.warning(f"Proxy invalid: {proxy}")
-                await self.proxy_manager.delete_proxy(proxy)
-                proxy = await self.proxy_manager.get_proxy()
-            except aiohttp.client_exceptions.ClientOSError:
-                logger.warning(f"ClientOSError Page Num: {page_num}")
-                await asyncio.sleep(self.config.sleep + random.random())
-            except aiohttp.client_exceptions.ServerDisconnectedError:
-                logger.warning(f"ClientOSError Page Num: {page_num}")
-                await asyncio.sleep(self.config.sleep + random.random())
-            except asyncio.TimeoutError:
-                logger.warning(f"TimeoutError Page Num: {page_num}")
-                await asyncio.sleep(self.config.sleep + random.random())
-            except aiohttp.client_exceptions.ClientPayloadError:
-                logger.error(f"ClientPayloadError Page Num: {page_num}")
-                await asyncio.sleep(self.config.sleep + random.random())
-
-        return {"object": {"page": {"totalPage": 0}, "list": []}}
 
-    async def get_url_list(self, *args, **kwargs) -> Iterable[str]:
-        # url_set only holds documentId here
-        url_set = set()
-        start_page_num = self.config.start_page_num
-        tot_page_num = self.config.tot_page_num
-        logger.info(f"Total page number: {tot_page_num}")
+        async def fetch(proxy):
+            logger.info(f"Crawling {url}, page: {page_num}, proxy: {proxy}")
+            async with self.request(
+                'POST',
+                url,
+                headers=post_headers,
+                data=payload,
+                proxy=proxy,
+                timeout=self.timeout,
+                cache=True
+            ) as response:
+                response.raise_for_status()
+                return await response.json()
+
+        return await self.retry_policy.run(
+            fetch,
+            proxy_manager=self.proxy_manager,
+            default=None,
+            desc=f"Page Num: {page_num}"
+        )
 
-        tasks = []
-        for page_num in range(start_page_num, tot_page_num + 1):
-            task = asyncio.create_task(self.get_one_url_list(self.base_list_url, page_num))
-            tasks.append(task)
-        results = await asyncio.gather(*tasks)
-        for result in results:
+    async def get_url_list(self, *args, **kwargs) -> AsyncIterator[str]:
+        fetch_page = functools.partial(self.get_one_url_list, self.base_list_url)
+        pages = self.paginate(
+            fetch_page,
+            self.config.start_page_num,
+            self.config.get('tot_page_num'),
+            get_total=self.get_total_page,
+            is_empty=self.is_empty_page,
+            is_known=self.is_known_page
+        )
+        async for _, result in pages:
             result = result.get('object')
             if result is not None:
                 page_ = result.get('page')
@@ -101,22 +76,34 @@ class CebPubServiceSpider(SpiderBase):
                 if list_ is not None:
                     for ins in list_:
                         document_id = ins.get('documentid')
-                        if document_id is not None:
-                            url_set.add(document_id)
-                            self.db_manager.insert_one({
+                        if document_id is not None and self.is_known(document_id):
+                            continue
+                        if document_id is not None and not self.is_duplicate(document_id):
+                            await self.db_manager.insert_one({
                                 "document_id": document_id,
                                 "guid": None,
                                 "download_url": None,
                                 "downloaded": False,
                                 "filename": None,
                                 "filepath": None,
+                                "content_hash": None,
                                 "raw_content_disposition": None,
                                 "insert_time": get_now(),
                                 "insert_guid_time": None,
                                 "download_time": None,
                             })
+                            yield document_id
+
+    def get_total_page(self, result: dict):
+        page_ = (result.get('object') or {}).get('page') or {}
+        return page_.get('totalPage')
+
+    def is_empty_page(self, result: dict) -> bool:
+        return not (result.get('object') or {}).get('list')
 
-        return url_set
+    def is_known_page(self, result: dict) -> bool:
+        list_ = (result.get('object') or {}).get('list')
+        return bool(list_) and all(self.is_known(ins.get('documentid')) for ins in list_)
 
     async def craw_one(self, document_id: str) -> object:
         guid = await self.get_guid(document_id)
@@ -130,7 +117,7 @@ class CebPubServiceSpider(SpiderBase):
             with self.output_dir.joinpath('download_urls.txt').open('a') as fout:
                 fout.write(f"{download_url}\n")
                 fout.flush()
-            self.db_manager.update_one(
+            await self.db_manager.update_one(
                 {"document_id": document_id},
                 {"$set": {
                     "guid": guid,
@@ -148,73 +135,58 @@ class CebPubServiceSpider(SpiderBase):
                 "documentId": document_id,
                 "type": "yes"
             }
-            proxy = await self.proxy_manager.get_proxy()
-            # in case of competing with each requests
-            await asyncio.sleep(1.5 + random.random() * 10)
-            for _ in range(self.config.max_request_attempt):
-                try:
-                    logger.info(f"Downloading: {document_id}")
-                    async with aiohttp.ClientSession() as session:
-                        async with session.post(
-                            self.config.download_api,
-                            headers=headers,
-                            params=params,
-                            proxy=proxy,
-                            timeout=self.timeout
-                        ) as response:
-                            if response.status != 200:
-                                return
-                            save_status = await self.save_one(response)
-                            if save_status is not None:
-                                self.db_manager.update_one(
-                                    {"document_id": document_id},
-                                    {
-                                        "$set": {
-                                            "download_time": get_now(),
-                                            "downloaded": True,
-                                            "filename": save_status[0],
-                                            "filepath": str(save_status[1].absolute()),
-                                            "raw_content_disposition": response.headers.get('Content-Disposition'),
-                                        }
-                                    }
-                                )
-                            else:
-                                raise asyncio.TimeoutError("Error Downloading")
-                except aiohttp.client_exceptions.ClientProxyConnectionError:
-                    logger.warning(f"Proxy invalid: {proxy}")
-                    await self.proxy_manager.delete_proxy(proxy)
-                    proxy = await self.proxy_manager.get_proxy()
-                except aiohttp.client_exceptions.ClientOSError:
-                    logger.warning(f"ClientOSError Downloading {document_id} Failed")
-                    await asyncio.sleep(self.config.sleep + random.random())
-                except aiohttp.client_exceptions.ServerDisconnectedError:
-                    logger.warning(f"ServerDisconnectedError Downloading {document_id} Failed")
-                    await asyncio.sleep(self.config.sleep + random.random())
-                except asyncio.TimeoutError:
-                    logger.warning(f"TimeoutError Downloading {document_id} Failed")
-                    await asyncio.sleep(self.config.sleep + random.random())
 
-    async def save_one(self, response):
-        try:
-            filename = self.get_filename(response)
-            if len(filename.encode()) > 30:
-                filename = filename[-30:]
-            filepath = Path.joinpath(self.output_dir, filename)
-            content = await response.read()
-            logger.info(f"Save into: {filepath.absolute()}")
-            with filepath.open('wb') as fout:
-                fout.write(content)
-            return (filename, filepath)
-        except aiohttp.client_exceptions.ClientPayloadError:
-            logger.error(f"ClientPayloadError {response.url}")
-            return False
+            async def download(proxy):
+                logger.info(f"Downloading: {document_id}")
+                async with self.request(
+                    'POST',
+                    self.config.download_api,
+                    headers={**headers, **self.sink.get_resume_headers(document_id)},
+                    params=params,
+                    proxy=proxy,
+                    timeout=self.timeout
+                ) as response:
+                    self.sink.check_range(response, document_id)
+                    response.raise_for_status()
+                    saved = await self.save_one(response, document_id)
+                    await self.db_manager.update_one(
+                        {"document_id": document_id},
+                        {
+                            "$set": {
+                                "download_time": get_now(),
+                                "downloaded": True,
+                                "filename": saved.filename,
+                                "filepath": str(saved.filepath.absolute()),
+                                "content_hash": saved.digest,
+                                "size": saved.size,
+                                "raw_content_disposition": response.headers.get('Content-Disposition'),
+                            }
+                        }
+                    )
+                    return True
+
+            return await self.retry_policy.run(
+                download,
+                proxy_manager=self.proxy_manager,
+                default=False,
+                desc=f"Downloading {document_id}"
+            )
+        return False
+
+    async def save_one(self, response, document_id: str):
+        # ClientPayloadError propagates to the retry policy
+        filename = self.get_filename(response)
+        if len(filename.encode()) > 30:
+            filename = filename[-30:]
+        saved = await self.sink.save(response, filename, key=document_id)
+        logger.info(f"Save into: {saved.filepath.absolute()}")
+        return saved
 
     def get_filename(self, response):
         filename = response.headers.get('Content-Disposition', uuid.uuid4().hex)
-        obj = re.search(r'filename="(.*)"', filename)
-        if obj:
-            filename = obj.group(1)
-            filename = urllib.parse.unquote(filename)
+        matched = FILENAME_FIELD.extract(filename)
+        if matched is not None:
+            filename = urllib.parse.unquote(matched)
         return filename
 
     async def get_guid(self, document_id: str):
@@ -225,38 +197,24 @@ class CebPubServiceSpider(SpiderBase):
         payload = {
             "documentId": document_id
         }
-        proxy = await self.proxy_manager.get_proxy()
-        # in case of competing with each requests
-        await asyncio.sleep(1.5 + random.random() * 10)
-        for _ in range(self.config.max_request_attempt):
-            try:
-                logger.info(f"Get GUID: documentId: {document_id}, proxy: {proxy}")
-                async with aiohttp.ClientSession() as session:
-                    async with session.post(
-                        url,
-                        headers=post_headers,
-                        data=payload,
-                        proxy=proxy,
-                        timeout=self.timeout
-                    ) as response:
-                        if response.status != 200:
-                            return {"object": {"newFileId1": None}}
-                        return await response.json()
-            except aiohttp.client_exceptions.ClientProxyConnectionError:
-                logger.warning(f"Proxy invalid: {proxy}")
-                await self.proxy_manager.delete_proxy(proxy)
-                proxy = await self.proxy_manager.get_proxy()
-            except aiohttp.client_exceptions.ClientOSError:
-                logger.warning(f"ClientOSError Get GUID {document_id} Failed")
-                await asyncio.sleep(self.config.sleep + random.random())
-            except aiohttp.client_exceptions.ServerDisconnectedError:
-                logger.warning(f"ServerDisconnectedError Get GUID {document_id} Failed")
-                await asyncio.sleep(self.config.sleep + random.random())
-            except asyncio.TimeoutError:
-                logger.warning(f"TimeoutError Get GUID {document_id} Failed")
-                await asyncio.sleep(self.config.sleep + random.random())
-            except aiohttp.client_exceptions.ClientPayloadError:
-                logger.error(f"ClientPayloadError Get GUID {document_id}")
-                await asyncio.sleep(self.config.sleep + random.random())
 
-        return {"object": {"newFileId1": None}}
+        async def fetch(proxy):
+            logger.info(f"Get GUID: documentId: {document_id}, proxy: {proxy}")
+            async with self.request(
+                'POST',
+                url,
+                headers=post_headers,
+                data=payload,
+                proxy=proxy,
+                timeout=self.timeout,
+                cache=True
+            ) as response:
+                response.raise_for_status()
+                return await response.json()
+
+        return await self.retry_policy.run(
+            fetch,
+            proxy_manager=self.proxy_manager,
+            default=None,
+            desc=f"Get GUID {document_id}"
+        )
@@ -1,40 +1,23 @@
-import re
-import uuid
-import random
-import asyncio
+import functools
 import urllib.parse
-from pathlib import Path
-from typing import Iterable
+from typing import AsyncIterator, Iterable
 
-import pymongo
 import aiohttp
 from loguru import logger
-from lxml import etree
 
+from tspider.db.schema import CollectionSchema
 from tspider.spiders.base import SpiderBase
-from tspider.utils.proxy import ProxyManager
-from tspider.db.mongo import MongoDBCollection
 from tspider.utils.time import get_now
 
 
 class CnInfoFundContractSpider(SpiderBase):
-    def __init__(self, config_filepath: str):
-        super().__init__(config_filepath)
+    schema = CollectionSchema(key='document_id', query_fields=['content_hash'])
+
+    def __init__(self, config_filepath: str, **kwargs):
+        super().__init__(config_filepath, **kwargs)
 
         self.base_list_url = self.config.base_list_url
         self.timeout = aiohttp.ClientTimeout(total=self.config.timeout)
-        self.proxy_manager = ProxyManager(self.config.proxy_host, self.config.proxy_port)
-        self.db_manager = MongoDBCollection(
-            self.config.mongo_host,
-            self.config.mongo_port,
-            self.config.mongo_db,
-            self.config.mongo_collection
-        )
-        self.db_manager.collection.create_index(
-            [("document_id", pymongo.TEXT)],
-            unique=True,
-            name="document_index"
-        )
 
     async def get_one_url_list(self, url: str, page_num: int) -> Iterable[str]:
         headers = {
@@ -56,70 +39,51 @@ class CnInfoFundContractSpider(SpiderBase):
             "sortType": "desc",
             "pageNum": str(page_num),
         }
-        proxy = await self.proxy_manager.get_proxy()
-        for _ in range(self.config.max_request_attempt):
-            try:
-                logger.info(f"Crawling {url}, page: {page_num}, proxy: {proxy}")
-                async with aiohttp.ClientSession() as session:
-                    async with session.get(
-                        url,
-                        headers=headers,
-                        params=params,
-                        proxy=proxy,
-                        timeout=self.timeout
-                    ) as response:
-                        response.raise_for_status()
-                        result = await response.json()
-                        logger.info(f"Successfully Crawled {url}, page: {page_num}, proxy: {proxy}")
-                        inses = result.get('announcements')
-                        if inses is None:
-                            inses = []
-                        return inses
-            except aiohttp.ClientResponseError:
-                logger.warning(f"ClientResponseError Page Num: {page_num}")
-                await asyncio.sleep(self.config.sleep + random.random())
-            except aiohttp.client_exceptions.ClientProxyConnectionError:
-                logger.warning(f"Proxy invalid: {proxy}")
-                await self.proxy_manager.delete_proxy(proxy)
-                proxy = await self.proxy_manager.get_proxy()
-            except aiohttp.client_exceptions.ClientOSError:
-                logger.warning(f"ClientOSError Page Num: {page_num}")
-                await asyncio.sleep(self.config.sleep + random.random())
-            except aiohttp.client_exceptions.ServerDisconnectedError:
-                logger.warning(f"ClientOSError Page Num: {page_num}")
-                await asyncio.sleep(self.config.sleep + random.random())
-            except asyncio.TimeoutError:
-                logger.warning(f"TimeoutError Page Num: {page_num}")
-                await asyncio.sleep(self.config.sleep + random.random())
-            except aiohttp.client_exceptions.ClientPayloadError:
-                logger.warning(f"ClientPayloadError Page Num: {page_num}")
-                await asyncio.sleep(self.config.sleep + random.random())
-
-        # logger.warning(f"Proxy invalid: {proxy}")
-        # await self.proxy_manager.delete_proxy(proxy)
-        return []
-
-    async def get_url_list(self, *args, **kwargs) -> Iterable[str]:
-        # url_list only holds documentId here
-        url_list = []
-        start_page_num = self.config.start_page_num
-        tot_page_num = self.config.tot_page_num
-        logger.info(f"Total page number: {tot_page_num}")
-
-        tasks = []
-        page_num_list = list(range(start_page_num, tot_page_num + 1))
-        for page_num in page_num_list:
-            task = asyncio.create_task(self.get_one_url_list(self.base_list_url, page_num))
-            tasks.append(task)
-        results = await asyncio.gather(*tasks)
-        for page_num, list_ in zip(page_num_list, results):
+        async def fetch(proxy):
+            logger.info(f"Crawling {url}, page: {page_num}, proxy: {proxy}")
+            async with self.request(
+                'GET',
+                url,
+                headers=headers,
+                params=params,
+                proxy=proxy,
+                timeout=self.timeout,
+                cache=True
+            ) as response:
+                response.raise_for_status()
+                result = await response.json()
+                logger.info(f"Successfully Crawled {url}, page: {page_num}, proxy: {proxy}")
+                inses = result.get('announcements')
+                if inses is None:
+                    inses = []
+                return inses
+
+        return await self.retry_policy.run(
+            fetch,
+            proxy_manager=self.proxy_manager,
+            default=None,
+            desc=f"Page Num: {page_num}"
+        )
+
+    async def get_url_list(self, *args, **kwargs) -> AsyncIterator[dict]:
+        fetch_page = functools.partial(self.get_one_url_list, self.base_list_url)
+        pages = self.paginate(
+            fetch_page,
+            self.config.start_page_num,
+            self.config.get('tot_page_num'),
+            is_known=self.is_known_page
+        )
+        async for page_num, list_ in pages:
             logger.info(f"page: {page_num}, result: {len(list_)}")
             for ins in list_:
-                url_list.append(ins)
                 document_id = ins['announcementId']
+                if self.is_known(document_id):
+                    continue
+                if self.is_duplicate(document_id):
+                    continue
                 title = ins['announcementTitle'].replace('<em>', '').replace('</em>', '')
                 download_url = urllib.parse.urljoin(self.config.download_base_url, ins['adjunctUrl'])
-                self.db_manager.insert_one({
+                await self.db_manager.insert_one({
                     "document_id": document_id,
                     "title": title,
                     "insert_time": get_now(),
@@ -128,9 +92,21 @@ class CnInfoFundContractSpider(SpiderBase):
                     "download_time": None,
                     "filename": None,
                     "filepath": None,
+                    "content_hash": None,
                 })
+                ins['page_num'] = page_num
+                yield ins
 
-        return url_list
+    def is_known_page(self, list_: list) -> bool:
+        return bool(list_) and all(self.is_known(ins['announcementId']) for ins in list_)
+
+    def get_item_key(self, instance: dict) -> str:
+        return instance['announcementId']
+
+    def get_publish_time(self, instance: dict):
+        # milliseconds since the epoch
+        announcement_time = instance.get('announcementTime')
+        return announcement_time / 1000 if announcement_time is not None else None
 
     async def craw_one(self, instance: dict) -> object:
         headers = {
@@ -148,75 +124,47 @@ class CnInfoFundContractSpider(SpiderBase):
         title = instance['announcementTitle'].replace('<em>', '').replace('</em>', '')
         filetype = download_suffix.split('.')[-1]
         download_url = urllib.parse.urljoin(self.config.download_base_url, download_suffix)
-        while True:
-            try:
-                proxy = await self.proxy_manager.get_proxy()
-                break
-            except:
-                await asyncio.sleep(random.random() * 5)
-                continue
-        # in case of competing with each requests
-        # await asyncio.sleep(1.5 + random.random() * 10)
-        for _ in range(self.config.max_request_attempt):
-            try:
-                logger.info(f"Requesting: {title}")
-                async with aiohttp.ClientSession() as session:
-                    async with session.get(
-                        download_url,
-                        headers=headers,
-                        proxy=proxy,
-                        timeout=self.timeout
-                    ) as response:
-                        response.raise_for_status()
-                        save_status = self.save_one(title + f'.{filetype}', await response.read())
-                        if save_status is not None:
-                            logger.info(f"Successfully Downloading: {title}")
-                            self.db_manager.update_one(
-                                {"document_id": document_id},
-                                {
-                                    "$set": {
-                                        "download_time": get_now(),
-                                        "downloaded": True,
-                                        "filename": save_status[0],
-                                        "filepath": str(save_status[1].absolute())
-                                    }
-                                }
-                            )
-                        else:
-                            raise asyncio.TimeoutError("Error Downloading")
-            except aiohttp.client_exceptions.ServerDisconnectedError:
-                logger.error(f"ServerDisconnectedError {download_url}")
-                await asyncio.sleep(self.config.sleep + random.random())
-            except aiohttp.client_exceptions.ClientPayloadError:
-                logger.error(f"ClientPayloadError {download_url}")
-                await asyncio.sleep(self.config.sleep + random.random())
-            except aiohttp.ClientResponseError:
-                logger.warning(f"ClientResponseError: {document_id}")
-                await asyncio.sleep(self.config.sleep + random.random())
-            except aiohttp.client_exceptions.ClientProxyConnectionError:
-                logger.warning(f"Proxy invalid: {proxy}")
-                await self.proxy_manager.delete_proxy(proxy)
-                proxy = await self.proxy_manager.get_proxy()
-            except aiohttp.client_exceptions.ClientOSError:
-                logger.warning(f"ClientOSError Downloading {document_id} Failed")
-                await asyncio.sleep(self.config.sleep + random.random())
-            except aiohttp.client_exceptions.ServerDisconnectedError:
-                logger.warning(f"ServerDisconnectedError Downloading {document_id} Failed")
-                await asyncio.sleep(self.config.sleep + random.random())
-            except asyncio.TimeoutError:
-                logger.warning(f"TimeoutError Downloading {document_id} Failed")
-                await asyncio.sleep(self.config.sleep + random.random())
-
-    def save_one(self, title: str, content: bytes):
-        try:
-            filename = title
-            if len(filename.encode()) > 30:
-                filename = filename[-30:]
-            filepath = Path.joinpath(self.output_dir, filename)
-            logger.info(f"Save into: {filepath.absolute()}")
-            with filepath.open('wb') as fout:
-                fout.write(content)
-            return (filename, filepath)
-        except Exception as err:
-            logger.error(f"{str(err)}")
-            return None
+
+        async def download(proxy):
+            logger.info(f"Requesting: {title}")
+            async with self.request(
+                'GET',
+                download_url,
+                headers={**headers, **self.sink.get_resume_headers(document_id)},
+                proxy=proxy,
+                timeout=self.timeout
+            ) as response:
+                self.sink.check_range(response, document_id)
+                response.raise_for_status()
+                saved = await self.save_one(title + f'.{filetype}', response, document_id)
+                logger.info(f"Successfully Downloading: {title}")
+                await self.db_manager.update_one(
+                    {"document_id": document_id},
+                    {
+                        "$set": {
+                            "download_time": get_now(),
+                            "downloaded": True,
+                            "filename": saved.filename,
+                            "filepath": str(saved.filepath.absolute()),
+                            "content_hash": saved.digest,
+                            "size": saved.size,
+                        }
+                    }
+                )
+                return True
+
+        return await self.retry_policy.run(
+            download,
+            proxy_manager=self.proxy_manager,
+            default=False,
+            desc=f"Downloading {document_id}"
+        )
+
+    async def save_one(self, title: str, response, document_id: str):
+        # ClientPayloadError propagates to the retry policy
+        filename = title
+        if len(filename.encode()) > 30:
+            filename = filename[-30:]
+        saved = await self.sink.save(response, filename, key=document_id)
+        logger.info(f"Save into: {saved.filepath.absolute()}")
+        return saved
@@ -1,10 +1,12 @@
 import sys
-sys.path.insert(0, "/data/tzhu/BidSpider")
+from pathlib import Path
+# the repository root, for tspider
+sys.path.insert(0, str(Path(__file__).resolve().parents[2]))
 
 from cninfo_fund_contract import CnInfoFundContractSpider
 
 
 if __name__ == "__main__":
-    config_filepath = "examples/cninfo_fund_contract/config.yaml"
+    config_filepath = str(Path(__file__).resolve().parent.joinpath("config.yaml"))
     spider = CnInfoFundContractSpider(config_filepath)
     spider.start()
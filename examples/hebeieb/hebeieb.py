@@ -1,40 +1,53 @@
-import re
-import uuid
-import random
 import asyncio
+import functools
 import urllib.parse
-from pathlib import Path
-from typing import Iterable
+from typing import AsyncIterator, Iterable, List, Optional
 
-import pymongo
 import aiohttp
 from loguru import logger
 from lxml import etree
 
+from tspider.db.schema import CollectionSchema
 from tspider.spiders.base import SpiderBase
-from tspider.utils.proxy import ProxyManager
-from tspider.db.mongo import MongoDBCollection
+from tspider.utils.content import Extractor, Field, parse_html
 from tspider.utils.time import get_now
 
 
+# parsing runs in the spider's parse pool, so these stay module-level
+# functions of raw bytes that can be pickled into worker processes
+URL_LIST_EXTRACTOR = Extractor({
+    "href": Field(xpath='@href'),
+    "title": Field(xpath='@title', strip=False),
+}, root='//div[@class="publicont"]/div/h4/a')
+ARTICLE_FIELD = Field(xpath='//*[@id="article_con"]/div/table')
+
+
+def parse_url_list_page(content: bytes, encoding: Optional[str], base_url: str) -> List[dict]:
+    doc = parse_html(content, encoding)
+    url_list = []
+    for item in URL_LIST_EXTRACTOR.extract_all(doc):
+        url_list.append({
+            "url": urllib.parse.urljoin(base_url, item['href']),
+            "title": item['title']
+        })
+    return url_list
+
+
+def extract_article(content: bytes, encoding: Optional[str]) -> bytes:
+    table = ARTICLE_FIELD.extract(parse_html(content, encoding))
+    if table is None:
+        raise ValueError("Article table not found")
+    return etree.tostring(table, pretty_print=True, encoding='utf-8', method='html')
+
+
 class HebeiebBidCallSpider(SpiderBase):
-    def __init__(self, config_filepath: str):
-        super().__init__(config_filepath)
+    schema = CollectionSchema(key='document_id', query_fields=['content_hash'])
+
+    def __init__(self, config_filepath: str, **kwargs):
+        super().__init__(config_filepath, **kwargs)
 
         self.base_list_url = self.config.base_list_url
         self.timeout = aiohttp.ClientTimeout(total=self.config.timeout)
-        self.proxy_manager = ProxyManager(self.config.proxy_host, self.config.proxy_port)
-        self.db_manager = MongoDBCollection(
-            self.config.mongo_host,
-            self.config.mongo_port,
-            self.config.mongo_db,
-            self.config.mongo_collection
-        )
-        self.db_manager.collection.create_index(
-            [("document_id", pymongo.TEXT)],
-            unique=True,
-            name="document_index"
-        )
 
     async def get_one_url_list(self, url: str, page_num: int) -> Iterable[str]:
         post_headers = {
@@ -58,55 +71,28 @@ class HebeiebBidCallSpider(SpiderBase):
             "KeyStr": "",
             "KeyType": "ggname",
         }
-        proxy = await self.proxy_manager.get_proxy()
-        for _ in range(self.config.max_request_attempt):
-            try:
-                logger.info(f"Crawling {url}, page: {page_num}, proxy: {proxy}")
-                async with aiohttp.ClientSession() as session:
-                    async with session.post(
-                        url,
-                        headers=post_headers,
-                        data=payload,
-                        proxy=proxy,
-                        timeout=self.timeout
-                    ) as response:
-                        response.raise_for_status()
-                        html = await response.text()
-                        logger.info(f"Successfully Crawled {url}, page: {page_num}, proxy: {proxy}")
-                        return self.parse_url_list_page(html)
-            except aiohttp.ClientResponseError:
-                logger.warning(f"ClientResponseError Page Num: {page_num}")
-                await asyncio.sleep(self.config.sleep + random.random())
-            except aiohttp.client_exceptions.ClientProxyConnectionError:
-                logger.warning(f"Proxy invalid: {proxy}")
-                await self.proxy_manager.delete_proxy(proxy)
-                proxy = await self.proxy_manager.get_proxy()
-            except aiohttp.client_exceptions.ClientOSError:
-                logger.warning(f"ClientOSError Page Num: {page_num}")
-                await asyncio.sleep(self.config.sleep + random.random())
-            except aiohttp.client_exceptions.ServerDisconnectedError:
-                logger.warning(f"ClientOSError Page Num: {page_num}")
-                await asyncio.sleep(self.config.sleep + random.random())
-            except asyncio.TimeoutError:
-                logger.warning(f"TimeoutError Page Num: {page_num}")
-                await asyncio.sleep(self.config.sleep + random.random())
-            except aiohttp.client_exceptions.ClientPayloadError:
-                logger.warning(f"ClientPayloadError Page Num: {page_num}")
-                await asyncio.sleep(self.config.sleep + random.random())
-
-        await self.proxy_manager.delete_proxy(proxy)
-        return []
-
-    def parse_url_list_page(self, html):
-        doc = etree.HTML(html)
-        elems = doc.xpath('//div[@class="publicont"]/div/h4/a')
-        url_list = []
-        for elem in elems:
-            url_list.append({
-                "url": urllib.parse.urljoin(self.config.base_url, elem.get('href')),
-                "title": elem.get('title')
-            })
-        return url_list
+        async def fetch(proxy):
+            logger.info(f"Crawling {url}, page: {page_num}, proxy: {proxy}")
+            async with self.request(
+                'POST',
+                url,
+                headers=post_headers,
+                data=payload,
+                proxy=proxy,
+                timeout=self.timeout,
+                cache=True
+            ) as response:
+                response.raise_for_status()
+                content = await response.read()
+                logger.info(f"Successfully Crawled {url}, page: {page_num}, proxy: {proxy}")
+                return await self.parse(parse_url_list_page, content, response.get_encoding(), self.config.base_url)
+
+        return await self.retry_policy.run(
+            fetch,
+            proxy_manager=self.proxy_manager,
+            default=None,
+            desc=f"Page Num: {page_num}"
+        )
 
     def get_doc_id_from_url(self, url):
         parsed_url = urllib.parse.urlparse(url)
@@ -114,25 +100,23 @@ class HebeiebBidCallSpider(SpiderBase):
         document_id = f"{queries['categoryid'][0]}###{queries['infoid'][0]}"
         return document_id
 
-    async def get_url_list(self, *args, **kwargs) -> Iterable[str]:
-        # url_list only holds documentId here
-        url_list = []
-        start_page_num = self.config.start_page_num
-        tot_page_num = self.config.tot_page_num
-        logger.info(f"Total page number: {tot_page_num}")
-
-        tasks = []
-        page_num_list = list(range(start_page_num, tot_page_num + 1))
-        for page_num in page_num_list:
-            task = asyncio.create_task(self.get_one_url_list(self.base_list_url, page_num))
-            tasks.append(task)
-        results = await asyncio.gather(*tasks)
-        for page_num, list_ in zip(page_num_list, results):
+    async def get_url_list(self, *args, **kwargs) -> AsyncIterator[dict]:
+        fetch_page = functools.partial(self.get_one_url_list, self.base_list_url)
+        pages = self.paginate(
+            fetch_page,
+            self.config.start_page_num,
+            self.config.get('tot_page_num'),
+            is_known=self.is_known_page
+        )
+        async for page_num, list_ in pages:
             logger.info(f"page: {page_num}, result: {len(list_)}")
             for ins in list_:
-                url_list.append(ins)
                 document_id = self.get_doc_id_from_url(ins['url'])
-                self.db_manager.insert_one({
+                if self.is_known(document_id):
+                    continue
+                if self.is_duplicate(document_id):
+                    continue
+                await self.db_manager.insert_one({
                     "document_id": document_id,
                     "title": ins['title'],
                     "insert_time": get_now(),
@@ -141,9 +125,16 @@ class HebeiebBidCallSpider(SpiderBase):
                     "download_time": None,
                     "filename": None,
                     "filepath": None,
+                    "content_hash": None,
                 })
+                ins['page_num'] = page_num
+                yield ins
+
+    def is_known_page(self, list_: list) -> bool:
+        return bool(list_) and all(self.is_known(self.get_doc_id_from_url(ins['url'])) for ins in list_)
 
-        return url_list
+    def get_item_key(self, instance: dict) -> str:
+        return self.get_doc_id_from_url(instance['url'])
 
     async def craw_one(self, instance: dict) -> object:
         headers = {
@@ -164,81 +155,55 @@ class HebeiebBidCallSpider(SpiderBase):
             "categoryid": category_id,
             "infoid": info_id,
         }
-        while True:
-            try:
-                proxy = await self.proxy_manager.get_proxy()
-                break
-            except:
-                await asyncio.sleep(random.random() * 5)
-                continue
-        # in case of competing with each requests
-        # await asyncio.sleep(1.5 + random.random() * 10)
-        for _ in range(self.config.max_request_attempt):
-            try:
-                logger.info(f"Requesting: {instance['title']}")
-                async with aiohttp.ClientSession() as session:
-                    async with session.get(
-                        self.config.download_api,
-                        params=params,
-                        headers=headers,
-                        proxy=proxy,
-                        timeout=self.timeout
-                    ) as response:
-                        response.raise_for_status()
-                        save_status = self.save_one(instance['title'], await response.text())
-                        if save_status is not None:
-                            logger.info(f"Successfully Downloading: {instance['title']}")
-                            self.db_manager.update_one(
-                                {"document_id": document_id},
-                                {
-                                    "$set": {
-                                        "download_time": get_now(),
-                                        "downloaded": True,
-                                        "filename": save_status[0],
-                                        "filepath": str(save_status[1].absolute())
-                                    }
-                                }
-                            )
-                        else:
-                            raise asyncio.TimeoutError("Error Downloading")
-            except aiohttp.client_exceptions.ServerDisconnectedError:
-                logger.error(f"ServerDisconnectedError {instance['url']}")
-                await asyncio.sleep(self.config.sleep + random.random())
-            except aiohttp.client_exceptions.ClientPayloadError:
-                logger.error(f"ClientPayloadError {instance['url']}")
-                await asyncio.sleep(self.config.sleep + random.random())
-            except aiohttp.ClientResponseError:
-                logger.warning(f"ClientResponseError: {document_id}")
-                await asyncio.sleep(self.config.sleep + random.random())
-            except aiohttp.client_exceptions.ClientProxyConnectionError:
-                logger.warning(f"Proxy invalid: {proxy}")
-                await self.proxy_manager.delete_proxy(proxy)
-                proxy = await self.proxy_manager.get_proxy()
-            except aiohttp.client_exceptions.ClientOSError:
-                logger.warning(f"ClientOSError Downloading {document_id} Failed")
-                await asyncio.sleep(self.config.sleep + random.random())
-            except aiohttp.client_exceptions.ServerDisconnectedError:
-                logger.warning(f"ServerDisconnectedError Downloading {document_id} Failed")
-                await asyncio.sleep(self.config.sleep + random.random())
-            except asyncio.TimeoutError:
-                logger.warning(f"TimeoutError Downloading {document_id} Failed")
-                await asyncio.sleep(self.config.sleep + random.random())
-
-    def save_one(self, title: str, html: str):
+
+        async def download(proxy):
+            logger.info(f"Requesting: {instance['title']}")
+            async with self.request(
+                'GET',
+                self.config.download_api,
+                params=params,
+                headers=headers,
+                proxy=proxy,
+                timeout=self.timeout,
+                cache=True
+            ) as response:
+                response.raise_for_status()
+                saved = await self.save_one(instance['title'], response, document_id)
+                if saved is None:
+                    raise asyncio.TimeoutError("Error Downloading")
+                logger.info(f"Successfully Downloading: {instance['title']}")
+                await self.db_manager.update_one(
+                    {"document_id": document_id},
+                    {
+                        "$set": {
+                            "download_time": get_now(),
+                            "downloaded": True,
+                            "filename": saved.filename,
+                            "filepath": str(saved.filepath.absolute()),
+                            "content_hash": saved.digest,
+                            "size": saved.size,
+                        }
+                    }
+                )
+                return True
+
+        return await self.retry_policy.run(
+            download,
+            proxy_manager=self.proxy_manager,
+            default=False,
+            desc=f"Downloading {document_id}"
+        )
+
+    async def save_one(self, title: str, response, document_id: str):
         try:
-            doc = etree.HTML(html)
-            content = etree.tostring(
-                doc.xpath('//*[@id="article_con"]/div/table')[0],
-                pretty_print=True, encoding='utf-8', method='html'
-            ).decode()
+            content = await self.parse(extract_article, await response.read(), response.get_encoding())
             filename = title
             if len(filename.encode()) > 30:
                 filename = filename[-30:]
-            filepath = Path.joinpath(self.output_dir, filename + '.html')
-            logger.info(f"Save into: {filepath.absolute()}")
-            with filepath.open('wt') as fout:
-                fout.write(content)
-            return (filename, filepath)
+            # segments keep the page too, other sinks only the article
+            saved = await self.sink.save_bytes(content, filename + '.html', key=document_id, response=response)
+            logger.info(f"Save into: {saved.filepath.absolute()}")
+            return saved
         except Exception as err:
             logger.error(f"{str(err)}")
             return None
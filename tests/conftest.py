@@ -0,0 +1,28 @@
+import sys
+
+import pytest
+from loguru import logger
+from omegaconf import OmegaConf
+
+from tspider.spiders.base import SpiderBase
+
+
+@pytest.fixture
+def make_spider(tmp_path):
+    # a bare spider over `config`, its output dir under `tmp_path`
+    spiders = []
+
+    def make(spider_class=SpiderBase, **config):
+        config_filepath = tmp_path.joinpath(f"spider{len(spiders)}.yaml")
+        OmegaConf.save(OmegaConf.create({"name": "test", "output_dir": str(tmp_path), **config}), config_filepath)
+        spider = spider_class(str(config_filepath))
+        spiders.append(spider)
+        return spider
+
+    yield make
+    for spider in spiders:
+        if spider.frontier is not None:
+            spider.frontier.close()
+    # each spider adds a log file sink, back to loguru's default one
+    logger.remove()
+    logger.add(sys.stderr)
@@ -0,0 +1,114 @@
+import gzip
+import random
+import asyncio
+import hashlib
+
+import aiohttp
+import pytest
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+
+from tspider.utils.download import StreamingSink
+
+
+# incompressible, a cut compressed body is cut halfway too
+CONTENT = random.Random(0).randbytes(64 * 1024)
+ETAG = '"v1"'
+
+
+def make_app(state: dict) -> web.Application:
+    # serves `CONTENT` with range support, cutting the connection after
+    # `state["cut_at"]` bytes of the body
+    async def handle(request):
+        state["headers"].append(dict(request.headers))
+        body, status, headers = CONTENT, 200, {"ETag": ETAG}
+        matched = request.headers.get("Range")
+        if matched is not None and request.headers.get("If-Range") == ETAG:
+            start = int(matched[len("bytes="):-1])
+            body, status = CONTENT[start:], 206
+            headers["Content-Range"] = f"bytes {start}-{len(CONTENT) - 1}/{len(CONTENT)}"
+        if state.get("gzip"):
+            body = gzip.compress(body)
+            headers["Content-Encoding"] = "gzip"
+        response = web.StreamResponse(status=status, headers=headers)
+        response.content_length = len(body)
+        await response.prepare(request)
+        cut_at = state.pop("cut_at", None)
+        await response.write(body[:cut_at])
+        if cut_at is not None:
+            # aiohttp drops what the client hasn't read once the connection fails
+            await asyncio.sleep(0.1)
+            request.transport.close()
+            return response
+        await response.write_eof()
+        return response
+
+    app = web.Application()
+    app.router.add_get("/file", handle)
+    return app
+
+
+def download(sink: StreamingSink, state: dict, key: str = "file"):
+    async def main():
+        async with TestServer(make_app(state)) as server:
+            async with aiohttp.ClientSession() as session:
+                headers = sink.get_resume_headers(key)
+                async with session.get(server.make_url("/file"), headers=headers) as response:
+                    sink.check_range(response, key)
+                    response.raise_for_status()
+                    return await sink.save(response, "file.bin", key=key)
+    return asyncio.run(main())
+
+
+def make_sink(tmp_path) -> StreamingSink:
+    return StreamingSink(tmp_path, chunk_size=1024, checkpoint_interval=4096)
+
+
+def test_interrupted_download_resumes(tmp_path):
+    sink = make_sink(tmp_path)
+    state = {"headers": [], "cut_at": 20000}
+    with pytest.raises(aiohttp.ClientPayloadError):
+        download(sink, state)
+    assert sink.get_part_path("file").exists()
+    assert sink.get_checkpoint_path("file").exists()
+
+    resume_headers = sink.get_resume_headers("file")
+    offset = int(resume_headers["Range"][len("bytes="):-1])
+    assert 0 < offset <= 20000
+    assert resume_headers["If-Range"] == ETAG
+    assert resume_headers["Accept-Encoding"] == "identity"
+
+    saved = download(sink, state)
+    assert state["headers"][-1]["Range"] == f"bytes={offset}-"
+    assert saved.filepath.read_bytes() == CONTENT
+    assert saved.size == len(CONTENT)
+    assert saved.digest == hashlib.sha256(CONTENT).hexdigest()
+    assert not sink.get_part_path("file").exists()
+    assert not sink.get_checkpoint_path("file").exists()
+
+
+def test_compressed_download_is_not_checkpointed(tmp_path):
+    sink = make_sink(tmp_path)
+    with pytest.raises(aiohttp.ClientPayloadError):
+        download(sink, {"headers": [], "gzip": True, "cut_at": 20000})
+    assert not sink.get_part_path("file").exists()
+    assert not sink.get_checkpoint_path("file").exists()
+
+    saved = download(sink, {"headers": [], "gzip": True})
+    assert saved.filepath.read_bytes() == CONTENT
+
+
+def test_compressed_range_response_restarts(tmp_path):
+    sink = make_sink(tmp_path)
+    state = {"headers": [], "cut_at": 20000}
+    with pytest.raises(aiohttp.ClientPayloadError):
+        download(sink, state)
+
+    # a server compressing the range regardless of `Accept-Encoding`
+    state["gzip"] = True
+    with pytest.raises(aiohttp.ClientPayloadError, match="Compressed range response"):
+        download(sink, state)
+    assert sink.get_resume_headers("file") == {"Accept-Encoding": "identity"}
+
+    state["gzip"] = False
+    assert download(sink, state).filepath.read_bytes() == CONTENT
@@ -0,0 +1,61 @@
+import sqlite3
+import datetime
+
+from tspider.db.frontier import FrontierState, SQLiteFrontier
+
+
+def test_resume_picks_up_unfinished_items(tmp_path):
+    path = tmp_path.joinpath("frontier.sqlite3")
+    frontier = SQLiteFrontier(path, max_attempts=2)
+    for key in "abcde":
+        assert frontier.add(key, {"key": key})
+    assert not frontier.add("a", {"key": "a"})
+    frontier.mark("a", FrontierState.DONE)
+    frontier.mark("b", FrontierState.IN_FLIGHT)
+    frontier.mark("c", FrontierState.FAILED)
+    frontier.mark("d", FrontierState.FAILED)
+    frontier.mark("d", FrontierState.FAILED)
+    frontier.close()
+
+    frontier = SQLiteFrontier(path, max_attempts=2)
+    # interrupted and retriable items, not done ones or those out of attempts
+    assert sorted(item["key"] for item in frontier.iter_pending()) == ["b", "c", "e"]
+    assert "a" in frontier and "f" not in frontier
+    assert frontier.get_progress("d")[0] == 2
+    frontier.close()
+
+
+def test_pending_items_follow_priority(tmp_path):
+    frontier = SQLiteFrontier(tmp_path.joinpath("frontier.sqlite3"), retry_penalty=10.0)
+    frontier.add("old", "old", priority=2.0)
+    frontier.add("new", "new", priority=1.0)
+    frontier.add("failed", "failed", priority=0.0)
+    frontier.mark("failed", FrontierState.FAILED)
+    assert list(frontier.iter_pending()) == ["new", "old", "failed"]
+    frontier.close()
+
+
+def test_datetimes_are_stored_as_strings(tmp_path):
+    frontier = SQLiteFrontier(tmp_path.joinpath("frontier.sqlite3"))
+    publish_time = datetime.datetime(2026, 1, 2, 3, 4, 5)
+    frontier.add("a", {"publish_time": publish_time})
+    [item] = frontier.iter_pending()
+    assert datetime.datetime.fromisoformat(item["publish_time"]) == publish_time
+    frontier.close()
+
+
+def test_discovered_time_is_migrated(tmp_path):
+    path = tmp_path.joinpath("frontier.sqlite3")
+    conn = sqlite3.connect(str(path))
+    conn.execute(
+        "CREATE TABLE frontier (key TEXT PRIMARY KEY, item TEXT NOT NULL, state TEXT NOT NULL,"
+        " attempts INTEGER NOT NULL DEFAULT 0, updated_time REAL NOT NULL)"
+    )
+    conn.execute("INSERT INTO frontier VALUES ('a', '{}', 'failed', 1, 1000.0)")
+    conn.commit()
+    conn.close()
+
+    frontier = SQLiteFrontier(path)
+    assert frontier.get_progress("a") == (1, 1000.0)
+    assert frontier.get_progress("b") == (0, None)
+    frontier.close()
@@ -0,0 +1,103 @@
+import asyncio
+
+import pytest
+
+
+def paginate(spider, fetch_page, *args, **kwargs):
+    async def collect():
+        return [page_num async for page_num, _ in spider.paginate(fetch_page, *args, **kwargs)]
+    return asyncio.run(collect())
+
+
+def test_stops_after_empty_pages(make_spider):
+    # without a last page, the list ends after `max_empty_pages` empty ones
+    spider = make_spider(pagination={"probe": False, "max_empty_pages": 2})
+
+    async def fetch_page(page_num):
+        return [page_num] if page_num <= 5 else []
+
+    pages = paginate(spider, fetch_page, 1)
+    assert sorted(pages)[:5] == [1, 2, 3, 4, 5]
+
+
+def test_reads_the_total_from_the_first_page(make_spider):
+    spider = make_spider()
+
+    async def fetch_page(page_num):
+        return {"total": 3, "items": [page_num]}
+
+    assert sorted(paginate(spider, fetch_page, 1, get_total=lambda page: page["total"])) == [1, 2, 3]
+
+
+def test_probes_the_last_page(make_spider):
+    spider = make_spider()
+
+    async def fetch_page(page_num):
+        return [page_num] if page_num <= 37 else []
+
+    assert sorted(paginate(spider, fetch_page, 1)) == list(range(1, 38))
+
+
+def test_known_page_waits_for_earlier_pages(make_spider):
+    # pages 4 and up were crawled before, slower pages 2 and 3 are new
+    spider = make_spider(pagination={"probe": False})
+    known = {page_num for page_num in range(4, 21)}
+
+    async def fetch_page(page_num):
+        await asyncio.sleep({2: 0.1, 3: 0.2}.get(page_num, 0.0))
+        return [page_num] if page_num <= 20 else []
+
+    def is_known(page):
+        return all(page_num in known for page_num in page)
+
+    pages = paginate(spider, fetch_page, 1, 30, is_known=is_known)
+    assert {1, 2, 3} <= set(pages)
+
+
+def test_known_first_page_stops(make_spider):
+    spider = make_spider()
+    fetched = []
+
+    async def fetch_page(page_num):
+        fetched.append(page_num)
+        return [page_num]
+
+    assert paginate(spider, fetch_page, 1, 10, is_known=lambda page: True) == [1]
+    assert fetched == [1]
+
+
+def test_failed_pages_are_retried_then_skipped(make_spider):
+    spider = make_spider(pagination={"probe": False, "page_attempts": 2})
+    attempts = {}
+
+    async def fetch_page(page_num):
+        attempts[page_num] = attempts.get(page_num, 0) + 1
+        if page_num == 3:
+            return None
+        return [page_num]
+
+    pages = paginate(spider, fetch_page, 1, 5)
+    assert sorted(pages) == [1, 2, 4, 5]
+    assert attempts[3] == 2
+
+
+def test_failed_pages_do_not_end_the_list(make_spider):
+    # failures between empty pages break neither the list nor the empty run
+    spider = make_spider(pagination={"probe": False, "page_attempts": 1, "max_empty_pages": 2})
+
+    async def fetch_page(page_num):
+        if page_num in (2, 3):
+            return None
+        return [page_num] if page_num <= 4 else []
+
+    assert {1, 4} <= set(paginate(spider, fetch_page, 1))
+
+
+def test_failed_first_page_raises(make_spider):
+    spider = make_spider(pagination={"page_attempts": 1})
+
+    async def fetch_page(page_num):
+        return None
+
+    with pytest.raises(RuntimeError):
+        paginate(spider, fetch_page, 1)
@@ -0,0 +1,88 @@
+import asyncio
+
+from tspider.db.queue import MemoryQueue, create_queue
+
+
+def run(coro):
+    return asyncio.run(coro)
+
+
+def test_claim_and_ack():
+    queue = MemoryQueue("test")
+
+    async def main():
+        assert await queue.push([("a", {"n": 1}), ("b", {"n": 2}), ("a", {"n": 1})]) == 2
+        assert await queue.claim() == ("a", {"n": 1})
+        assert await queue.claim() == ("b", {"n": 2})
+        assert await queue.claim() is None
+        await queue.ack("a")
+        await queue.ack("b")
+        await queue.finish_producing()
+        assert await queue.is_finished()
+        # seen keys are not queued again
+        assert await queue.push([("a", {"n": 1})]) == 0
+        return await queue.stats()
+
+    assert run(main()) == {"pending": 0, "processing": 0, "failed": 0, "done": 2}
+
+
+def test_nack_retries_until_max_attempts():
+    queue = MemoryQueue("test", max_attempts=2)
+
+    async def main():
+        await queue.push([("a", 1)])
+        await queue.claim()
+        await queue.nack("a")
+        assert await queue.claim() == ("a", 1)
+        await queue.nack("a")
+        assert await queue.claim() is None
+        return await queue.stats()
+
+    assert run(main())["failed"] == 1
+
+
+def test_visibility_timeout_hands_items_out_again():
+    queue = MemoryQueue("test", visibility_timeout=0.05)
+
+    async def main():
+        await queue.push([("a", 1)])
+        assert await queue.claim() == ("a", 1)
+        assert await queue.claim() is None
+        await asyncio.sleep(0.1)
+        return await queue.claim()
+
+    assert run(main()) == ("a", 1)
+
+
+def test_touch_extends_the_claim():
+    queue = MemoryQueue("test", visibility_timeout=0.1)
+
+    async def main():
+        await queue.push([("a", 1)])
+        await queue.claim()
+        for _ in range(3):
+            await asyncio.sleep(0.05)
+            await queue.touch("a")
+        return await queue.claim()
+
+    assert run(main()) is None
+
+
+def test_release_does_not_count_an_attempt():
+    queue = MemoryQueue("test", max_attempts=1)
+
+    async def main():
+        await queue.push([("a", 1), ("b", 2)])
+        await queue.claim()
+        await queue.release("a")
+        # released items are claimed next
+        return await queue.claim(), await queue.stats()
+
+    claimed, stats = run(main())
+    assert claimed == ("a", 1)
+    assert stats["failed"] == 0
+
+
+def test_memory_queues_are_shared_by_name():
+    assert create_queue("memory", "shared-test") is create_queue("memory", "shared-test")
+    assert create_queue("memory", "shared-test") is not create_queue("memory", "other-test")
@@ -0,0 +1,69 @@
+import json
+import asyncio
+
+import aiohttp
+import pytest
+from yarl import URL
+
+from tspider.http.retry import RetryAction, RetryBudget, RetryPolicy
+
+
+REQUEST_INFO = aiohttp.RequestInfo(URL("http://example.com"), "GET", {}, URL("http://example.com"))
+
+
+def response_error(status: int, headers=None) -> aiohttp.ClientResponseError:
+    return aiohttp.ClientResponseError(REQUEST_INFO, (), status=status, headers=headers)
+
+
+@pytest.mark.parametrize("err, action", [
+    (aiohttp.ClientProxyConnectionError(None, OSError()), RetryAction.ROTATE_PROXY),
+    (aiohttp.ContentTypeError(REQUEST_INFO, (), status=200), RetryAction.ROTATE_PROXY),
+    (json.JSONDecodeError("Expecting value", "<html>", 0), RetryAction.ROTATE_PROXY),
+    (aiohttp.ServerDisconnectedError(), RetryAction.BACKOFF),
+    (aiohttp.ClientPayloadError(), RetryAction.BACKOFF),
+    (asyncio.TimeoutError(), RetryAction.BACKOFF),
+    (response_error(503), RetryAction.BACKOFF),
+    (response_error(429), RetryAction.BACKOFF),
+    (response_error(404), RetryAction.GIVE_UP),
+    (KeyError("announcements"), None),
+])
+def test_classify(err, action):
+    assert RetryPolicy().classify(err) is action
+
+
+def test_retry_after_sets_the_delay():
+    policy = RetryPolicy(base_delay=100.0, max_delay=30.0)
+    assert policy.get_delay(0, response_error(503, {"Retry-After": "2"})) == 2.0
+    assert policy.get_delay(0, response_error(503, {"Retry-After": "120"})) == 30.0
+
+
+def test_run_returns_default_once_attempts_are_used_up():
+    policy = RetryPolicy(max_attempts=3, base_delay=0.0)
+    calls = []
+
+    async def func(proxy):
+        calls.append(proxy)
+        raise aiohttp.ServerDisconnectedError()
+
+    assert asyncio.run(policy.run(func, default="failed")) == "failed"
+    assert len(calls) == 3
+
+
+def test_run_reraises_unknown_errors():
+    async def func(proxy):
+        raise KeyError("announcements")
+
+    with pytest.raises(KeyError):
+        asyncio.run(RetryPolicy(base_delay=0.0).run(func))
+
+
+def test_budget_stops_retries():
+    policy = RetryPolicy(max_attempts=5, base_delay=0.0, budget=RetryBudget(ratio=0.0, min_retries=1))
+    calls = []
+
+    async def func(proxy):
+        calls.append(proxy)
+        raise asyncio.TimeoutError()
+
+    asyncio.run(policy.run(func))
+    assert len(calls) == 2
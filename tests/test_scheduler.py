@@ -0,0 +1,55 @@
+import time
+import asyncio
+
+import pytest
+
+from tspider.spiders.scheduler import PriorityQueue, Scheduler
+
+
+def drain(queue: PriorityQueue) -> list:
+    return [queue.get_nowait() for _ in range(queue.qsize())]
+
+
+def test_priority_queue_orders_by_score():
+    queue = PriorityQueue(priority_func=lambda item: item["score"])
+    for score in [3, 1, 2, 1]:
+        queue.put_nowait({"score": score})
+    assert [item["score"] for item in drain(queue)] == [1, 1, 2, 3]
+
+
+def test_host_penalty_spreads_hosts():
+    queue = PriorityQueue(priority_func=lambda item: 0.0, host_penalty=1.0)
+    for url in ["http://a/1", "http://b/1", "http://a/2", "http://a/3", "http://c/1"]:
+        queue.put_nowait(url)
+    assert drain(queue) == ["http://a/1", "http://b/1", "http://c/1", "http://a/2", "http://a/3"]
+
+
+@pytest.mark.parametrize("items", [
+    ["http://a/1", "http://a/2", "http://a/3"],
+    [{"key": 1}, {"key": 2}, {"key": 3}],
+])
+def test_host_penalty_keeps_order_of_a_single_or_no_host(items):
+    queue = PriorityQueue(priority_func=lambda item: 0.0 if item in items[:2] else -0.5, host_penalty=1.0)
+    for item in items:
+        queue.put_nowait(item)
+    # the penalty would push item 3 behind the others by more than its lead
+    assert drain(queue) == [items[2], *items[:2]]
+
+
+def test_full_domain_does_not_hold_other_domains():
+    scheduler = Scheduler(concurrency=4, per_domain_concurrency=1)
+    items = [f"http://slow/{i}" for i in range(4)] + [f"http://fast/{i}" for i in range(4)]
+
+    async def worker(item):
+        await asyncio.sleep(0.1 if "slow" in item else 0.01)
+        return time.monotonic()
+
+    async def main():
+        start = time.monotonic()
+        return {item: finished - start async for item, finished in scheduler.run(items, worker)}
+
+    finished = asyncio.run(main())
+    assert sorted(finished) == sorted(items)
+    # the slow domain runs one at a time, the fast one in between
+    assert max(finished[f"http://fast/{i}"] for i in range(4)) < 0.15
+    assert scheduler.queued == 0
@@ -0,0 +1,33 @@
+"""Run spiders side by side on one event loop.
+
+    python -m tspider examples/hebeieb/config.yaml examples/cninfo_fund_contract/config.yaml
+
+Each config names its spider class with `spider: module.SpiderClass`,
+imported from the config's directory.
+"""
+import sys
+import argparse
+
+from tspider.spiders.runner import SpiderRunner
+
+
+def main():
+    parser = argparse.ArgumentParser(prog='tspider', description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('configs', nargs='+', help="spider config files")
+    parser.add_argument('--role', choices=['coordinator', 'worker'], help="distributed role of every spider")
+    parser.add_argument('--limit', type=int, default=100, help="connections of the shared pool")
+    parser.add_argument('--limit-per-host', type=int, default=10)
+    parser.add_argument('--mongo-max-workers', type=int, default=4, help="threads of the shared mongo writers")
+    args = parser.parse_args()
+
+    runner = SpiderRunner(
+        args.configs,
+        session={"limit": args.limit, "limit_per_host": args.limit_per_host},
+        mongo_max_workers=args.mongo_max_workers
+    )
+    if not runner.start(args.role):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,118 @@
+import json
+import time
+import sqlite3
+from pathlib import Path
+from typing import Dict, Iterator, Optional, Tuple, Union
+
+
+class FrontierState:
+    DISCOVERED = "discovered"
+    IN_FLIGHT = "in_flight"
+    DONE = "done"
+    FAILED = "failed"
+
+
+class SQLiteFrontier:
+    # durable record of every discovered item and how far it got, so a
+    # restarted crawl only picks up what is not done yet, lowest priority first
+    def __init__(self, path: Union[str, Path], max_attempts: int = 3, batch_size: int = 1000, retry_penalty: float = 0.0):
+        self.path = Path(path)
+        self.max_attempts = max_attempts
+        self.batch_size = batch_size
+        # added to the priority of an item on every failure
+        self.retry_penalty = retry_penalty
+
+        self.conn = sqlite3.connect(str(self.path), isolation_level=None)
+        # WAL with synchronous=NORMAL only syncs on checkpoints, keeping updates cheap
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS frontier ("
+            " key TEXT PRIMARY KEY,"
+            " item TEXT NOT NULL,"
+            " state TEXT NOT NULL,"
+            " attempts INTEGER NOT NULL DEFAULT 0,"
+            " updated_time REAL NOT NULL,"
+            " priority REAL NOT NULL DEFAULT 0,"
+            " discovered_time REAL"
+            ")"
+        )
+        columns = {row[1] for row in self.conn.execute("PRAGMA table_info(frontier)")}
+        if 'priority' not in columns:
+            # frontiers from before priorities keep their discovery order
+            self.conn.execute("ALTER TABLE frontier ADD COLUMN priority REAL NOT NULL DEFAULT 0")
+        if 'discovered_time' not in columns:
+            # the last update is the closest to discovery older frontiers know
+            self.conn.execute("ALTER TABLE frontier ADD COLUMN discovered_time REAL")
+            self.conn.execute("UPDATE frontier SET discovered_time = updated_time")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS frontier_state ON frontier (state)")
+        # only unfinished items, which stay few while done ones pile up
+        self.conn.execute(
+            "CREATE INDEX IF NOT EXISTS frontier_pending ON frontier (priority)"
+            f" WHERE state != '{FrontierState.DONE}'"
+        )
+
+    def __contains__(self, key: str) -> bool:
+        row = self.conn.execute("SELECT 1 FROM frontier WHERE key = ?", (key,)).fetchone()
+        return row is not None
+
+    def __len__(self) -> int:
+        return self.conn.execute("SELECT COUNT(*) FROM frontier").fetchone()[0]
+
+    def add(self, key: str, item, priority: float = 0.0) -> bool:
+        # values json can't hold, e.g. a datetime publish time, are stored as strings
+        now = time.time()
+        cursor = self.conn.execute(
+            "INSERT OR IGNORE INTO frontier (key, item, state, updated_time, priority, discovered_time) VALUES (?, ?, ?, ?, ?, ?)",
+            (key, json.dumps(item, ensure_ascii=False, default=str), FrontierState.DISCOVERED, now, priority, now)
+        )
+        return cursor.rowcount == 1
+
+    def mark(self, key: str, state: str):
+        failed = state == FrontierState.FAILED
+        self.conn.execute(
+            "UPDATE frontier SET state = ?, attempts = attempts + ?, priority = priority + ?, updated_time = ? WHERE key = ?",
+            (state, int(failed), self.retry_penalty if failed else 0.0, time.time(), key)
+        )
+
+    def get_progress(self, key: str) -> Tuple[int, Optional[float]]:
+        # failed attempts and discovery time, `(0, None)` for unknown keys
+        row = self.conn.execute("SELECT attempts, discovered_time FROM frontier WHERE key = ?", (key,)).fetchone()
+        return (row[0], row[1]) if row is not None else (0, None)
+
+    def iter_pending(self) -> Iterator[object]:
+        # items interrupted while in flight are simply picked up again; items
+        # added or marked since the call are left to the running crawl
+        start_time = time.time()
+        last = (float('-inf'), 0)
+        while True:
+            rows = self.conn.execute(
+                # walks the pending index in order, failures out of attempts are skipped
+                "SELECT priority, rowid, item FROM frontier"
+                f" WHERE state != '{FrontierState.DONE}' AND (priority, rowid) > (?, ?) AND updated_time < ?"
+                " AND NOT (state = ? AND attempts >= ?)"
+                " ORDER BY priority, rowid LIMIT ?",
+                (
+                    *last, start_time,
+                    FrontierState.FAILED, self.max_attempts,
+                    self.batch_size
+                )
+            ).fetchall()
+            if not rows:
+                return
+            for priority, rowid, item in rows:
+                last = (priority, rowid)
+                yield json.loads(item)
+
+    def stats(self) -> Dict[str, int]:
+        rows = self.conn.execute("SELECT state, COUNT(*) FROM frontier GROUP BY state").fetchall()
+        return dict(rows)
+
+    def close(self):
+        self.conn.close()
+
+    def __str__(self) -> str:
+        return f"<SQLiteFrontier: {self.path}>"
+
+    def __repr__(self) -> str:
+        return self.__str__()
@@ -0,0 +1,209 @@
+import copy
+import threading
+import itertools
+from typing import Dict, Iterator, List, Optional
+
+import pymongo
+from pymongo.errors import BulkWriteError, DuplicateKeyError
+
+
+# In-memory stand-in for the subset of the pymongo client API used by tspider,
+# for tests and offline benchmarks. Filters only support top-level equality.
+
+
+def _match(document: dict, filter_condition: Optional[dict]) -> bool:
+    if not filter_condition:
+        return True
+    return all(document.get(key) == value for key, value in filter_condition.items())
+
+
+class MemoryCursor:
+    # iterates the matched documents, `explain` reports the plan a server would pick
+    def __init__(self, documents: List[dict], plan: dict):
+        self._documents = iter(documents)
+        self._plan = plan
+
+    def __iter__(self) -> Iterator[dict]:
+        return self
+
+    def __next__(self) -> dict:
+        return next(self._documents)
+
+    def explain(self) -> dict:
+        return {"queryPlanner": {"winningPlan": self._plan}}
+
+
+class MemoryCollection:
+    def __init__(self, name: str):
+        self.name = name
+        self._documents: Dict[int, dict] = {}
+        self._ids = itertools.count()
+        self._indexes: Dict[str, dict] = {"_id_": {"key": [("_id", 1)], "unique": True}}
+        # unique index name -> index key values -> _id
+        self._unique_keys: Dict[str, Dict[tuple, object]] = {"_id_": {}}
+        self._lock = threading.RLock()
+
+    def create_index(self, keys, unique: bool = False, name: Optional[str] = None, **kwargs) -> str:
+        if isinstance(keys, str):
+            keys = [(keys, pymongo.ASCENDING)]
+        keys = list(keys)
+        if name is None:
+            name = "_".join(f"{field}_{direction}" for field, direction in keys)
+        with self._lock:
+            self._indexes[name] = {"key": keys, "unique": unique}
+            if unique:
+                self._unique_keys[name] = {}
+                for document in self._documents.values():
+                    self._unique_keys[name][self._index_key(name, document)] = document["_id"]
+        return name
+
+    def drop_index(self, name: str):
+        with self._lock:
+            self._indexes.pop(name, None)
+            self._unique_keys.pop(name, None)
+
+    def index_information(self) -> dict:
+        with self._lock:
+            return copy.deepcopy(self._indexes)
+
+    def insert_one(self, document: dict):
+        with self._lock:
+            document.setdefault("_id", next(self._ids))
+            self._check_unique(document)
+            self._documents[document["_id"]] = copy.deepcopy(document)
+            self._add_keys(document)
+
+    def insert_many(self, documents: List[dict], ordered: bool = True):
+        self.bulk_write([pymongo.InsertOne(document) for document in documents], ordered=ordered)
+
+    def update_one(self, filter_condition: dict, update: dict, upsert: bool = False):
+        with self._lock:
+            document = self.find_one(filter_condition)
+            if document is None:
+                if not upsert:
+                    return
+                document = dict(filter_condition)
+                self._apply(document, update.get("$setOnInsert", {}))
+                self._apply(document, update.get("$set", {}))
+                self.insert_one(document)
+                return
+            stored = self._documents[document["_id"]]
+            updated = dict(stored)
+            self._apply(updated, update.get("$set", {}))
+            self._remove_keys(stored)
+            try:
+                self._check_unique(updated)
+            except DuplicateKeyError:
+                self._add_keys(stored)
+                raise
+            self._documents[document["_id"]] = updated
+            self._add_keys(updated)
+
+    def delete_one(self, filter_condition: dict, *args, **kwargs):
+        with self._lock:
+            document = self.find_one(filter_condition)
+            if document is not None:
+                self._remove_keys(self._documents.pop(document["_id"]))
+
+    def find(self, filter_condition: Optional[dict] = None) -> MemoryCursor:
+        with self._lock:
+            # serve equality lookups on uniquely indexed fields without a scan,
+            # like a server text indexes cannot
+            for name, keys in self._unique_keys.items():
+                if self._is_text_index(name):
+                    continue
+                fields = [field for field, _ in self._indexes[name]["key"]]
+                if filter_condition and set(filter_condition) == set(fields):
+                    _id = keys.get(tuple(filter_condition[field] for field in fields))
+                    document = self._documents.get(_id)
+                    plan = {"stage": "FETCH", "inputStage": {"stage": "IXSCAN", "indexName": name}}
+                    return MemoryCursor([copy.deepcopy(document)] if document is not None else [], plan)
+            documents = [copy.deepcopy(doc) for doc in self._documents.values() if _match(doc, filter_condition)]
+        return MemoryCursor(documents, self._get_plan(filter_condition))
+
+    def find_one(self, filter_condition: Optional[dict] = None) -> Optional[dict]:
+        return next(self.find(filter_condition), None)
+
+    def count_documents(self, filter_condition: dict) -> int:
+        return sum(1 for _ in self.find(filter_condition))
+
+    def bulk_write(self, operations: list, ordered: bool = True):
+        write_errors = []
+        for index, operation in enumerate(operations):
+            try:
+                if isinstance(operation, pymongo.InsertOne):
+                    self.insert_one(operation._doc)
+                elif isinstance(operation, pymongo.UpdateOne):
+                    self.update_one(operation._filter, operation._doc, upsert=bool(operation._upsert))
+                elif isinstance(operation, pymongo.DeleteOne):
+                    self.delete_one(operation._filter)
+                else:
+                    raise TypeError(f"Unsupported operation: {operation!r}")
+            except DuplicateKeyError as err:
+                write_errors.append({"index": index, "code": err.code, "errmsg": str(err)})
+                if ordered:
+                    break
+        if write_errors:
+            raise BulkWriteError({"writeErrors": write_errors})
+
+    def _is_text_index(self, name: str) -> bool:
+        return any(direction == pymongo.TEXT for _, direction in self._indexes[name]["key"])
+
+    def _get_plan(self, filter_condition: Optional[dict]) -> dict:
+        # what a server would use: an index on a prefix of the filtered fields
+        for name, index in self._indexes.items():
+            if not self._is_text_index(name) and filter_condition and index["key"][0][0] in filter_condition:
+                return {"stage": "FETCH", "inputStage": {"stage": "IXSCAN", "indexName": name}}
+        return {"stage": "COLLSCAN"}
+
+    def _index_key(self, name: str, document: dict) -> tuple:
+        return tuple(document.get(field) for field, _ in self._indexes[name]["key"])
+
+    def _check_unique(self, document: dict):
+        for name, keys in self._unique_keys.items():
+            key = self._index_key(name, document)
+            if keys.get(key, document["_id"]) != document["_id"]:
+                raise DuplicateKeyError(f"E11000 duplicate key error index: {name} dup key: {key}", 11000)
+
+    def _add_keys(self, document: dict):
+        for name, keys in self._unique_keys.items():
+            keys[self._index_key(name, document)] = document["_id"]
+
+    def _remove_keys(self, document: dict):
+        for name, keys in self._unique_keys.items():
+            keys.pop(self._index_key(name, document), None)
+
+    @staticmethod
+    def _apply(document: dict, values: dict):
+        for key, value in values.items():
+            document[key] = copy.deepcopy(value)
+
+    def __str__(self) -> str:
+        return f"<MemoryCollection: {self.name}>"
+
+    def __repr__(self) -> str:
+        return self.__str__()
+
+
+class MemoryDatabase:
+    def __init__(self, name: str):
+        self.name = name
+        self._collections: Dict[str, MemoryCollection] = {}
+
+    def __getitem__(self, name: str) -> MemoryCollection:
+        if name not in self._collections:
+            self._collections[name] = MemoryCollection(name)
+        return self._collections[name]
+
+
+class MemoryClient:
+    def __init__(self, *args, **kwargs):
+        self._databases: Dict[str, MemoryDatabase] = {}
+
+    def __getitem__(self, name: str) -> MemoryDatabase:
+        if name not in self._databases:
+            self._databases[name] = MemoryDatabase(name)
+        return self._databases[name]
+
+    def close(self):
+        pass
@@ -1,6 +1,30 @@
-from typing import Optional
+import time
+import asyncio
+import functools
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Optional
 
 import pymongo
+from loguru import logger
+
+try:
+    import motor.motor_asyncio
+except ImportError:
+    motor = None
+
+from tspider.db.memory import MemoryClient
+from tspider.utils.tracing import span
+
+
+DUPLICATE_KEY_ERROR = 11000
+
+
+def log_bulk_write_error(err: pymongo.errors.BulkWriteError, collection):
+    # duplicate keys are expected when re-discovering known documents
+    for error in err.details.get('writeErrors', []):
+        if error.get('code') != DUPLICATE_KEY_ERROR:
+            logger.error(f"Bulk write error in {collection}: {error.get('errmsg')}")
 
 
 class MongoDBCollection:
@@ -8,7 +32,10 @@ class MongoDBCollection:
         self, host: str, port: int,
         db: str, collection: str,
         username: Optional[str] = None,
-        password: Optional[str] = None
+        password: Optional[str] = None,
+        buffer_size: int = 0,
+        flush_interval: float = 1.0,
+        client=None
     ):
         self.host = host
         self.port = port
@@ -17,7 +44,10 @@ class MongoDBCollection:
         self.username = username
         self.password = password
 
-        self.client = pymongo.MongoClient(
+        # any client with the pymongo API, e.g. `MemoryClient` or mongomock,
+        # closed by whoever passed it in
+        self._own_client = client is None
+        self.client = client or pymongo.MongoClient(
             host, port,
             username=username,
             password=password
@@ -25,20 +55,450 @@ class MongoDBCollection:
         self.db = self.client[db]
         self.collection = self.db[collection]
 
+        # write-behind buffer, disabled when `buffer_size` is 0
+        self.buffer_size = buffer_size
+        self.flush_interval = flush_interval
+        self._inserts: List[pymongo.InsertOne] = []
+        self._updates: List[pymongo.UpdateOne] = []
+        self._last_flush = time.monotonic()
+        self._lock = threading.Lock()
+        # held for the whole write, so batches reach the server in order
+        self._flush_lock = threading.Lock()
+        # a metrics `Histogram` observing every write round trip when set
+        self.write_latency = None
+        # a `QueryPlanChecker` explaining the filters of updates when set
+        self.plan_checker = None
+
     def insert_one(self, data: dict):
+        if self.buffer_size > 0:
+            self._buffer(self._inserts, pymongo.InsertOne(data))
+            return
+        start_time = time.monotonic()
         try:
             self.collection.insert_one(data)
         except pymongo.errors.DuplicateKeyError:
             pass
+        self._observe('insert_one', start_time)
 
     def update_one(self, filter_condition: dict, new_data: dict):
+        self._check_plan(filter_condition)
+        if self.buffer_size > 0:
+            self._buffer(self._updates, pymongo.UpdateOne(filter_condition, new_data))
+            return
+        start_time = time.monotonic()
         self.collection.update_one(filter_condition, new_data)
+        self._observe('update_one', start_time)
+
+    def delete_one(self, filter_condition: dict, data: Optional[dict] = None):
+        self._check_plan(filter_condition)
+        self.collection.delete_one(filter_condition)
+
+    def insert_many(self, data: List[dict]):
+        self._bulk_write([pymongo.InsertOne(ins) for ins in data])
+
+    def bulk_write(self, operations: list):
+        self._bulk_write(operations)
+
+    def create_index(self, *args, **kwargs):
+        return self.collection.create_index(*args, **kwargs)
+
+    def drop_index(self, name: str):
+        self.collection.drop_index(name)
+
+    def index_information(self) -> dict:
+        return self.collection.index_information()
 
-    def delete_one(self, filter_condition: dict, data: dict):
-        self.collection.delete_one(filter_condition, data)
+    def flush(self):
+        with self._flush_lock:
+            with self._lock:
+                inserts, self._inserts = self._inserts, []
+                updates, self._updates = self._updates, []
+                self._last_flush = time.monotonic()
+            try:
+                # unordered batches may run in any order, so inserts go first
+                # to keep updates from racing the documents they target
+                self._bulk_write(inserts)
+                inserts = []
+                self._bulk_write(updates)
+            except Exception as err:
+                self._requeue(inserts, updates, err)
+                raise
+
+    def close(self):
+        self.flush()
+        if self._own_client:
+            self.client.close()
+
+    def _buffer(self, buffer: list, operation):
+        with self._lock:
+            buffer.append(operation)
+            full = (
+                len(self._inserts) + len(self._updates) >= self.buffer_size
+                or time.monotonic() - self._last_flush >= self.flush_interval
+            )
+        if full:
+            self.flush()
+
+    def _requeue(self, inserts: list, updates: list, err: Exception):
+        # replaying a partly written batch is harmless: inserts that made it
+        # come back as duplicate keys and updates set the same values again
+        logger.error(f"Flushing {len(inserts) + len(updates)} operations to {self} failed, kept for the next flush: {err}")
+        with self._lock:
+            self._inserts[:0] = inserts
+            self._updates[:0] = updates
+
+    def _bulk_write(self, operations: list):
+        if not operations:
+            return
+        start_time = time.monotonic()
+        try:
+            self.collection.bulk_write(operations, ordered=False)
+        except pymongo.errors.BulkWriteError as err:
+            log_bulk_write_error(err, self)
+        self._observe('bulk_write', start_time)
+
+    def _observe(self, operation: str, start_time: float):
+        if self.write_latency is not None:
+            self.write_latency.observe(time.monotonic() - start_time, operation)
+
+    def _check_plan(self, filter_condition: dict):
+        if self.plan_checker is not None and self.plan_checker.is_new(filter_condition):
+            self.plan_checker.check(self, filter_condition, self.collection.find(filter_condition).explain())
 
     def __str__(self) -> str:
         return f"<MongoDB: {self.db_name}/{self.collection_name}>"
 
     def __repr__(self) -> str:
         return self.__str__()
+
+
+class AsyncMongoDBCollection:
+    """`MongoDBCollection` with coroutine methods, run on a thread pool so
+    blocking pymongo calls never stall the event loop.
+
+    With `max_workers=0` calls run inline, which is meant for in-memory clients.
+    A given `executor` is shared and left running on close.
+    """
+
+    def __init__(self, collection: MongoDBCollection, max_workers: int = 4, executor: Optional[ThreadPoolExecutor] = None):
+        self.sync_collection = collection
+        self.collection = collection.collection
+        self.flush_interval = collection.flush_interval
+        self._own_executor = executor is None
+        if executor is None and max_workers > 0:
+            executor = ThreadPoolExecutor(max_workers, thread_name_prefix="mongo")
+        self._executor = executor
+        self._flush_task: Optional[asyncio.Task] = None
+
+    @property
+    def write_latency(self):
+        return self.sync_collection.write_latency
+
+    @write_latency.setter
+    def write_latency(self, histogram):
+        self.sync_collection.write_latency = histogram
+
+    @property
+    def plan_checker(self):
+        return self.sync_collection.plan_checker
+
+    @plan_checker.setter
+    def plan_checker(self, checker):
+        self.sync_collection.plan_checker = checker
+
+    async def insert_one(self, data: dict):
+        await self._run(self.sync_collection.insert_one, data)
+
+    async def update_one(self, filter_condition: dict, new_data: dict):
+        await self._run(self.sync_collection.update_one, filter_condition, new_data)
+
+    async def delete_one(self, filter_condition: dict, data: Optional[dict] = None):
+        await self._run(self.sync_collection.delete_one, filter_condition)
+
+    async def insert_many(self, data: List[dict]):
+        await self._run(self.sync_collection.insert_many, data)
+
+    async def bulk_write(self, operations: list):
+        await self._run(self.sync_collection.bulk_write, operations)
+
+    async def create_index(self, *args, **kwargs):
+        return await self._run(self.sync_collection.create_index, *args, **kwargs)
+
+    async def drop_index(self, name: str):
+        await self._run(self.sync_collection.drop_index, name)
+
+    async def index_information(self) -> dict:
+        return await self._run(self.sync_collection.index_information)
+
+    async def flush(self):
+        await self._run(self.sync_collection.flush)
+
+    async def close(self):
+        if self._flush_task is not None:
+            self._flush_task.cancel()
+            await asyncio.gather(self._flush_task, return_exceptions=True)
+            self._flush_task = None
+        await self._offload(self.sync_collection.close)
+        if self._executor is not None and self._own_executor:
+            self._executor.shutdown(wait=True)
+
+    async def _run(self, func, *args, **kwargs):
+        if self.sync_collection.buffer_size > 0 and self._flush_task is None:
+            # flush half-filled buffers once the interval passes without new writes
+            self._flush_task = asyncio.ensure_future(self._flush_loop())
+        with span(f"db.{func.__name__}"):
+            return await self._offload(func, *args, **kwargs)
+
+    async def _offload(self, func, *args, **kwargs):
+        if self._executor is None:
+            return func(*args, **kwargs)
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(self._executor, functools.partial(func, *args, **kwargs))
+
+    async def _flush_loop(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self._offload(self.sync_collection.flush)
+            except Exception as err:
+                # the batch is kept, a dead loop would leave it unflushed
+                logger.error(f"Flush of {self} failed: {err}")
+
+    def __str__(self) -> str:
+        return f"<AsyncMongoDB: {self.sync_collection.db_name}/{self.sync_collection.collection_name}>"
+
+    def __repr__(self) -> str:
+        return self.__str__()
+
+
+class MotorMongoDBCollection:
+    def __init__(
+        self, host: str, port: int,
+        db: str, collection: str,
+        username: Optional[str] = None,
+        password: Optional[str] = None,
+        buffer_size: int = 0,
+        flush_interval: float = 1.0,
+        client=None
+    ):
+        if motor is None:
+            raise ImportError("mongo_backend 'motor' requires the motor package")
+        self.db_name = db
+        self.collection_name = collection
+        self._own_client = client is None
+        self.client = client or motor.motor_asyncio.AsyncIOMotorClient(
+            host, port,
+            username=username,
+            password=password
+        )
+        self.db = self.client[db]
+        self.collection = self.db[collection]
+
+        self.buffer_size = buffer_size
+        self.flush_interval = flush_interval
+        self._inserts: List[pymongo.InsertOne] = []
+        self._updates: List[pymongo.UpdateOne] = []
+        self._flush_task: Optional[asyncio.Task] = None
+        self._flush_lock = asyncio.Lock()
+        self.write_latency = None
+        self.plan_checker = None
+
+    async def insert_one(self, data: dict):
+        with span('db.insert_one'):
+            if self.buffer_size > 0:
+                await self._buffer(self._inserts, pymongo.InsertOne(data))
+                return
+            start_time = time.monotonic()
+            try:
+                await self.collection.insert_one(data)
+            except pymongo.errors.DuplicateKeyError:
+                pass
+            self._observe('insert_one', start_time)
+
+    async def update_one(self, filter_condition: dict, new_data: dict):
+        with span('db.update_one'):
+            await self._check_plan(filter_condition)
+            if self.buffer_size > 0:
+                await self._buffer(self._updates, pymongo.UpdateOne(filter_condition, new_data))
+                return
+            start_time = time.monotonic()
+            await self.collection.update_one(filter_condition, new_data)
+            self._observe('update_one', start_time)
+
+    async def delete_one(self, filter_condition: dict, data: Optional[dict] = None):
+        with span('db.delete_one'):
+            await self._check_plan(filter_condition)
+            await self.collection.delete_one(filter_condition)
+
+    async def insert_many(self, data: List[dict]):
+        await self._bulk_write([pymongo.InsertOne(ins) for ins in data])
+
+    async def bulk_write(self, operations: list):
+        await self._bulk_write(operations)
+
+    async def create_index(self, *args, **kwargs):
+        return await self.collection.create_index(*args, **kwargs)
+
+    async def drop_index(self, name: str):
+        await self.collection.drop_index(name)
+
+    async def index_information(self) -> dict:
+        return await self.collection.index_information()
+
+    async def flush(self):
+        async with self._flush_lock:
+            inserts, self._inserts = self._inserts, []
+            updates, self._updates = self._updates, []
+            try:
+                await self._bulk_write(inserts)
+                inserts = []
+                await self._bulk_write(updates)
+            except BaseException as err:
+                # see `MongoDBCollection._requeue`, a flush loop cancelled by
+                # `close` leaves its batch to the final flush
+                if not isinstance(err, asyncio.CancelledError):
+                    logger.error(f"Flushing {len(inserts) + len(updates)} operations to {self} failed, kept for the next flush: {err}")
+                self._inserts[:0] = inserts
+                self._updates[:0] = updates
+                raise
+
+    async def close(self):
+        if self._flush_task is not None:
+            self._flush_task.cancel()
+            await asyncio.gather(self._flush_task, return_exceptions=True)
+            self._flush_task = None
+        await self.flush()
+        if self._own_client:
+            self.client.close()
+
+    async def _buffer(self, buffer: list, operation):
+        if self._flush_task is None:
+            self._flush_task = asyncio.ensure_future(self._flush_loop())
+        buffer.append(operation)
+        if len(self._inserts) + len(self._updates) >= self.buffer_size:
+            await self.flush()
+
+    async def _flush_loop(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush()
+            except Exception as err:
+                logger.error(f"Flush of {self} failed: {err}")
+
+    async def _bulk_write(self, operations: list):
+        if not operations:
+            return
+        start_time = time.monotonic()
+        try:
+            await self.collection.bulk_write(operations, ordered=False)
+        except pymongo.errors.BulkWriteError as err:
+            log_bulk_write_error(err, self)
+        self._observe('bulk_write', start_time)
+
+    def _observe(self, operation: str, start_time: float):
+        if self.write_latency is not None:
+            self.write_latency.observe(time.monotonic() - start_time, operation)
+
+    async def _check_plan(self, filter_condition: dict):
+        if self.plan_checker is not None and self.plan_checker.is_new(filter_condition):
+            self.plan_checker.check(self, filter_condition, await self.collection.find(filter_condition).explain())
+
+    def __str__(self) -> str:
+        return f"<MotorMongoDB: {self.db_name}/{self.collection_name}>"
+
+    def __repr__(self) -> str:
+        return self.__str__()
+
+
+class MongoClientPool:
+    """Clients, one per backend and server, and the thread pool shared by
+    the collections of several spiders running on one loop."""
+
+    def __init__(self, max_workers: int = 4):
+        self.max_workers = max_workers
+        self._clients = {}
+        self._executor: Optional[ThreadPoolExecutor] = None
+
+    def get_client(self, backend: str, host: str, port: int, username: Optional[str] = None, password: Optional[str] = None):
+        key = (backend, host, port, username)
+        if key not in self._clients:
+            if backend == "motor":
+                if motor is None:
+                    raise ImportError("mongo_backend 'motor' requires the motor package")
+                client = motor.motor_asyncio.AsyncIOMotorClient(host, port, username=username, password=password)
+            elif backend == "thread":
+                client = pymongo.MongoClient(host, port, username=username, password=password)
+            elif backend == "memory":
+                client = MemoryClient()
+            else:
+                raise ValueError(f"Unknown mongo backend: {backend}")
+            self._clients[key] = client
+        return self._clients[key]
+
+    @property
+    def executor(self) -> Optional[ThreadPoolExecutor]:
+        if self._executor is None and self.max_workers > 0:
+            self._executor = ThreadPoolExecutor(self.max_workers, thread_name_prefix="mongo")
+        return self._executor
+
+    def close(self):
+        # after the collections, which flush on close
+        for client in self._clients.values():
+            client.close()
+        self._clients.clear()
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+
+    def __str__(self) -> str:
+        return f"<MongoClientPool: {len(self._clients)} clients, max_workers={self.max_workers}>"
+
+    def __repr__(self) -> str:
+        return self.__str__()
+
+
+def create_async_collection(
+    backend: str,
+    host: str, port: int,
+    db: str, collection: str,
+    username: Optional[str] = None,
+    password: Optional[str] = None,
+    buffer_size: int = 0,
+    flush_interval: float = 1.0,
+    max_workers: int = 4,
+    pool: Optional[MongoClientPool] = None,
+):
+    """Build the async collection for `backend`: "thread" (pymongo on a
+    thread pool), "motor" or "memory" (in-process stand-in).
+
+    With a `pool`, the client and the thread pool come from it and are
+    left open when the collection closes.
+    """
+    client = pool.get_client(backend, host, port, username, password) if pool is not None else None
+    if backend == "motor":
+        return MotorMongoDBCollection(
+            host, port, db, collection, username, password,
+            buffer_size=buffer_size, flush_interval=flush_interval,
+            client=client
+        )
+    if backend == "thread":
+        return AsyncMongoDBCollection(
+            MongoDBCollection(
+                host, port, db, collection, username, password,
+                buffer_size=buffer_size, flush_interval=flush_interval,
+                client=client
+            ),
+            max_workers=max_workers,
+            executor=pool.executor if pool is not None else None
+        )
+    if backend == "memory":
+        return AsyncMongoDBCollection(
+            MongoDBCollection(
+                host, port, db, collection, username, password,
+                buffer_size=buffer_size, flush_interval=flush_interval,
+                client=client or MemoryClient()
+            ),
+            max_workers=0
+        )
+    raise ValueError(f"Unknown mongo backend: {backend}")
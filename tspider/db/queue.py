@@ -0,0 +1,334 @@
+import json
+import time
+import collections
+from typing import Dict, Iterable, Optional, Set, Tuple
+
+try:
+    import redis.asyncio
+except ImportError:
+    redis = None
+
+
+# Reliable work queue shared by a coordinator and any number of workers.
+# A claimed item is invisible to other workers until it is acked, or until
+# its visibility timeout expires and it goes back to the queue. Items that
+# were nacked or timed out `max_attempts` times end up in the failed set.
+
+# KEYS: seen, items, pending  ARGV: key1, payload1, key2, payload2, ...
+PUSH_SCRIPT = """
+local pushed = 0
+for i = 1, #ARGV, 2 do
+    if redis.call('SADD', KEYS[1], ARGV[i]) == 1 then
+        redis.call('HSET', KEYS[2], ARGV[i], ARGV[i + 1])
+        redis.call('LPUSH', KEYS[3], ARGV[i])
+        pushed = pushed + 1
+    end
+end
+return pushed
+"""
+
+# KEYS: pending, processing, items, attempts, failed  ARGV: visibility_timeout, max_attempts
+CLAIM_SCRIPT = """
+local time = redis.call('TIME')
+local now = tonumber(time[1]) + tonumber(time[2]) / 1000000
+local expired = redis.call('ZRANGEBYSCORE', KEYS[2], '-inf', now, 'LIMIT', 0, 100)
+for _, key in ipairs(expired) do
+    redis.call('ZREM', KEYS[2], key)
+    if redis.call('HINCRBY', KEYS[4], key, 1) >= tonumber(ARGV[2]) then
+        redis.call('SADD', KEYS[5], key)
+    else
+        redis.call('LPUSH', KEYS[1], key)
+    end
+end
+local key = redis.call('RPOP', KEYS[1])
+if not key then
+    return nil
+end
+redis.call('ZADD', KEYS[2], now + tonumber(ARGV[1]), key)
+return {key, redis.call('HGET', KEYS[3], key)}
+"""
+
+# KEYS: processing, pending, items, attempts, done  ARGV: key
+ACK_SCRIPT = """
+if redis.call('ZREM', KEYS[1], ARGV[1]) == 0 then
+    -- timed out meanwhile and maybe queued again
+    redis.call('LREM', KEYS[2], 0, ARGV[1])
+end
+redis.call('HDEL', KEYS[3], ARGV[1])
+redis.call('HDEL', KEYS[4], ARGV[1])
+return redis.call('INCR', KEYS[5])
+"""
+
+# KEYS: processing, pending, attempts, failed  ARGV: key, max_attempts
+NACK_SCRIPT = """
+if redis.call('ZREM', KEYS[1], ARGV[1]) == 0 then
+    return 0
+end
+local attempts = redis.call('HINCRBY', KEYS[3], ARGV[1], 1)
+if attempts >= tonumber(ARGV[2]) then
+    redis.call('SADD', KEYS[4], ARGV[1])
+else
+    redis.call('LPUSH', KEYS[2], ARGV[1])
+end
+return attempts
+"""
+
+# KEYS: processing, pending  ARGV: key
+RELEASE_SCRIPT = """
+if redis.call('ZREM', KEYS[1], ARGV[1]) == 0 then
+    return 0
+end
+-- claimed next, it never got its attempt
+return redis.call('RPUSH', KEYS[2], ARGV[1])
+"""
+
+# KEYS: processing  ARGV: key, visibility_timeout
+TOUCH_SCRIPT = """
+if not redis.call('ZSCORE', KEYS[1], ARGV[1]) then
+    return 0
+end
+local time = redis.call('TIME')
+local now = tonumber(time[1]) + tonumber(time[2]) / 1000000
+return redis.call('ZADD', KEYS[1], 'XX', 'CH', now + tonumber(ARGV[2]), ARGV[1])
+"""
+
+
+class RedisQueue:
+    def __init__(
+        self,
+        name: str,
+        url: str = "redis://localhost:26887/0",
+        visibility_timeout: float = 300.0,
+        max_attempts: int = 3,
+        poll_interval: float = 1.0,
+        batch_size: int = 100,
+    ):
+        if redis is None:
+            raise ImportError("queue backend 'redis' requires the redis package")
+        self.name = name
+        self.url = url
+        self.visibility_timeout = visibility_timeout
+        self.max_attempts = max_attempts
+        self.poll_interval = poll_interval
+        self.batch_size = batch_size
+
+        self.client = redis.asyncio.from_url(url, decode_responses=True)
+        prefix = f"tspider:{name}"
+        self.seen_key = f"{prefix}:seen"
+        self.items_key = f"{prefix}:items"
+        self.pending_key = f"{prefix}:pending"
+        self.processing_key = f"{prefix}:processing"
+        self.attempts_key = f"{prefix}:attempts"
+        self.failed_key = f"{prefix}:failed"
+        self.done_key = f"{prefix}:done"
+        self.producer_done_key = f"{prefix}:producer_done"
+        self.stop_key = f"{prefix}:stop"
+
+        self._push = self.client.register_script(PUSH_SCRIPT)
+        self._claim = self.client.register_script(CLAIM_SCRIPT)
+        self._ack = self.client.register_script(ACK_SCRIPT)
+        self._nack = self.client.register_script(NACK_SCRIPT)
+        self._release = self.client.register_script(RELEASE_SCRIPT)
+        self._touch = self.client.register_script(TOUCH_SCRIPT)
+
+    async def push(self, items: Iterable[Tuple[str, object]]) -> int:
+        # keys already seen by any coordinator are dropped
+        args = []
+        for key, item in items:
+            args.extend((key, json.dumps(item, ensure_ascii=False)))
+        if not args:
+            return 0
+        return await self._push(keys=[self.seen_key, self.items_key, self.pending_key], args=args)
+
+    async def claim(self) -> Optional[Tuple[str, object]]:
+        claimed = await self._claim(
+            keys=[self.pending_key, self.processing_key, self.items_key, self.attempts_key, self.failed_key],
+            args=[self.visibility_timeout, self.max_attempts]
+        )
+        if claimed is None:
+            return None
+        key, payload = claimed
+        return key, json.loads(payload)
+
+    async def ack(self, key: str):
+        await self._ack(
+            keys=[self.processing_key, self.pending_key, self.items_key, self.attempts_key, self.done_key],
+            args=[key]
+        )
+
+    async def nack(self, key: str):
+        await self._nack(
+            keys=[self.processing_key, self.pending_key, self.attempts_key, self.failed_key],
+            args=[key, self.max_attempts]
+        )
+
+    async def release(self, key: str):
+        # gives a claimed item back without counting an attempt
+        await self._release(keys=[self.processing_key, self.pending_key], args=[key])
+
+    async def touch(self, key: str):
+        await self._touch(keys=[self.processing_key], args=[key, self.visibility_timeout])
+
+    async def start_producing(self):
+        await self.client.delete(self.producer_done_key, self.stop_key)
+
+    async def finish_producing(self):
+        await self.client.set(self.producer_done_key, 1)
+
+    async def is_finished(self) -> bool:
+        async with self.client.pipeline(transaction=True) as pipe:
+            pipe.exists(self.producer_done_key)
+            pipe.llen(self.pending_key)
+            pipe.zcard(self.processing_key)
+            producer_done, pending, processing = await pipe.execute()
+        return bool(producer_done) and pending == 0 and processing == 0
+
+    async def stop(self):
+        await self.client.set(self.stop_key, 1)
+
+    async def is_stopped(self) -> bool:
+        return bool(await self.client.exists(self.stop_key))
+
+    async def stats(self) -> Dict[str, int]:
+        async with self.client.pipeline(transaction=True) as pipe:
+            pipe.llen(self.pending_key)
+            pipe.zcard(self.processing_key)
+            pipe.scard(self.failed_key)
+            pipe.get(self.done_key)
+            pending, processing, failed, done = await pipe.execute()
+        return {"pending": pending, "processing": processing, "failed": failed, "done": int(done or 0)}
+
+    async def close(self):
+        await self.client.aclose()
+
+    def __str__(self) -> str:
+        return f"<RedisQueue: {self.name} @ {self.url}>"
+
+    def __repr__(self) -> str:
+        return self.__str__()
+
+
+class MemoryQueue:
+    # in-process stand-in for `RedisQueue` with the same semantics,
+    # for tests and for running coordinator and workers on one loop
+    def __init__(
+        self,
+        name: str,
+        visibility_timeout: float = 300.0,
+        max_attempts: int = 3,
+        poll_interval: float = 1.0,
+        batch_size: int = 100,
+        **kwargs
+    ):
+        self.name = name
+        self.visibility_timeout = visibility_timeout
+        self.max_attempts = max_attempts
+        self.poll_interval = poll_interval
+        self.batch_size = batch_size
+
+        self._seen: Set[str] = set()
+        self._items: Dict[str, str] = {}
+        self._pending = collections.deque()
+        self._processing: Dict[str, float] = {}
+        self._attempts: Dict[str, int] = collections.Counter()
+        self._failed: Set[str] = set()
+        self._done = 0
+        self._producer_done = False
+        self._stopped = False
+
+    async def push(self, items: Iterable[Tuple[str, object]]) -> int:
+        pushed = 0
+        for key, item in items:
+            if key in self._seen:
+                continue
+            self._seen.add(key)
+            self._items[key] = json.dumps(item, ensure_ascii=False)
+            self._pending.appendleft(key)
+            pushed += 1
+        return pushed
+
+    async def claim(self) -> Optional[Tuple[str, object]]:
+        now = time.time()
+        for key in [key for key, deadline in self._processing.items() if deadline <= now]:
+            del self._processing[key]
+            self._retry(key)
+        if not self._pending:
+            return None
+        key = self._pending.pop()
+        self._processing[key] = now + self.visibility_timeout
+        return key, json.loads(self._items[key])
+
+    async def ack(self, key: str):
+        if self._processing.pop(key, None) is None and key in self._pending:
+            self._pending.remove(key)
+        self._items.pop(key, None)
+        self._attempts.pop(key, None)
+        self._done += 1
+
+    async def nack(self, key: str):
+        if self._processing.pop(key, None) is not None:
+            self._retry(key)
+
+    async def release(self, key: str):
+        if self._processing.pop(key, None) is not None:
+            self._pending.append(key)
+
+    async def touch(self, key: str):
+        if key in self._processing:
+            self._processing[key] = time.time() + self.visibility_timeout
+
+    async def start_producing(self):
+        self._producer_done = False
+        self._stopped = False
+
+    async def finish_producing(self):
+        self._producer_done = True
+
+    async def is_finished(self) -> bool:
+        return self._producer_done and not self._pending and not self._processing
+
+    async def stop(self):
+        self._stopped = True
+
+    async def is_stopped(self) -> bool:
+        return self._stopped
+
+    async def stats(self) -> Dict[str, int]:
+        return {
+            "pending": len(self._pending),
+            "processing": len(self._processing),
+            "failed": len(self._failed),
+            "done": self._done
+        }
+
+    async def close(self):
+        pass
+
+    def _retry(self, key: str):
+        self._attempts[key] += 1
+        if self._attempts[key] >= self.max_attempts:
+            self._failed.add(key)
+        else:
+            self._pending.appendleft(key)
+
+    def __str__(self) -> str:
+        return f"<MemoryQueue: {self.name}>"
+
+    def __repr__(self) -> str:
+        return self.__str__()
+
+
+# spiders of one process using the memory backend share a queue by name,
+# like they would share the redis keys
+_memory_queues: Dict[str, MemoryQueue] = {}
+
+
+def create_queue(backend: str, name: str, **kwargs):
+    """Build the distributed work queue for `backend`: "redis" or "memory"."""
+    if backend == "redis":
+        return RedisQueue(name, **kwargs)
+    if backend == "memory":
+        if name not in _memory_queues:
+            _memory_queues[name] = MemoryQueue(name, **kwargs)
+        return _memory_queues[name]
+    raise ValueError(f"Unknown queue backend: {backend}")
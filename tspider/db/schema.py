@@ -0,0 +1,141 @@
+from typing import Iterable, List, NamedTuple, Set, Tuple
+
+import pymongo
+from loguru import logger
+
+from tspider.db.mongo import DUPLICATE_KEY_ERROR
+
+
+class IndexSpec(NamedTuple):
+    name: str
+    keys: List[Tuple[str, object]]
+    unique: bool = False
+
+
+def get_index_fields(info: dict) -> Set[str]:
+    # text indexes list their fields as weights, keyed by `_fts` / `_ftsx`
+    fields = {field for field, _ in info.get('key', []) if field not in ('_fts', '_ftsx')}
+    return fields | set(info.get('weights', {}))
+
+
+def is_text_index(info: dict) -> bool:
+    return any(direction == pymongo.TEXT for _, direction in info.get('key', []))
+
+
+class CollectionSchema:
+    """The indexes of a spider's collection, declared on the spider class.
+
+    `key` gets a unique ascending index, which serves the equality filters
+    of every status update. A text index cannot, so text indexes on the
+    declared fields are dropped and replaced. `query_fields` get ascending
+    and `hashed_fields` hashed indexes; MongoDB cannot make hashed indexes
+    unique.
+    """
+
+    def __init__(self, key: str = 'document_id', query_fields: Iterable[str] = (), hashed_fields: Iterable[str] = ()):
+        self.key = key
+        self.query_fields = list(query_fields)
+        self.hashed_fields = list(hashed_fields)
+
+    @property
+    def fields(self) -> Set[str]:
+        return {self.key, *self.query_fields, *self.hashed_fields}
+
+    def get_indexes(self) -> List[IndexSpec]:
+        indexes = [IndexSpec(f"{self.key}_unique", [(self.key, pymongo.ASCENDING)], unique=True)]
+        indexes.extend(IndexSpec(f"{field}_1", [(field, pymongo.ASCENDING)]) for field in self.query_fields)
+        indexes.extend(IndexSpec(f"{field}_hashed", [(field, pymongo.HASHED)]) for field in self.hashed_fields)
+        return indexes
+
+    async def ensure_indexes(self, collection):
+        # `collection` is one of the async collections of `tspider.db.mongo`
+        wanted = {index.name: index for index in self.get_indexes()}
+        existing = await collection.index_information()
+        for name, info in existing.items():
+            if name == '_id_':
+                continue
+            if is_text_index(info) and get_index_fields(info) & self.fields:
+                logger.warning(f"Dropping text index {name} of {collection}, it cannot serve equality filters")
+                await collection.drop_index(name)
+            elif name in wanted and (
+                list(info['key']) != wanted[name].keys or bool(info.get('unique')) != wanted[name].unique
+            ):
+                logger.warning(f"Dropping index {name} of {collection}, its definition changed")
+                await collection.drop_index(name)
+            else:
+                # the same keys under another name, e.g. created by hand,
+                # would make creating ours fail
+                index = next((index for index in wanted.values() if list(info['key']) == index.keys), None)
+                if index is None or index.name == name:
+                    continue
+                if bool(info.get('unique')) == index.unique:
+                    logger.info(f"Index {name} of {collection} matches {index.name}, keeping it")
+                    wanted.pop(index.name)
+                else:
+                    logger.warning(f"Dropping index {name} of {collection} in favour of {index.name}")
+                    await collection.drop_index(name)
+        for index in wanted.values():
+            await self._create_index(collection, index)
+
+    @staticmethod
+    async def _create_index(collection, index: IndexSpec):
+        try:
+            await collection.create_index(index.keys, unique=index.unique, name=index.name)
+        except pymongo.errors.OperationFailure as err:
+            if not index.unique or err.code != DUPLICATE_KEY_ERROR:
+                raise
+            # existing duplicates, still index the lookups
+            logger.error(f"{collection} holds duplicate {index.keys[0][0]} values, created {index.name} without unique: {err}")
+            await collection.create_index(index.keys, name=index.name)
+
+    def __str__(self) -> str:
+        return f"<CollectionSchema: key={self.key}, query_fields={self.query_fields}, hashed_fields={self.hashed_fields}>"
+
+    def __repr__(self) -> str:
+        return self.__str__()
+
+
+def get_plan_stages(explanation: dict) -> Set[str]:
+    # every stage of the winning plan, however deeply the server nests it
+    stages = set()
+    pending = [explanation.get('queryPlanner', {}).get('winningPlan', {})]
+    while pending:
+        node = pending.pop()
+        if isinstance(node, dict):
+            if 'stage' in node:
+                stages.add(node['stage'])
+            pending.extend(node.values())
+        elif isinstance(node, list):
+            pending.extend(node)
+    return stages
+
+
+class QueryPlanChecker:
+    """Debug aid: explains the first filter of every shape the framework
+    writes with and warns when it is served by a collection scan."""
+
+    def __init__(self):
+        self.checked: Set[Tuple[str, ...]] = set()
+        self.collection_scans: Set[Tuple[str, ...]] = set()
+
+    def is_new(self, filter_condition: dict) -> bool:
+        shape = tuple(sorted(filter_condition))
+        if shape in self.checked:
+            return False
+        self.checked.add(shape)
+        return True
+
+    def check(self, collection, filter_condition: dict, explanation: dict) -> Set[str]:
+        stages = get_plan_stages(explanation)
+        if 'COLLSCAN' in stages:
+            self.collection_scans.add(tuple(sorted(filter_condition)))
+            logger.warning(f"COLLSCAN in {collection} for filter on {sorted(filter_condition)}, index these fields")
+        else:
+            logger.debug(f"Plan in {collection} for filter on {sorted(filter_condition)}: {sorted(stages)}")
+        return stages
+
+    def __str__(self) -> str:
+        return f"<QueryPlanChecker: {len(self.checked)} shapes, {len(self.collection_scans)} collection scans>"
+
+    def __repr__(self) -> str:
+        return self.__str__()
@@ -1,8 +1,15 @@
+from typing import Optional
+
 import aiohttp
 
 
-async def async_request(method: str, url: str, **kwargs):
-    async with aiohttp.ClientSession() as session:
-        func = getattr(session, method.lower())
-        async with func(url, **kwargs) as response:
-            return response
+async def async_request(method: str, url: str, session: Optional[aiohttp.ClientSession] = None, **kwargs):
+    if session is None:
+        async with aiohttp.ClientSession() as session:
+            return await async_request(method, url, session=session, **kwargs)
+
+    func = getattr(session, method.lower())
+    async with func(url, **kwargs) as response:
+        # read the body before the connection is released back to the pool
+        await response.read()
+        return response
@@ -0,0 +1,268 @@
+import json
+import time
+import hashlib
+import sqlite3
+import urllib.parse
+from pathlib import Path
+from typing import AsyncIterator, Optional, Union
+
+import aiohttp
+from loguru import logger
+from multidict import CIMultiDict, CIMultiDictProxy
+from yarl import URL
+
+
+class CacheMissError(Exception):
+    pass
+
+
+def make_cache_key(method: str, url: str, params=None, data=None, json_data=None) -> str:
+    url = URL(url)
+    if params:
+        url = url.update_query(params)
+    # query order does not change the resource
+    query = urllib.parse.urlencode(sorted(url.query.items()))
+    if isinstance(data, dict):
+        body = urllib.parse.urlencode(sorted(data.items())).encode()
+    elif isinstance(data, str):
+        body = data.encode()
+    elif isinstance(data, bytes):
+        body = data
+    elif json_data is not None:
+        body = json.dumps(json_data, sort_keys=True).encode()
+    else:
+        body = b''
+    hasher = hashlib.sha256()
+    for part in (method.upper().encode(), str(url.with_query(None)).encode(), query.encode(), body):
+        hasher.update(part)
+        hasher.update(b'\0')
+    return hasher.hexdigest()
+
+
+class _BodyReader:
+    # the part of `StreamReader` the spiders use
+    def __init__(self, body: bytes):
+        self._body = body
+
+    async def iter_chunked(self, n: int) -> AsyncIterator[bytes]:
+        for i in range(0, len(self._body), n):
+            yield self._body[i:i + n]
+
+    async def read(self, n: int = -1) -> bytes:
+        return self._body
+
+
+class CachedResponse:
+    """A response whose body is already in memory, served from the cache or
+    read from the network, with the subset of `aiohttp.ClientResponse` the
+    spiders use."""
+
+    def __init__(self, method: str, url, status: int, headers, body: bytes, from_cache: bool = False):
+        self.method = method
+        self.url = URL(url)
+        self.status = status
+        self.headers = CIMultiDictProxy(CIMultiDict(headers))
+        self.body = body
+        self.from_cache = from_cache
+        self.stored_time: Optional[float] = None
+        self.content = _BodyReader(body)
+
+    @property
+    def reason(self) -> str:
+        return "From Cache" if self.from_cache else ""
+
+    @property
+    def ok(self) -> bool:
+        return self.status < 400
+
+    def get_encoding(self) -> str:
+        mimetype = aiohttp.helpers.parse_mimetype(self.headers.get('Content-Type', ''))
+        return mimetype.parameters.get('charset') or 'utf-8'
+
+    async def read(self) -> bytes:
+        return self.body
+
+    async def text(self, encoding: Optional[str] = None, errors: str = 'strict') -> str:
+        return self.body.decode(encoding or self.get_encoding(), errors=errors)
+
+    async def json(self, encoding: Optional[str] = None, loads=json.loads, content_type: Optional[str] = None):
+        return loads(await self.text(encoding))
+
+    def raise_for_status(self):
+        if not self.ok:
+            request_info = aiohttp.RequestInfo(self.url, self.method, CIMultiDictProxy(CIMultiDict()), self.url)
+            raise aiohttp.ClientResponseError(
+                request_info, (),
+                status=self.status,
+                message=self.reason,
+                headers=self.headers
+            )
+
+    def release(self):
+        pass
+
+    async def __aenter__(self) -> 'CachedResponse':
+        return self
+
+    async def __aexit__(self, *exc_info):
+        pass
+
+    def __str__(self) -> str:
+        return f"<CachedResponse: {self.status} {self.url}, from_cache={self.from_cache}>"
+
+    def __repr__(self) -> str:
+        return self.__str__()
+
+
+class _CachedRequest:
+    # usable like aiohttp's request methods: awaited or with `async with`
+    def __init__(self, coro):
+        self._coro = coro
+
+    def __await__(self):
+        return self._coro.__await__()
+
+    async def __aenter__(self) -> CachedResponse:
+        return await self._coro
+
+    async def __aexit__(self, *exc_info):
+        pass
+
+
+class HttpCache:
+    """On-disk cache of small responses, e.g. list pages, keyed by method,
+    url, params and body.
+
+    Entries younger than `ttl` are served as they are, older ones are
+    revalidated with `If-None-Match` / `If-Modified-Since`. Least recently
+    used entries are evicted beyond `max_size` bytes. In `replay` mode
+    nothing goes to the network and a miss raises `CacheMissError`.
+    """
+
+    def __init__(
+        self,
+        path: Union[str, Path],
+        ttl: Optional[float] = 3600.0,
+        max_size: int = 512 * 1024 * 1024,
+        replay: bool = False,
+        statuses=(200,)
+    ):
+        self.path = Path(path)
+        self.ttl = ttl
+        self.max_size = max_size
+        self.replay = replay
+        self.statuses = frozenset(statuses)
+
+        self.conn = sqlite3.connect(str(self.path), isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS cache ("
+            " key TEXT PRIMARY KEY,"
+            " method TEXT NOT NULL,"
+            " url TEXT NOT NULL,"
+            " status INTEGER NOT NULL,"
+            " headers TEXT NOT NULL,"
+            " body BLOB NOT NULL,"
+            " etag TEXT,"
+            " last_modified TEXT,"
+            " size INTEGER NOT NULL,"
+            " stored_time REAL NOT NULL,"
+            " access_time REAL NOT NULL"
+            ")"
+        )
+        self.conn.execute("CREATE INDEX IF NOT EXISTS cache_access_time ON cache (access_time)")
+        self.size = self.conn.execute("SELECT COALESCE(SUM(size), 0) FROM cache").fetchone()[0]
+        self.hits = 0
+        self.misses = 0
+        self.revalidated = 0
+
+    def request(self, session: aiohttp.ClientSession, method: str, url: str, acquire=None, **kwargs) -> _CachedRequest:
+        # `acquire`, e.g. a rate limit, is awaited only when going to the network
+        return _CachedRequest(self._request(session, method, url, acquire, **kwargs))
+
+    async def _request(self, session: aiohttp.ClientSession, method: str, url: str, acquire=None, **kwargs) -> CachedResponse:
+        key = make_cache_key(method, url, kwargs.get('params'), kwargs.get('data'), kwargs.get('json'))
+        entry = self.get(key)
+        if self.replay:
+            if entry is None:
+                raise CacheMissError(f"{method} {url} is not cached")
+            self.hits += 1
+            return entry
+        if entry is not None and self.ttl is not None and time.time() - entry.stored_time < self.ttl:
+            self.hits += 1
+            return entry
+
+        headers = dict(kwargs.pop('headers', None) or {})
+        if entry is not None:
+            if entry.headers.get('ETag'):
+                headers['If-None-Match'] = entry.headers['ETag']
+            if entry.headers.get('Last-Modified'):
+                headers['If-Modified-Since'] = entry.headers['Last-Modified']
+        if acquire is not None:
+            await acquire()
+        async with session.request(method, url, headers=headers, **kwargs) as response:
+            body = await response.read()
+            if response.status == 304 and entry is not None:
+                self.revalidated += 1
+                self.conn.execute("UPDATE cache SET stored_time = ? WHERE key = ?", (time.time(), key))
+                return entry
+            self.misses += 1
+            fresh = CachedResponse(method, response.url, response.status, response.headers, body)
+        if fresh.status in self.statuses and 'no-store' not in fresh.headers.get('Cache-Control', ''):
+            self.put(key, fresh)
+        return fresh
+
+    def get(self, key: str) -> Optional[CachedResponse]:
+        row = self.conn.execute(
+            "SELECT method, url, status, headers, body, stored_time FROM cache WHERE key = ?", (key,)
+        ).fetchone()
+        if row is None:
+            return None
+        self.conn.execute("UPDATE cache SET access_time = ? WHERE key = ?", (time.time(), key))
+        method, url, status, headers, body, stored_time = row
+        response = CachedResponse(method, url, status, json.loads(headers), body, from_cache=True)
+        response.stored_time = stored_time
+        return response
+
+    def put(self, key: str, response: CachedResponse):
+        now = time.time()
+        old = self.conn.execute("SELECT size FROM cache WHERE key = ?", (key,)).fetchone()
+        self.conn.execute(
+            "INSERT OR REPLACE INTO cache VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (
+                key, response.method, str(response.url), response.status,
+                json.dumps(list(response.headers.items())), response.body,
+                response.headers.get('ETag'), response.headers.get('Last-Modified'),
+                len(response.body), now, now
+            )
+        )
+        self.size += len(response.body) - (old[0] if old is not None else 0)
+        if self.size > self.max_size:
+            self.evict()
+
+    def evict(self):
+        # down to 90% so that eviction does not run on every put
+        target = self.max_size * 0.9
+        num = 0
+        while self.size > target:
+            rows = self.conn.execute("SELECT key, size FROM cache ORDER BY access_time LIMIT 100").fetchall()
+            if not rows:
+                break
+            for key, size in rows:
+                self.conn.execute("DELETE FROM cache WHERE key = ?", (key,))
+                self.size -= size
+                num += 1
+                if self.size <= target:
+                    break
+        logger.info(f"Evicted {num} entries from {self}")
+
+    def close(self):
+        logger.info(f"{self}: hits={self.hits}, misses={self.misses}, revalidated={self.revalidated}")
+        self.conn.close()
+
+    def __str__(self) -> str:
+        return f"<HttpCache: {self.path}>"
+
+    def __repr__(self) -> str:
+        return self.__str__()
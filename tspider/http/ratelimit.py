@@ -0,0 +1,160 @@
+import time
+import asyncio
+from typing import Awaitable, Callable, Dict, Iterable, Optional
+
+import aiohttp
+from loguru import logger
+
+from tspider.utils.tracing import span
+
+
+class TokenBucket:
+    def __init__(self, rate: float, burst: int = 1):
+        self.rate = rate
+        self.burst = burst
+        self._next_time = time.monotonic()
+
+    async def acquire(self):
+        # every caller reserves the next free slot up front, so waiters are
+        # spread out at 1 / rate instead of waking up together
+        now = time.monotonic()
+        self._next_time = max(self._next_time, now - (self.burst - 1) / self.rate)
+        wait = self._next_time - now
+        self._next_time += 1.0 / self.rate
+        if wait > 0:
+            with span('ratelimit.wait'):
+                await asyncio.sleep(wait)
+
+
+class LimitedRequest:
+    # `session.request(...)` taking a rate limit token before the request
+    # is made, so waiting for it never eats into the request's timeout
+    def __init__(self, acquire: Callable[[], Awaitable[None]], make_request: Callable[[], object]):
+        self._acquire = acquire
+        self._make_request = make_request
+        self._request = None
+
+    async def _send(self):
+        await self._acquire()
+        return await self._make_request()
+
+    def __await__(self):
+        return self._send().__await__()
+
+    async def __aenter__(self):
+        await self._acquire()
+        self._request = self._make_request()
+        return await self._request.__aenter__()
+
+    async def __aexit__(self, *exc_info):
+        return await self._request.__aexit__(*exc_info)
+
+
+class HostLimit:
+    __slots__ = ('bucket', 'min_qps', 'max_qps', 'last_decrease')
+
+    def __init__(self, qps: float, min_qps: float, max_qps: float, burst: int):
+        self.bucket = TokenBucket(qps, burst)
+        self.min_qps = min_qps
+        self.max_qps = max_qps
+        self.last_decrease = 0.0
+
+    @property
+    def qps(self) -> float:
+        return self.bucket.rate
+
+
+class AdaptiveRateLimiter:
+    # per-host token buckets whose rate follows AIMD: it grows additively
+    # while requests succeed and is cut multiplicatively on 429/5xx,
+    # timeouts or latency above `latency_threshold`
+    def __init__(
+        self,
+        qps: float = 2.0,
+        min_qps: float = 0.1,
+        max_qps: Optional[float] = None,
+        burst: int = 1,
+        increase: float = 0.1,
+        decrease: float = 0.5,
+        latency_threshold: Optional[float] = None,
+        hosts: Optional[Dict[str, dict]] = None,
+        exclude_hosts: Iterable[str] = (),
+    ):
+        self.qps = qps
+        self.min_qps = min_qps
+        self.max_qps = max_qps or qps * 5
+        self.burst = burst
+        self.increase = increase
+        self.decrease = decrease
+        self.latency_threshold = latency_threshold
+        self.hosts = dict(hosts or {})
+        self.exclude_hosts = set(exclude_hosts)
+
+        self._limits: Dict[str, HostLimit] = {}
+
+    def get_limit(self, host: str) -> Optional[HostLimit]:
+        if host in self.exclude_hosts:
+            return None
+        if host not in self._limits:
+            config = self.hosts.get(host, {})
+            qps = config.get('qps', self.qps)
+            self._limits[host] = HostLimit(
+                qps,
+                config.get('min_qps', self.min_qps),
+                config.get('max_qps', max(self.max_qps, qps)),
+                config.get('burst', self.burst),
+            )
+        return self._limits[host]
+
+    async def acquire(self, host: str):
+        limit = self.get_limit(host)
+        if limit is not None:
+            await limit.bucket.acquire()
+
+    def feedback(self, host: str, status: Optional[int] = None, latency: Optional[float] = None, error: Optional[BaseException] = None):
+        limit = self.get_limit(host)
+        if limit is None:
+            return
+        congested = (
+            (status is not None and (status == 429 or status >= 500))
+            or isinstance(error, (asyncio.TimeoutError, aiohttp.ServerDisconnectedError))
+            or (self.latency_threshold is not None and latency is not None and latency > self.latency_threshold)
+        )
+        bucket = limit.bucket
+        if congested:
+            now = time.monotonic()
+            # a burst of failures from requests already in flight counts once
+            if now - limit.last_decrease < 1.0 / bucket.rate:
+                return
+            limit.last_decrease = now
+            bucket.rate = max(limit.min_qps, bucket.rate * self.decrease)
+            logger.warning(f"Rate limit for {host} decreased to {bucket.rate:.2f} qps")
+        elif error is None:
+            # `increase / rate` per success adds about `increase` qps per second
+            bucket.rate = min(limit.max_qps, bucket.rate + self.increase / bucket.rate)
+
+    def make_trace_config(self) -> aiohttp.TraceConfig:
+        # feedback only, tokens are taken before the request starts, see `LimitedRequest`
+        trace_config = aiohttp.TraceConfig()
+
+        async def on_request_start(session, ctx, params):
+            ctx.start_time = time.monotonic()
+
+        async def on_request_end(session, ctx, params):
+            latency = time.monotonic() - ctx.start_time
+            self.feedback(params.url.host, status=params.response.status, latency=latency)
+
+        async def on_request_exception(session, ctx, params):
+            self.feedback(params.url.host, error=params.exception)
+
+        trace_config.on_request_start.append(on_request_start)
+        trace_config.on_request_end.append(on_request_end)
+        trace_config.on_request_exception.append(on_request_exception)
+        return trace_config
+
+    def __str__(self) -> str:
+        rates = {host: round(limit.qps, 2) for host, limit in self._limits.items()}
+        return f"<AdaptiveRateLimiter: {rates}>"
+
+    def __repr__(self) -> str:
+        return self.__str__()
@@ -0,0 +1,173 @@
+import enum
+import json
+import time
+import random
+import asyncio
+import datetime
+from email.utils import parsedate_to_datetime
+from typing import Any, Awaitable, Callable, Iterable, Optional, Tuple, Type
+
+import aiohttp
+from loguru import logger
+
+from tspider.utils.tracing import span
+
+
+class RetryAction(enum.Enum):
+    ROTATE_PROXY = "rotate_proxy"
+    BACKOFF = "backoff"
+    GIVE_UP = "give_up"
+
+
+# checked in order, so subclasses must come before their bases
+# (ClientProxyConnectionError is a ClientOSError). A body that is not what
+# was asked for, e.g. a proxy's HTML error page, rotates the proxy, without
+# a proxy it is retried with backoff
+DEFAULT_RULES: Tuple[Tuple[Type[BaseException], RetryAction], ...] = (
+    (aiohttp.ClientProxyConnectionError, RetryAction.ROTATE_PROXY),
+    (aiohttp.ContentTypeError, RetryAction.ROTATE_PROXY),
+    (json.JSONDecodeError, RetryAction.ROTATE_PROXY),
+    (aiohttp.ServerDisconnectedError, RetryAction.BACKOFF),
+    (aiohttp.ClientPayloadError, RetryAction.BACKOFF),
+    (aiohttp.ClientOSError, RetryAction.BACKOFF),
+    (asyncio.TimeoutError, RetryAction.BACKOFF),
+)
+
+RETRY_STATUSES = frozenset({408, 429, 500, 502, 503, 504})
+
+
+def get_retry_after(err: BaseException) -> Optional[float]:
+    headers = getattr(err, 'headers', None)
+    if not headers:
+        return None
+    value = headers.get('Retry-After')
+    if value is None:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        date = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    now = datetime.datetime.now(date.tzinfo)
+    return max(0.0, (date - now).total_seconds())
+
+
+class RetryBudget:
+    # every call deposits `ratio` tokens and every backoff retry costs one,
+    # so retries stay a bounded fraction of traffic while a site is failing
+    def __init__(self, ratio: float = 0.2, min_retries: int = 10, max_retries: int = 100):
+        self.ratio = ratio
+        self.max_retries = max_retries
+        self.balance = float(min_retries)
+
+    def deposit(self):
+        self.balance = min(self.balance + self.ratio, float(self.max_retries))
+
+    def withdraw(self) -> bool:
+        if self.balance < 1.0:
+            return False
+        self.balance -= 1.0
+        return True
+
+
+class RetryPolicy:
+    def __init__(
+        self,
+        max_attempts: int = 5,
+        base_delay: float = 1.0,
+        max_delay: float = 60.0,
+        budget: Optional[RetryBudget] = None,
+        rules: Iterable[Tuple[Type[BaseException], RetryAction]] = DEFAULT_RULES,
+        retry_statuses: Iterable[int] = RETRY_STATUSES,
+    ):
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.budget = budget
+        self.rules = tuple(rules)
+        self.retry_statuses = frozenset(retry_statuses)
+        # a `MetricsRegistry`, counts retries and proxy outcomes when set
+        self.metrics = None
+
+    def classify(self, err: BaseException) -> Optional[RetryAction]:
+        # `None` means the error is not a transport error and is re-raised
+        if isinstance(err, aiohttp.ClientResponseError) and not isinstance(err, aiohttp.ContentTypeError):
+            if err.status in self.retry_statuses:
+                return RetryAction.BACKOFF
+            return RetryAction.GIVE_UP
+        for exc_type, action in self.rules:
+            if isinstance(err, exc_type):
+                return action
+        return None
+
+    def get_delay(self, attempt: int, err: Optional[BaseException] = None) -> float:
+        retry_after = get_retry_after(err) if err is not None else None
+        if retry_after is not None:
+            return min(retry_after, self.max_delay)
+        # exponential backoff with full jitter
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+    async def run(
+        self,
+        func: Callable[[Optional[str]], Awaitable[Any]],
+        proxy_manager=None,
+        default: Any = None,
+        desc: str = "",
+    ) -> Any:
+        """Call `func(proxy)` until it returns, retrying transport errors.
+
+        Returns `default` once the attempts, or the retry budget, are used up
+        or when an error is classified as not worth retrying.
+        """
+        if self.budget is not None:
+            self.budget.deposit()
+        proxy = None
+        for attempt in range(self.max_attempts):
+            try:
+                if proxy is None and proxy_manager is not None:
+                    proxy = await proxy_manager.get_proxy()
+                start_time = time.monotonic()
+                result = await func(proxy)
+                if proxy is not None:
+                    latency = time.monotonic() - start_time
+                    proxy_manager.report_success(proxy, latency)
+                    if self.metrics is not None:
+                        self.metrics.histogram('proxy_request_duration_seconds', labelnames=('proxy',)).observe(latency, proxy)
+                return result
+            except Exception as err:
+                action = self.classify(err)
+                if action is None:
+                    raise
+                if self.metrics is not None:
+                    self.metrics.counter('request_failures_total', labelnames=('error', 'action')).inc(type(err).__name__, action.value)
+                    if proxy is not None:
+                        self.metrics.counter('proxy_failures_total', labelnames=('proxy',)).inc(proxy)
+                if proxy is not None and action is not RetryAction.GIVE_UP:
+                    # only connection failures to the proxy itself take it out of rotation
+                    proxy_manager.report_failure(proxy, quarantine=action is RetryAction.ROTATE_PROXY)
+                logger.warning(
+                    f"{type(err).__name__} {desc} "
+                    f"(attempt {attempt + 1}/{self.max_attempts}, proxy: {proxy}): {err}"
+                )
+                if action is RetryAction.GIVE_UP or attempt + 1 >= self.max_attempts:
+                    break
+                if action is RetryAction.ROTATE_PROXY and proxy_manager is not None:
+                    proxy = None
+                    continue
+                if self.budget is not None and not self.budget.withdraw():
+                    logger.warning(f"Retry budget exhausted, giving up {desc}")
+                    break
+                with span('retry.backoff', attempt=attempt + 1):
+                    await asyncio.sleep(self.get_delay(attempt, err))
+
+        logger.error(f"Failed {desc}")
+        return default
+
+    def __str__(self) -> str:
+        return f"<RetryPolicy: max_attempts={self.max_attempts}, base_delay={self.base_delay}>"
+
+    def __repr__(self) -> str:
+        return self.__str__()
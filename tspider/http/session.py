@@ -0,0 +1,92 @@
+from typing import List, Optional
+
+import aiohttp
+
+
+class SessionManager:
+    """One long-lived `aiohttp.ClientSession` shared by a spider and its utilities.
+
+    aiohttp keys pooled connections by (host, port, ssl, proxy), so requests
+    going through the same proxy to the same target reuse their connections.
+    """
+
+    def __init__(
+        self,
+        limit: int = 100,
+        limit_per_host: int = 10,
+        keepalive_timeout: float = 30.0,
+        ttl_dns_cache: Optional[int] = 300,
+        **session_kwargs
+    ):
+        self.limit = limit
+        self.limit_per_host = limit_per_host
+        self.keepalive_timeout = keepalive_timeout
+        self.ttl_dns_cache = ttl_dns_cache
+        self.session_kwargs = session_kwargs
+        self.trace_configs: List[aiohttp.TraceConfig] = []
+
+        self._session: Optional[aiohttp.ClientSession] = None
+        self._connector: Optional[aiohttp.TCPConnector] = None
+        # set on managers made by `share()`, which use the parent's connector
+        self._parent: Optional['SessionManager'] = None
+
+    @property
+    def connector(self) -> aiohttp.TCPConnector:
+        if self._parent is not None:
+            return self._parent.connector
+        if self._connector is None or self._connector.closed:
+            self._connector = aiohttp.TCPConnector(
+                limit=self.limit,
+                limit_per_host=self.limit_per_host,
+                keepalive_timeout=self.keepalive_timeout,
+                ttl_dns_cache=self.ttl_dns_cache,
+                use_dns_cache=self.ttl_dns_cache is not None,
+            )
+        return self._connector
+
+    @property
+    def session(self) -> aiohttp.ClientSession:
+        # created lazily so that it binds to the running event loop
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(
+                connector=self.connector,
+                connector_owner=False,
+                trace_configs=list(self.trace_configs),
+                **self.session_kwargs
+            )
+        return self._session
+
+    def share(self, **session_kwargs) -> 'SessionManager':
+        """Another manager whose sessions pool their connections with this
+        one's, e.g. for several spiders on one loop, each with its own
+        trace configs. This manager must be closed last."""
+        manager = SessionManager(
+            self.limit, self.limit_per_host, self.keepalive_timeout, self.ttl_dns_cache,
+            **{**self.session_kwargs, **session_kwargs}
+        )
+        manager._parent = self
+        return manager
+
+    def add_trace_config(self, trace_config: aiohttp.TraceConfig):
+        # hooks into every request made through the shared session,
+        # only sessions created afterwards pick it up
+        self.trace_configs.append(trace_config)
+
+    @property
+    def closed(self) -> bool:
+        return self._session is None or self._session.closed
+
+    async def close(self):
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        self._session = None
+        if self._connector is not None and not self._connector.closed:
+            await self._connector.close()
+        self._connector = None
+
+    def __str__(self) -> str:
+        shared = ", shared" if self._parent is not None else ""
+        return f"<SessionManager: limit={self.limit}, limit_per_host={self.limit_per_host}{shared}>"
+
+    def __repr__(self) -> str:
+        return self.__str__()
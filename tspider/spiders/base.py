@@ -1,70 +1,858 @@
 import os
 import asyncio
+import datetime
+import functools
+import inspect
+import operator
+import itertools
+import multiprocessing
 from pathlib import Path
-from typing import Iterable
+from typing import AsyncIterator, Awaitable, Callable, Dict, Iterable, Optional, Tuple, Union
 
 from loguru import logger
 from omegaconf.omegaconf import OmegaConf
+from yarl import URL
+
+from tspider.db.frontier import FrontierState, SQLiteFrontier
+from tspider.db.mongo import create_async_collection
+from tspider.db.queue import create_queue
+from tspider.db.schema import CollectionSchema, QueryPlanChecker
+from tspider.http.cache import CacheMissError, HttpCache
+from tspider.http.ratelimit import AdaptiveRateLimiter, LimitedRequest
+from tspider.http.retry import RetryBudget, RetryPolicy
+from tspider.http.session import SessionManager
+from tspider.spiders.runner import SharedResources
+from tspider.spiders.scheduler import PriorityPolicy, Scheduler, get_domain
+from tspider.utils.dedup import DedupIndex
+from tspider.utils.download import ContentAddressedSink, StreamingSink
+from tspider.utils.metrics import MetricsRegistry
+from tspider.utils.parse import ParseExecutor
+from tspider.utils.proxy import ProxyManager
+from tspider.utils.segments import SegmentSink
+from tspider.utils.tracing import Tracer, span
+
+
+_END = object()
 
 
 class SpiderBase(object):
-    def __init__(self, config_filepath: str):
+    # indexes of the mongo collection, created or migrated on `open`
+    schema: Optional[CollectionSchema] = None
+
+    def __init__(self, config_filepath: str, resources: Optional[SharedResources] = None):
+        # `resources` are the connection pool, proxy pools and DB clients
+        # shared by spiders running on one loop, see `SpiderRunner`
         self.config = OmegaConf.load(config_filepath)
+        self.resources = resources
         self.name = self.config.name
         self.stop_signal = False
         self.output_dir = Path(self.config.output_dir, self.config.name)
         if not self.output_dir.exists() or not self.output_dir.is_dir():
             self.output_dir.mkdir(parents=True)
-        logger.add(self.output_dir.joinpath('log.log'))
+        # records from other spiders on the same loop are left out, see `main`
+        logger.add(self.output_dir.joinpath('log.log'), filter=self.filter_log_record)
+
+        # session:
+        #   limit: 100
+        #   limit_per_host: 10
+        #   keepalive_timeout: 30.0
+        #   ttl_dns_cache: 300
+        if resources is not None:
+            self.session_manager = resources.session_manager.share()
+        else:
+            self.session_manager = SessionManager(**self.get_config_section('session'))
+
+        # proxy_host: "localhost"
+        # proxy_port: "26888"
+        # proxy_pool:
+        #   pool_size: 50
+        #   refill_threshold: 10
+        #   quarantine_time: 60.0
+        #   max_failures: 3
+        # rate_limit:
+        #   qps: 2.0               # starting rate per host
+        #   max_qps: 10.0
+        #   min_qps: 0.1
+        #   latency_threshold: 5.0
+        #   hosts: {"www.cninfo.com.cn": {qps: 1.0, max_qps: 4.0}}
+        self.rate_limiter = None
+        if self.config.get('rate_limit') is not None:
+            rate_limit_config = self.get_config_section('rate_limit')
+            exclude_hosts = set(rate_limit_config.pop('exclude_hosts', []))
+            if self.config.get('proxy_host') is not None:
+                exclude_hosts.add(self.config.proxy_host)
+            if resources is not None:
+                self.rate_limiter = resources.get_rate_limiter(exclude_hosts=exclude_hosts, **rate_limit_config)
+            else:
+                self.rate_limiter = AdaptiveRateLimiter(exclude_hosts=exclude_hosts, **rate_limit_config)
+            self.session_manager.add_trace_config(self.rate_limiter.make_trace_config())
+
+        # metrics:
+        #   interval: 60.0         # seconds between summaries in the log
+        #   path: metrics.prom     # relative to the output dir, rewritten every interval
+        #   port: 9100             # serves /metrics when set
+        self.metrics = None
+        self.metrics_config = self.get_config_section('metrics')
+        self._metrics_task: Optional[asyncio.Task] = None
+        if self.config.get('metrics') is not None:
+            self.metrics = MetricsRegistry()
+            self.session_manager.add_trace_config(self.metrics.make_trace_config())
+
+        # tracing:
+        #   sample_rate: 0.1       # share of items timed stage by stage, from proxy wait to DB write
+        #   path: trace.json       # relative to the output dir, for chrome://tracing or Perfetto
+        #   max_spans: 100000      # spans kept for the trace file, the report counts all of them
+        self.tracer = None
+        self.trace_path = None
+        if self.config.get('tracing') is not None:
+            tracing_config = self.get_config_section('tracing')
+            self.trace_path = self.output_dir.joinpath(tracing_config.pop('path', 'trace.json'))
+            self.tracer = Tracer(**tracing_config)
+            self.session_manager.add_trace_config(self.tracer.make_trace_config())
+
+        # replaying the http cache never goes to the network, see `request`,
+        # so requests must not wait for a proxy
+        replay = self.get_config_section('http_cache').get('replay', False)
+        proxy_host = self.config.get('proxy_host') if not replay else None
+        self.proxy_manager = None
+        if proxy_host is not None and resources is not None:
+            self.proxy_manager = resources.get_proxy_manager(
+                self.config.proxy_host,
+                self.config.proxy_port,
+                **self.get_config_section('proxy_pool')
+            )
+        elif proxy_host is not None:
+            self.proxy_manager = ProxyManager(
+                self.config.proxy_host,
+                self.config.proxy_port,
+                session_manager=self.session_manager,
+                **self.get_config_section('proxy_pool')
+            )
+
+        # mongo_host: "localhost"
+        # mongo_port: 27018
+        # mongo_db: cebpubservice
+        # mongo_collection: ${name}
+        # mongo_backend: thread    # thread | motor | memory
+        # mongo_max_workers: 4     # thread pool size of the `thread` backend
+        # mongo_explain: false     # debug, explain each filter shape of updates and warn on COLLSCAN
+        # mongo_buffer:
+        #   buffer_size: 500
+        #   flush_interval: 1.0
+        self.db_manager = None
+        if self.config.get('mongo_host') is not None:
+            self.db_manager = create_async_collection(
+                self.config.get('mongo_backend', 'thread'),
+                self.config.mongo_host,
+                self.config.mongo_port,
+                self.config.mongo_db,
+                self.config.mongo_collection,
+                username=self.config.get('mongo_username'),
+                password=self.config.get('mongo_password'),
+                max_workers=self.config.get('mongo_max_workers', 4),
+                pool=resources.mongo_pool if resources is not None else None,
+                **self.get_config_section('mongo_buffer')
+            )
+            if self.config.get('mongo_explain', False):
+                self.db_manager.plan_checker = QueryPlanChecker()
+
+        # download:
+        #   chunk_size: 65536
+        #   hash_name: sha256
+        #   resume: true                  # keep .part files and resume with Range requests
+        #   checkpoint_interval: 1048576
+        #   content_addressed: false      # store each distinct content once under blobs/
+        #   link: hardlink                # hardlink | symlink | copy | none, friendly names of blobs
+        #   segments: false               # append WARC records to rotating segments/ files instead
+        #   segment_size: 1073741824
+        #   compression: gzip             # gzip | zstd
+        download_config = self.get_config_section('download')
+        content_addressed = download_config.pop('content_addressed', False)
+        if download_config.pop('segments', False):
+            if content_addressed:
+                raise ValueError("download: `segments` and `content_addressed` exclude each other")
+            download_config.pop('link', None)
+            self.sink = SegmentSink(self.output_dir, **download_config)
+        elif content_addressed:
+            self.sink = ContentAddressedSink(self.output_dir, **download_config)
+        else:
+            self.sink = StreamingSink(self.output_dir, **download_config)
+
+        # frontier:
+        #   path: frontier.sqlite3    # relative to the output dir
+        #   max_attempts: 3           # failed items are retried on later runs until then
+        #   incremental: true         # stop paginating at pages holding only known items
+        # distributed:
+        #   role: worker           # coordinator | worker, overridden by `start(role=...)`
+        #   backend: redis         # redis | memory
+        #   url: "redis://localhost:26887/0"
+        #   visibility_timeout: 300.0    # claimed items go back to the queue unless acked by then
+        #   max_attempts: 3
+        self.queue = None
+        self.role = None
+        # claims extended from the moment they are taken, see `iter_queue`
+        self._heartbeats: Dict[str, asyncio.Task] = {}
+        if self.config.get('distributed') is not None:
+            distributed_config = self.get_config_section('distributed')
+            self.role = distributed_config.pop('role', None)
+            self.queue = create_queue(
+                distributed_config.pop('backend', 'redis'),
+                distributed_config.pop('name', self.name),
+                **distributed_config
+            )
+
+        # priority:                # crawl the freshest items first instead of in discovery order
+        #   page_weight: 0.1       # days of age a list page is worth
+        #   retry_penalty: 1.0     # days of age a failed attempt is worth
+        #   host_penalty: 0.05     # days of age per queued item of the same host
+        # items are reordered within the scheduler's `queue_size`, raise it
+        # to look further ahead; see `get_publish_time` and `get_page_num`
+        self.priority = None
+        if self.config.get('priority') is not None:
+            self.priority = PriorityPolicy(**self.get_config_section('priority'))
+
+        # the distributed queue takes the frontier's place
+        self.frontier = None
+        self.incremental = False
+        frontier_config = self.get_config_section('frontier')
+        if self.config.get('frontier') is not None and self.queue is None:
+            self.incremental = frontier_config.pop('incremental', True)
+            self.frontier = SQLiteFrontier(
+                self.output_dir.joinpath(frontier_config.pop('path', 'frontier.sqlite3')),
+                retry_penalty=self.priority.retry_penalty if self.priority is not None else 0.0,
+                **frontier_config
+            )
+
+        # parse:
+        #   backend: process    # process | thread | inline
+        #   max_workers: 4      # defaults to the number of cores
+        self.parser = ParseExecutor(**self.get_config_section('parse'))
+
+        # http_cache:
+        #   path: http_cache.sqlite3    # relative to the output dir
+        #   ttl: 3600.0                 # served without revalidation until then
+        #   max_size: 536870912
+        #   replay: false               # serve everything from the cache, e.g. to test parsers offline
+        self.http_cache = None
+        if self.config.get('http_cache') is not None:
+            http_cache_config = self.get_config_section('http_cache')
+            self.http_cache = HttpCache(
+                self.output_dir.joinpath(http_cache_config.pop('path', 'http_cache.sqlite3')),
+                **http_cache_config
+            )
+
+        # dedup:
+        #   path: dedup.sqlite3    # relative to the output dir, in memory for one run when unset;
+        #                          # ids seen before are never crawled again, pair it with `frontier`
+        #   capacity: 1000000      # sizes the Bloom filter, more keys only raise false positives
+        #   error_rate: 0.001
+        dedup_config = self.get_config_section('dedup')
+        dedup_path = dedup_config.pop('path', None)
+        self.dedup = DedupIndex(
+            self.output_dir.joinpath(dedup_path) if dedup_path is not None else None,
+            **dedup_config
+        )
+
+        # scheduler:
+        #   concurrency: 16
+        #   per_domain_concurrency: 8
+        #   domain_concurrency: {"www.cninfo.com.cn": 4}
+        #   queue_size: 32
+        self.scheduler = Scheduler(domain_func=self.get_domain, **self.get_config_section('scheduler'))
+
+        # pagination:
+        #   max_empty_pages: 3     # stop after this many consecutive empty list pages
+        #   probe: true            # search for the last page when the site does not report it
+        #   page_attempts: 3       # fetches of a list page that failed, on top of its retry policy
+        #   max_failed_pages: 10   # stop after this many consecutive pages that could not be fetched
+        pagination_config = self.get_config_section('pagination')
+        self.max_empty_pages = pagination_config.get('max_empty_pages', 3)
+        self.probe_pages = pagination_config.get('probe', True)
+        self.page_attempts = pagination_config.get('page_attempts', 3)
+        self.max_failed_pages = pagination_config.get('max_failed_pages', 10)
+
+        # retry:
+        #   max_attempts: 5      # defaults to `max_request_attempt`
+        #   base_delay: 1.5      # defaults to `sleep`
+        #   max_delay: 60.0
+        #   budget: {ratio: 0.2, min_retries: 10, max_retries: 100}   # off unless set, `{}` for these defaults
+        retry_config = self.get_config_section('retry')
+        budget_config = retry_config.pop('budget', None)
+        self.retry_policy = RetryPolicy(**{
+            "max_attempts": self.config.get('max_request_attempt', 5),
+            "base_delay": self.config.get('sleep', 1.0),
+            "budget": RetryBudget(**budget_config) if budget_config is not None else None,
+            **retry_config,
+        })
+
+        if self.metrics is not None:
+            self.instrument(self.metrics)
 
-    def start(self, *args, **kwargs):
+    def instrument(self, metrics: MetricsRegistry):
+        self.retry_policy.metrics = metrics
+        metrics.gauge('scheduler_in_flight', 'Items being crawled').set_function(lambda: self.scheduler.in_flight)
+        metrics.gauge('scheduler_queued', 'Items waiting for a worker').set_function(lambda: self.scheduler.queued)
+        if self.proxy_manager is not None:
+            metrics.gauge('proxy_pool_active', 'Proxies in rotation').set_function(lambda: len(self.proxy_manager))
+        # streamed bodies bypass the trace config's byte count
+        self.sink.received_bytes = metrics.counter('http_response_bytes_total', 'Response body bytes received by host', ('host',))
+        if self.db_manager is not None:
+            self.db_manager.write_latency = metrics.histogram(
+                'db_write_duration_seconds', 'Duration of DB write round trips', ('operation',)
+            )
+
+    def filter_log_record(self, record) -> bool:
+        return record['extra'].get('spider', self.name) == self.name
+
+    def get_config_section(self, key: str) -> dict:
+        section = self.config.get(key)
+        if section is None:
+            return {}
+        return OmegaConf.to_container(section, resolve=True)
+
+    def start(self, *args, role: Optional[str] = None, **kwargs):
         loop = asyncio.get_event_loop()
         try:
-            if self.stop_signal:
-                raise InterruptedError
+            loop.run_until_complete(self.main(*args, role=role, **kwargs))
+        finally:
+            loop.close()
+
+    async def main(self, *args, role: Optional[str] = None, **kwargs):
+        # runs and closes the spider on the running loop, next to other spiders
+        role = role or self.role
+        if role is not None and self.queue is None:
+            raise ValueError(f"Role {role} requires a `distributed` config section")
+        if role == 'coordinator':
+            main = self.run_coordinator(*args, **kwargs)
+        elif role == 'worker':
+            main = self.run_worker()
+        elif role is None:
+            main = self.run(*args, **kwargs)
+        else:
+            raise ValueError(f"Unknown role: {role}")
+        if role == 'worker' and self.trace_path is not None:
+            # workers of one spider share its output dir
+            self.trace_path = self.trace_path.with_name(f"{self.trace_path.stem}.{os.getpid()}{self.trace_path.suffix}")
+        with logger.contextualize(spider=self.name):
+            try:
+                await main
+            finally:
+                await self.close()
+
+    @classmethod
+    def start_workers(cls, config_filepath: str, num_workers: int):
+        # one event loop per process, so crawling scales across cores
+        context = multiprocessing.get_context('spawn')
+        processes = [
+            context.Process(target=_start_worker, args=(cls, config_filepath), name=f"worker-{i}")
+            for i in range(num_workers)
+        ]
+        for process in processes:
+            process.start()
+        for process in processes:
+            process.join()
+
+    async def run(self, *args, **kwargs):
+        if self.stop_signal:
+            raise InterruptedError
+
+        await self.open()
+
+        url_list = self.get_url_list(*args, **kwargs)
+        if inspect.isasyncgen(url_list):
+            if self.config.get('pipeline', True):
+                # download workers start as soon as the first list page is parsed,
+                # the scheduler's bounded queue holds back discovery when they fall behind
+                num = await self.craw_urls(url_list)
+                logger.info(f"crawled url num: {num}")
+                return
+            url_list = [url async for url in url_list]
+        else:
+            url_list = await url_list
 
-            url_list = loop.run_until_complete(self.get_url_list(*args, **kwargs))
+        if self.stop_signal:
+            raise InterruptedError
 
-            # with self.output_dir.joinpath('url_set.txt').open('wt') as fout:
-            #     for url in url_set:
-            #         fout.write(f"{url}\n")
-            #         fout.flush()
+        logger.info(f"url list len: {len(url_list)}")
 
-            # url_set = set()
-            # with self.output_dir.joinpath('url_list.txt').open('rt') as fin:
-            #     for url in fin:
-            #         url_set.add(url.strip())
+        """sync"""
+        # for url in url_list:
+        #     await self.craw_one(url)
 
-            if self.stop_signal:
-                raise InterruptedError
+        """async"""
+        await self.craw_urls(url_list)
 
-            logger.info(f"url list len: {len(url_list)}")
+    async def run_coordinator(self, *args, **kwargs):
+        # discovers items and pushes them to the shared queue for the workers
+        await self.open()
+        await self.queue.start_producing()
 
-            """sync"""
-            # for url in url_list:
-            #     loop.run_until_complete(self.craw_one(url))
+        url_list = self.get_url_list(*args, **kwargs)
+        if not inspect.isasyncgen(url_list):
+            url_list = await url_list
 
-            """async"""
-            loop.run_until_complete(self.craw_urls(url_list))
+        num = 0
+        batch = []
+        # pushed in batches, each one script call with a bounded argument list
+        if hasattr(url_list, '__aiter__'):
+            async for url in url_list:
+                batch.append((self.get_item_key(url), url))
+                if len(batch) >= self.queue.batch_size:
+                    num += await self.queue.push(batch)
+                    batch = []
+                    if self.stop_signal or await self.queue.is_stopped():
+                        break
+        else:
+            for url in url_list:
+                batch.append((self.get_item_key(url), url))
+                if len(batch) >= self.queue.batch_size:
+                    num += await self.queue.push(batch)
+                    batch = []
+                    if self.stop_signal or await self.queue.is_stopped():
+                        break
+        num += await self.queue.push(batch)
+        await self.queue.finish_producing()
+        logger.info(f"pushed url num: {num}, queue: {await self.queue.stats()}")
 
+    async def run_worker(self):
+        await self.open()
+        num = 0
+        results = self.scheduler.run(self.iter_queue(), self.craw_claimed, return_exceptions=True)
+        try:
+            async for _ in results:
+                num += 1
         finally:
-            loop.close()
+            await results.aclose()
+            await self.release_claimed()
+        logger.info(f"crawled url num: {num}, queue: {await self.queue.stats()}")
+
+    async def iter_queue(self) -> AsyncIterator[object]:
+        # claims only as fast as the scheduler takes items, until the
+        # coordinator is done and no other worker holds anything
+        while not self.stop_signal and not await self.queue.is_stopped():
+            claimed = await self.queue.claim()
+            if claimed is not None:
+                # items wait in the scheduler's buffer before a worker takes
+                # them, their claim has to be kept from now on
+                key, url = claimed
+                self._heartbeats[key] = asyncio.ensure_future(self.keep_claimed(key))
+                yield url
+            elif await self.queue.is_finished():
+                return
+            else:
+                await asyncio.sleep(self.queue.poll_interval)
+
+    async def craw_claimed(self, url) -> object:
+        key = self.get_item_key(url)
+        heartbeat = self._heartbeats.get(key)
+        try:
+            result = await self.craw_traced(url)
+        except Exception:
+            await self.queue.nack(key)
+            raise
+        finally:
+            if heartbeat is not None:
+                heartbeat.cancel()
+                del self._heartbeats[key]
+        if result is False:
+            await self.queue.nack(key)
+        else:
+            await self.queue.ack(key)
+        return result
+
+    async def keep_claimed(self, key: str):
+        # long downloads extend their claim instead of being handed out twice
+        while True:
+            await asyncio.sleep(self.queue.visibility_timeout / 3)
+            await self.queue.touch(key)
+
+    async def release_claimed(self):
+        # items claimed but never crawled, e.g. on stop, go back to the queue
+        heartbeats, self._heartbeats = self._heartbeats, {}
+        for key, heartbeat in heartbeats.items():
+            heartbeat.cancel()
+            await self.queue.release(key)
+
+    async def open(self):
+        # async setup, e.g. creating indexes, before anything is crawled
+        if self.db_manager is not None and self.schema is not None:
+            await self.schema.ensure_indexes(self.db_manager)
+        if self.metrics is not None and self._metrics_task is None:
+            if self.metrics_config.get('port') is not None:
+                await self.metrics.serve(port=self.metrics_config['port'])
+            self._metrics_task = asyncio.ensure_future(self.report_metrics())
+
+    async def report_metrics(self):
+        while True:
+            await asyncio.sleep(self.metrics_config.get('interval', 60.0))
+            self.log_metrics()
+
+    def log_metrics(self):
+        logger.info(f"metrics: {self.metrics.summary()}")
+        if self.metrics_config.get('path') is not None:
+            self.metrics.write(self.output_dir.joinpath(self.metrics_config['path']))
+
+    async def close(self):
+        if self._metrics_task is not None:
+            self._metrics_task.cancel()
+            self._metrics_task = None
+        if self.frontier is not None:
+            logger.info(f"frontier: {self.frontier.stats()}")
+            self.frontier.close()
+        self.dedup.close()
+        self.sink.close()
+        self.parser.close()
+        if self.http_cache is not None:
+            self.http_cache.close()
+        if self.queue is not None:
+            await self.queue.close()
+        if self.proxy_manager is not None:
+            await self.proxy_manager.close()
+        await self.session_manager.close()
+        if self.db_manager is not None:
+            await self.db_manager.close()
+        if self.tracer is not None:
+            logger.info(self.tracer.report())
+            self.tracer.write(self.trace_path)
+            logger.info(f"trace: {self.trace_path}")
+        if self.metrics is not None:
+            # last, so that the final flushes are counted
+            self.log_metrics()
+            await self.metrics.close()
 
     def stop(self):
         self.stop_signal = True
+        self.scheduler.stop()
+
+    async def stop_all(self):
+        # stops the coordinator and every worker sharing the queue
+        self.stop()
+        if self.queue is not None:
+            await self.queue.stop()
+
+    @property
+    def session(self):
+        return self.session_manager.session
+
+    def request(self, method: str, url: str, cache: bool = False, **kwargs):
+        # `cache=True` goes through the http cache when one is configured,
+        # meant for small responses like list pages. Requests wait for the
+        # rate limit here, before their timeout starts. Replay serves only
+        # those, anything else raises `CacheMissError` like a miss would
+        if self.http_cache is not None and self.http_cache.replay and not cache:
+            raise CacheMissError(f"{method} {url} is not cached, replay only serves `cache=True` requests")
+        acquire = None
+        if self.rate_limiter is not None:
+            acquire = functools.partial(self.rate_limiter.acquire, URL(url).host)
+        if cache and self.http_cache is not None:
+            return self.http_cache.request(self.session, method, url, acquire=acquire, **kwargs)
+        if acquire is None:
+            return self.session.request(method, url, **kwargs)
+        return LimitedRequest(acquire, functools.partial(self.session.request, method, url, **kwargs))
+
+    def get_domain(self, url) -> Optional[str]:
+        return get_domain(url)
+
+    def get_item_key(self, url) -> str:
+        if isinstance(url, dict):
+            return url.get('document_id') or url['url']
+        return url
+
+    def is_known(self, key: str) -> bool:
+        # only consulted in incremental mode, where known items are skipped
+        return self.incremental and key in self.frontier
+
+    async def parse(self, func: Callable, *args, **kwargs):
+        # `func` runs in the parse pool, pass it raw bytes rather than parsed trees
+        with span('parse', func=getattr(func, '__name__', func)):
+            return await self.parser.run(func, *args, **kwargs)
+
+    def is_duplicate(self, key: str) -> bool:
+        # records `key` as seen, check it before any request or DB write for the item
+        return not self.dedup.add(key)
+
+    def get_publish_time(self, url) -> Optional[float]:
+        # epoch seconds, from a `publish_time` entry of dict items by default
+        value = url.get('publish_time') if isinstance(url, dict) else None
+        if isinstance(value, str):
+            # a datetime as the frontier stores it
+            try:
+                value = datetime.datetime.fromisoformat(value)
+            except ValueError:
+                return None
+        if isinstance(value, datetime.datetime):
+            return value.timestamp()
+        return value
 
-    async def craw_urls(self, url_list):
-        tasks = []
-        for url in url_list:
-            if self.stop_signal:
-                raise InterruptedError
-            task = asyncio.create_task(self.craw_one(url))
-            tasks.append(task)
-        results = await asyncio.gather(*tasks)
-        return results
-
-    async def get_url_list(self, *args, **kwargs) -> Iterable[str]:
+    def get_page_num(self, url) -> Optional[int]:
+        # the list page an item was found on, from a `page_num` entry by default
+        return url.get('page_num') if isinstance(url, dict) else None
+
+    def get_priority(self, url) -> float:
+        # items of earlier runs age from their discovery, not from now
+        attempts, discovered_time = 0, None
+        if self.frontier is not None:
+            attempts, discovered_time = self.frontier.get_progress(self.get_item_key(url))
+        return self.priority.score(self.get_publish_time(url), self.get_page_num(url), attempts, discovered_time)
+
+    def iter_craw_urls(self, url_list) -> AsyncIterator[Tuple[object, object]]:
+        kwargs = {}
+        if self.priority is not None:
+            kwargs = {"priority_func": self.get_priority, "host_penalty": self.priority.host_penalty}
+        if self.frontier is None:
+            return self.scheduler.run(url_list, self.craw_traced, return_exceptions=True, **kwargs)
+        return self.scheduler.run(self.iter_frontier(url_list), self.craw_tracked, return_exceptions=True, **kwargs)
+
+    async def iter_frontier(self, url_list) -> AsyncIterator[object]:
+        if self.priority is not None:
+            async for url in self.iter_frontier_by_priority(url_list):
+                yield url
+            return
+        # first whatever an earlier run left unfinished, then the new discoveries
+        for url in self.frontier.iter_pending():
+            yield url
+        if hasattr(url_list, '__aiter__'):
+            async for url in url_list:
+                if self.frontier.add(self.get_item_key(url), url):
+                    yield url
+        else:
+            for url in url_list:
+                if self.frontier.add(self.get_item_key(url), url):
+                    yield url
+
+    async def iter_frontier_by_priority(self, url_list) -> AsyncIterator[object]:
+        # unfinished items of earlier runs only fill in while no discovery is
+        # ready, and the scheduler's heap still puts fresher items first, so
+        # a backlog of retries never holds back what was just published
+        discovered = asyncio.Queue(maxsize=self.scheduler.queue_size)
+        errors = []
+        discovery = asyncio.ensure_future(self.discover(url_list, discovered, errors))
+        pending = self.frontier.iter_pending()
+        try:
+            while True:
+                if discovered.empty():
+                    url = next(pending, _END)
+                    if url is not _END:
+                        yield url
+                        continue
+                url = await discovered.get()
+                if url is _END:
+                    break
+                yield url
+            for url in pending:
+                yield url
+        finally:
+            discovery.cancel()
+            await asyncio.gather(discovery, return_exceptions=True)
+        if errors:
+            raise errors[0]
+
+    async def discover(self, url_list, discovered: asyncio.Queue, errors: list):
+        try:
+            if hasattr(url_list, '__aiter__'):
+                async for url in url_list:
+                    if self.frontier.add(self.get_item_key(url), url, self.get_priority(url)):
+                        await discovered.put(url)
+            else:
+                for url in url_list:
+                    if self.frontier.add(self.get_item_key(url), url, self.get_priority(url)):
+                        await discovered.put(url)
+        except asyncio.CancelledError:
+            raise
+        except BaseException as err:
+            errors.append(err)
+        await discovered.put(_END)
+
+    async def craw_tracked(self, url) -> object:
+        key = self.get_item_key(url)
+        self.frontier.mark(key, FrontierState.IN_FLIGHT)
+        try:
+            result = await self.craw_traced(url)
+        except Exception:
+            self.frontier.mark(key, FrontierState.FAILED)
+            raise
+        self.frontier.mark(key, FrontierState.FAILED if result is False else FrontierState.DONE)
+        return result
+
+    async def craw_traced(self, url) -> object:
+        # the root span of sampled items, their stages are timed where they run
+        if self.tracer is None:
+            return await self.craw_one(url)
+        with self.tracer.trace('craw_one', self.get_item_key(url)):
+            return await self.craw_one(url)
+
+    async def craw_urls(self, url_list) -> int:
+        num = 0
+        results = self.iter_craw_urls(url_list)
+        try:
+            async for _ in results:
+                num += 1
+        finally:
+            await results.aclose()
+        return num
+
+    def iter_pages(self, fetch_page: Callable[[int], Awaitable[object]], page_nums: Iterable[int]) -> AsyncIterator[Tuple[int, object]]:
+        return self.scheduler.run(page_nums, fetch_page)
+
+    async def paginate(
+        self,
+        fetch_page: Callable[[int], Awaitable[object]],
+        start_page_num: int = 1,
+        max_page_num: Optional[int] = None,
+        get_total: Optional[Callable[[object], Optional[int]]] = None,
+        is_empty: Callable[[object], bool] = operator.not_,
+        is_known: Optional[Callable[[object], bool]] = None,
+    ) -> AsyncIterator[Tuple[int, object]]:
+        """Yield `(page_num, result)` for list pages from `start_page_num` until
+        the real last page, capped by `max_page_num` when given.
+
+        `fetch_page` returns `None` when the page could not be fetched, e.g.
+        the retry policy's `default`, which is not an empty page: it is
+        fetched again up to `page_attempts` times, then skipped.
+
+        The first page is fetched alone: `get_total` may read the page count
+        from it, otherwise the last page is found with an exponential then
+        binary search. Either way fetching stops after `max_empty_pages`
+        consecutive empty pages, or `max_failed_pages` failed ones.
+
+        With `is_known`, telling a page that only holds items crawled before,
+        an incremental crawl stops at the first such page once every page
+        before it is done, so slower earlier pages still yield their items.
+        """
+        fetch_page = functools.partial(self.fetch_list_page, fetch_page)
+        first = await fetch_page(start_page_num)
+        if first is None:
+            raise RuntimeError(f"First list page {start_page_num} could not be fetched")
+        known = is_known is not None and is_known(first)
+        yield start_page_num, first
+        if is_empty(first):
+            logger.warning(f"First list page {start_page_num} is empty, stop paginating")
+            return
+        if known:
+            logger.info(f"First list page {start_page_num} only holds known items, stop paginating")
+            return
+
+        total = get_total(first) if get_total is not None else None
+        probed = {}
+        last_page_num = None
+        if total is not None and total > 0:
+            last_page_num = total if max_page_num is None else min(total, max_page_num)
+            logger.info(f"Total page number: {total}")
+        elif self.probe_pages:
+            last_page_num = await self.probe_last_page(fetch_page, start_page_num, max_page_num, is_empty, probed)
+            if last_page_num is not None:
+                logger.info(f"Probed last page number: {last_page_num}")
+        if last_page_num is None:
+            last_page_num = max_page_num
+
+        if last_page_num is None:
+            page_nums = itertools.count(start_page_num + 1)
+        else:
+            page_nums = range(start_page_num + 1, last_page_num + 1)
+
+        async def fetch(page_num: int) -> object:
+            # pages seen while probing are not fetched again
+            if page_num in probed:
+                return probed.pop(page_num)
+            return await fetch_page(page_num)
+
+        # pages complete out of order, so stop conditions are checked in page
+        # order; a failed page neither ends nor breaks a run of empty ones
+        done_pages = {}
+        next_page_num = start_page_num + 1
+        num_empty = 0
+        num_failed = 0
+        pages = self.iter_pages(fetch, page_nums)
+        try:
+            async for page_num, result in pages:
+                if result is None:
+                    logger.error(f"List page {page_num} could not be fetched, skipping it")
+                    done_pages[page_num] = None
+                else:
+                    # before yielding, the consumer may record the page's items
+                    known = is_known is not None and is_known(result)
+                    yield page_num, result
+                    done_pages[page_num] = (is_empty(result), known)
+                while next_page_num in done_pages:
+                    done = done_pages.pop(next_page_num)
+                    if done is None:
+                        num_failed += 1
+                    elif done[1]:
+                        logger.info(f"List page {next_page_num} only holds known items, stop paginating")
+                        return
+                    else:
+                        num_failed = 0
+                        num_empty = num_empty + 1 if done[0] else 0
+                    next_page_num += 1
+                if num_empty >= self.max_empty_pages:
+                    logger.info(f"{num_empty} consecutive empty pages before page {next_page_num}, stop paginating")
+                    return
+                if num_failed >= self.max_failed_pages:
+                    logger.error(f"{num_failed} consecutive list pages failed before page {next_page_num}, stop paginating")
+                    return
+        finally:
+            await pages.aclose()
+
+    async def fetch_list_page(self, fetch_page: Callable[[int], Awaitable[object]], page_num: int) -> object:
+        # `None` once every attempt failed
+        for attempt in range(self.page_attempts):
+            result = await fetch_page(page_num)
+            if result is not None:
+                return result
+            logger.warning(f"List page {page_num} could not be fetched (attempt {attempt + 1}/{self.page_attempts})")
+        return None
+
+    async def probe_last_page(
+        self,
+        fetch_page: Callable[[int], Awaitable[object]],
+        start_page_num: int,
+        max_page_num: Optional[int],
+        is_empty: Callable[[object], bool],
+        probed: dict
+    ) -> Optional[int]:
+        # `start_page_num` is known to hold items, about 2 * log2(pages) fetches.
+        # A page that could not be fetched gives up the search, `None`, and
+        # pages are walked until an empty run instead
+        low, high, step = start_page_num, None, 1
+        while high is None:
+            page_num = low + step
+            if max_page_num is not None and page_num >= max_page_num:
+                page_num = max_page_num
+                if page_num <= low:
+                    return low
+            result = await fetch_page(page_num)
+            if result is None:
+                logger.warning(f"Probing list page {page_num} failed, walking pages instead")
+                return None
+            probed[page_num] = result
+            if is_empty(result):
+                high = page_num
+            elif page_num == max_page_num:
+                return page_num
+            else:
+                low = page_num
+                step *= 2
+        while high - low > 1:
+            page_num = (low + high) // 2
+            result = await fetch_page(page_num)
+            if result is None:
+                logger.warning(f"Probing list page {page_num} failed, walking pages instead")
+                return None
+            probed[page_num] = result
+            if is_empty(result):
+                high = page_num
+            else:
+                low = page_num
+        return low
+
+    async def get_url_list(self, *args, **kwargs) -> Union[Iterable[str], AsyncIterator[str]]:
+        # either a coroutine returning the whole list or an async generator
+        # yielding urls as they are discovered (pipelined mode)
         raise NotImplementedError
 
     async def craw_one(self, url: str) -> object:
         raise NotImplementedError
+
+
+def _start_worker(cls, config_filepath: str):
+    cls(config_filepath).start(role='worker')
@@ -0,0 +1,119 @@
+import sys
+import asyncio
+import importlib
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from loguru import logger
+from omegaconf.omegaconf import OmegaConf
+
+from tspider.db.mongo import MongoClientPool
+from tspider.http.ratelimit import AdaptiveRateLimiter
+from tspider.http.session import SessionManager
+from tspider.utils.proxy import ProxyManager, ProxyShare
+
+
+class SharedResources:
+    """What spiders on one loop share: one connection pool, one proxy pool
+    per proxy_pool server, split fairly between the spiders using it, one
+    rate limiter, so spiders crawling the same host share its rate, and
+    one mongo client per server with one thread pool for their writes.
+
+    A spider's own `session` settings give way to the shared pool's, the
+    first spider using a proxy_pool server sets its `proxy_pool` ones and
+    the first one with a `rate_limit` section sets the limiter's; later
+    ones only add their `hosts` and `exclude_hosts`.
+    """
+
+    def __init__(self, session: Optional[dict] = None, mongo_max_workers: int = 4):
+        self.session_manager = SessionManager(**(session or {}))
+        self.mongo_pool = MongoClientPool(mongo_max_workers)
+        self.proxy_managers: Dict[Tuple[str, str], ProxyManager] = {}
+        self.rate_limiter: Optional[AdaptiveRateLimiter] = None
+
+    def get_proxy_manager(self, host: str, port: str, **kwargs) -> ProxyShare:
+        key = (host, str(port))
+        if key not in self.proxy_managers:
+            self.proxy_managers[key] = ProxyManager(host, port, session_manager=self.session_manager, **kwargs)
+        return self.proxy_managers[key].share()
+
+    def get_rate_limiter(self, hosts: Optional[Dict[str, dict]] = None, exclude_hosts: Iterable[str] = (), **kwargs) -> AdaptiveRateLimiter:
+        if self.rate_limiter is None:
+            self.rate_limiter = AdaptiveRateLimiter(hosts=hosts, **kwargs)
+        else:
+            for host, config in (hosts or {}).items():
+                self.rate_limiter.hosts.setdefault(host, config)
+        self.rate_limiter.exclude_hosts.update(exclude_hosts)
+        return self.rate_limiter
+
+    async def close(self):
+        # after every spider closed, they flush their writes on close
+        for proxy_manager in self.proxy_managers.values():
+            await proxy_manager.close()
+        self.mongo_pool.close()
+        await self.session_manager.close()
+
+    def __str__(self) -> str:
+        return f"<SharedResources: {len(self.proxy_managers)} proxy pools, {self.mongo_pool}>"
+
+    def __repr__(self) -> str:
+        return self.__str__()
+
+
+def load_spider_class(config_filepath: str):
+    # `spider: hebeieb.HebeiebBidCallSpider`, importable from the config's directory
+    config = OmegaConf.load(config_filepath)
+    if config.get('spider') is None:
+        raise ValueError(f"{config_filepath} has no `spider` entry, e.g. `spider: module.SpiderClass`")
+    module_name, _, class_name = config.spider.rpartition('.')
+    directory = str(Path(config_filepath).resolve().parent)
+    if directory not in sys.path:
+        sys.path.insert(0, directory)
+    return getattr(importlib.import_module(module_name), class_name)
+
+
+class SpiderRunner:
+    """Runs several spiders at the same time on one event loop with
+    `SharedResources`, instead of one process per site.
+
+    Spider classes take the resources as `resources=`, so subclasses
+    overriding `__init__` must pass keyword arguments on to `SpiderBase`.
+    A failing spider is logged and does not stop the others.
+    """
+
+    def __init__(self, config_filepaths: Iterable[str], session: Optional[dict] = None, mongo_max_workers: int = 4):
+        self.resources = SharedResources(session, mongo_max_workers)
+        self.spiders = [
+            load_spider_class(config_filepath)(config_filepath, resources=self.resources)
+            for config_filepath in config_filepaths
+        ]
+
+    def start(self, role: Optional[str] = None) -> bool:
+        return asyncio.run(self.run(role))
+
+    async def run(self, role: Optional[str] = None) -> bool:
+        try:
+            results = await asyncio.gather(
+                *[spider.main(role=role) for spider in self.spiders],
+                return_exceptions=True
+            )
+        finally:
+            await self.resources.close()
+        failed: List[str] = []
+        for spider, result in zip(self.spiders, results):
+            if isinstance(result, BaseException):
+                logger.opt(exception=result).error(f"Spider {spider.name} failed")
+                failed.append(spider.name)
+        if failed:
+            logger.error(f"Failed spiders: {failed}")
+        return not failed
+
+    def stop(self):
+        for spider in self.spiders:
+            spider.stop()
+
+    def __str__(self) -> str:
+        return f"<SpiderRunner: {[spider.name for spider in self.spiders]}>"
+
+    def __repr__(self) -> str:
+        return self.__str__()
@@ -0,0 +1,294 @@
+import time
+import heapq
+import asyncio
+import itertools
+import collections
+import urllib.parse
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, Optional, Tuple
+
+from loguru import logger
+
+
+_DONE = object()
+
+
+def get_domain(item) -> Optional[str]:
+    if isinstance(item, dict):
+        item = item.get('url')
+    if isinstance(item, str) and '://' in item:
+        return urllib.parse.urlparse(item).netloc
+    return None
+
+
+class PriorityPolicy:
+    """Scores items in days of age, lower is crawled sooner.
+
+    An item is as old as its publish time, or as its discovery when it
+    has none, plus `page_weight` per list page it was found on and
+    `retry_penalty` per failed attempt, so retried failures fall behind
+    fresh items without being dropped. `host_penalty` is added per item of
+    the same host already queued, see `PriorityQueue`.
+    """
+
+    def __init__(self, page_weight: float = 0.1, retry_penalty: float = 1.0, host_penalty: float = 0.05):
+        self.page_weight = page_weight
+        self.retry_penalty = retry_penalty
+        self.host_penalty = host_penalty
+
+    def score(
+        self,
+        publish_time: Optional[float] = None,
+        page_num: Optional[int] = None,
+        attempts: int = 0,
+        discovered_time: Optional[float] = None
+    ) -> float:
+        # times in epoch seconds; the score is absolute, ages relative to
+        # any fixed now would order items the same. Without a discovery
+        # time the item is taken as discovered just now
+        if publish_time is None:
+            publish_time = discovered_time if discovered_time is not None else time.time()
+        score = -publish_time / 86400.0 + self.retry_penalty * attempts
+        if page_num is not None:
+            score += self.page_weight * page_num
+        return score
+
+    def __str__(self) -> str:
+        return (
+            f"<PriorityPolicy: page_weight={self.page_weight}, "
+            f"retry_penalty={self.retry_penalty}, host_penalty={self.host_penalty}>"
+        )
+
+    def __repr__(self) -> str:
+        return self.__str__()
+
+
+class PriorityQueue(asyncio.Queue):
+    # a heap keyed by `priority_func(item)`, O(log n) per put and get, ties
+    # in discovery order. While several hosts are queued, the n-th queued item
+    # of a host gets `host_penalty * n` more, so a host flooding the queue does
+    # not hold back the others; items without a host are never penalized.
+    def __init__(
+        self,
+        maxsize: int = 0,
+        priority_func: Callable[[Any], float] = lambda item: 0.0,
+        domain_func: Callable[[Any], Optional[str]] = get_domain,
+        host_penalty: float = 0.0
+    ):
+        self.priority_func = priority_func
+        self.domain_func = domain_func
+        self.host_penalty = host_penalty
+        super().__init__(maxsize)
+
+    def _init(self, maxsize: int):
+        self._queue = []
+        self._counter = itertools.count()
+        self._host_queued: Dict[Optional[str], int] = {}
+
+    def _put(self, item):
+        if item is _DONE:
+            # after every item, whatever their scores
+            heapq.heappush(self._queue, (float('inf'), next(self._counter), None, item))
+            return
+        host = self.domain_func(item)
+        priority = self.priority_func(item)
+        if host is not None:
+            queued = self._host_queued.get(host, 0)
+            self._host_queued[host] = queued + 1
+            if len(self._host_queued) > 1:
+                priority += self.host_penalty * queued
+        heapq.heappush(self._queue, (priority, next(self._counter), host, item))
+
+    def _get(self):
+        _, _, host, item = heapq.heappop(self._queue)
+        if item is not _DONE and host is not None:
+            queued = self._host_queued[host] - 1
+            if queued:
+                self._host_queued[host] = queued
+            else:
+                del self._host_queued[host]
+        return item
+
+
+class _Deferred:
+    # items of full domains set aside by the workers of one `run`, each
+    # taken by the next of those workers to finish an item of its domain
+    def __init__(self):
+        self.items: Dict[asyncio.Semaphore, collections.deque] = {}
+        # workers of the run on each domain, running or waiting for a slot
+        self.active: Dict[asyncio.Semaphore, int] = collections.Counter()
+
+    def __len__(self) -> int:
+        return sum(map(len, self.items.values()))
+
+
+class Scheduler:
+    def __init__(
+        self,
+        concurrency: int = 16,
+        per_domain_concurrency: Optional[int] = None,
+        domain_concurrency: Optional[Dict[str, int]] = None,
+        queue_size: Optional[int] = None,
+        domain_func: Callable[[Any], Optional[str]] = get_domain,
+    ):
+        self.concurrency = concurrency
+        self.per_domain_concurrency = per_domain_concurrency
+        self.domain_concurrency = dict(domain_concurrency or {})
+        self.queue_size = queue_size or concurrency * 2
+        self.domain_func = domain_func
+
+        self.in_flight = 0
+        self.stop_signal = False
+        self._queues = []
+        self._domain_semaphores: Dict[str, asyncio.Semaphore] = {}
+        # items of full domains set aside by `_work`, over every running `run`
+        self._num_deferred = 0
+
+    @property
+    def queued(self) -> int:
+        # items waiting for a free worker, over every running `run`
+        return sum(queue.qsize() for queue in self._queues) + self._num_deferred
+
+    def stop(self):
+        self.stop_signal = True
+
+    def get_domain_semaphore(self, item) -> Optional[asyncio.Semaphore]:
+        domain = self.domain_func(item)
+        if domain is None:
+            return None
+        if domain not in self._domain_semaphores:
+            limit = self.domain_concurrency.get(domain, self.per_domain_concurrency)
+            if limit is None:
+                return None
+            self._domain_semaphores[domain] = asyncio.Semaphore(limit)
+        return self._domain_semaphores[domain]
+
+    async def run(
+        self,
+        items,
+        worker: Callable[[Any], Awaitable[Any]],
+        return_exceptions: bool = False,
+        priority_func: Optional[Callable[[Any], float]] = None,
+        host_penalty: float = 0.0
+    ) -> AsyncIterator[Tuple[Any, Any]]:
+        """Run `worker` over `items` (an iterable or async iterable) and yield
+        `(item, result)` pairs as they complete.
+
+        At most `concurrency` workers run at a time and at most `queue_size`
+        items are buffered on either side, so memory does not grow with the
+        number of items and a slow consumer holds back the producer.
+        With `priority_func`, buffered items are started lowest score first
+        rather than in order, see `PriorityQueue`.
+        """
+        if priority_func is None:
+            queue = asyncio.Queue(maxsize=self.queue_size)
+        else:
+            queue = PriorityQueue(self.queue_size, priority_func, self.domain_func, host_penalty)
+        results = asyncio.Queue(maxsize=self.queue_size)
+        producer_errors = []
+        self._queues.append(queue)
+        producer = asyncio.create_task(self._produce(items, queue, producer_errors))
+        deferred = _Deferred()
+        workers = [
+            asyncio.create_task(self._work(queue, deferred, results, worker, return_exceptions))
+            for _ in range(self.concurrency)
+        ]
+        try:
+            finished = 0
+            while finished < len(workers):
+                result = await results.get()
+                if result is _DONE:
+                    finished += 1
+                    continue
+                if isinstance(result, BaseException):
+                    raise result
+                yield result
+            if producer_errors:
+                raise producer_errors[0]
+        finally:
+            self._queues.remove(queue)
+            self._num_deferred -= len(deferred)
+            for task in [producer, *workers]:
+                task.cancel()
+            await asyncio.gather(producer, *workers, return_exceptions=True)
+
+    async def _produce(self, items, queue: asyncio.Queue, errors: list):
+        try:
+            if hasattr(items, '__aiter__'):
+                async for item in items:
+                    if self.stop_signal:
+                        raise InterruptedError
+                    await queue.put(item)
+            else:
+                for item in items:
+                    if self.stop_signal:
+                        raise InterruptedError
+                    await queue.put(item)
+        except asyncio.CancelledError:
+            raise
+        except BaseException as err:
+            errors.append(err)
+        for _ in range(self.concurrency):
+            await queue.put(_DONE)
+
+    async def _work(self, queue: asyncio.Queue, deferred: _Deferred, results: asyncio.Queue, worker, return_exceptions: bool):
+        while True:
+            item = await queue.get()
+            if item is _DONE:
+                await results.put(_DONE)
+                return
+            semaphore = self.get_domain_semaphore(item)
+            if (
+                semaphore is not None and semaphore.locked() and deferred.active[semaphore]
+                and self._num_deferred < self.queue_size
+            ):
+                # rather than holding this worker while other domains wait,
+                # the item goes to a worker of this run already on its domain
+                deferred.items.setdefault(semaphore, collections.deque()).append(item)
+                self._num_deferred += 1
+                continue
+            while item is not None:
+                if not await self._work_one(item, semaphore, deferred, results, worker, return_exceptions):
+                    return
+                item = self._pop_deferred(deferred, semaphore)
+
+    async def _work_one(self, item, semaphore, deferred: _Deferred, results: asyncio.Queue, worker, return_exceptions: bool) -> bool:
+        # `False` once an error ends the run
+        self.in_flight += 1
+        if semaphore is not None:
+            deferred.active[semaphore] += 1
+        try:
+            if semaphore is None:
+                result = await worker(item)
+            else:
+                async with semaphore:
+                    result = await worker(item)
+        except asyncio.CancelledError:
+            raise
+        except Exception as err:
+            if not return_exceptions:
+                await results.put(err)
+                return False
+            logger.error(f"{type(err).__name__} on {item}: {err}")
+            result = err
+        finally:
+            self.in_flight -= 1
+            if semaphore is not None:
+                deferred.active[semaphore] -= 1
+        await results.put((item, result))
+        return True
+
+    def _pop_deferred(self, deferred: _Deferred, semaphore: Optional[asyncio.Semaphore]):
+        items = deferred.items.get(semaphore)
+        if not items:
+            return None
+        self._num_deferred -= 1
+        item = items.popleft()
+        if not items:
+            del deferred.items[semaphore]
+        return item
+
+    def __str__(self) -> str:
+        return f"<Scheduler: concurrency={self.concurrency}, in_flight={self.in_flight}>"
+
+    def __repr__(self) -> str:
+        return self.__str__()
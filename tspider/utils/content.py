@@ -1,5 +1,133 @@
+import re
+import functools
+import threading
+from typing import Any, Dict, List, Optional
+
+from lxml import etree
+
+
+_local = threading.local()
+
+
 def extract_first_string(obj):
     if len(obj) >= 1:
         return obj[0].strip()
     else:
         return ""
+
+
+# every expression is compiled once per process, however many fields,
+# spiders or pages use it
+@functools.lru_cache(maxsize=None)
+def compile_xpath(path: str) -> etree.XPath:
+    # plain strings instead of "smart" ones, which keep their whole tree alive
+    return etree.XPath(path, smart_strings=False)
+
+
+@functools.lru_cache(maxsize=None)
+def compile_regex(pattern: str, flags: int = 0) -> re.Pattern:
+    return re.compile(pattern, flags)
+
+
+def get_html_parser(encoding: Optional[str] = None) -> etree.HTMLParser:
+    # lxml parsers must not be shared between threads
+    parsers = getattr(_local, 'parsers', None)
+    if parsers is None:
+        parsers = _local.parsers = {}
+    if encoding not in parsers:
+        parsers[encoding] = etree.HTMLParser(encoding=encoding)
+    return parsers[encoding]
+
+
+def parse_html(content: bytes, encoding: Optional[str] = None):
+    return etree.HTML(content, get_html_parser(encoding))
+
+
+class Field:
+    """One value of an item, taken with an XPath or a regex.
+
+    mode:
+        first: the first match or `default`
+        all: a list of every match
+        join: every match joined with `sep`
+    """
+
+    def __init__(
+        self,
+        xpath: Optional[str] = None,
+        regex: Optional[str] = None,
+        mode: str = 'first',
+        strip: bool = True,
+        sep: str = '',
+        default: Any = None,
+        group: int = 1,
+        flags: int = 0
+    ):
+        if (xpath is None) == (regex is None):
+            raise ValueError("Field takes either `xpath` or `regex`")
+        if mode not in ('first', 'all', 'join'):
+            raise ValueError(f"Unknown field mode: {mode}")
+        self.xpath = compile_xpath(xpath) if xpath is not None else None
+        self.regex = compile_regex(regex, flags) if regex is not None else None
+        self.mode = mode
+        self.strip = strip
+        self.sep = sep
+        self.default = default
+        self.group = group
+
+    def extract(self, node) -> Any:
+        # `node` is an element, regex fields also take plain text
+        if self.xpath is not None:
+            values = self.xpath(node)
+            if not isinstance(values, list):
+                # string(), count() and friends evaluate to a single value
+                values = [values]
+        else:
+            text = node if isinstance(node, str) else ''.join(node.itertext())
+            if self.mode == 'first':
+                matched = self.regex.search(text)
+                values = [matched.group(self.group)] if matched is not None else []
+            else:
+                values = [matched.group(self.group) for matched in self.regex.finditer(text)]
+        if self.strip:
+            values = [value.strip() if isinstance(value, str) else value for value in values]
+        if self.mode == 'all':
+            return values
+        if self.mode == 'join':
+            return self.sep.join(values)
+        return values[0] if values else self.default
+
+    def __str__(self) -> str:
+        expression = self.xpath.path if self.xpath is not None else self.regex.pattern
+        return f"<Field: {expression}, mode={self.mode}>"
+
+    def __repr__(self) -> str:
+        return self.__str__()
+
+
+class Extractor:
+    """A schema of named `Field`s. With `root`, every node it matches is one
+    item and fields are evaluated relative to it, so a list page is walked
+    once instead of once per field.
+
+    Define extractors at module level, next to the parse functions using
+    them, so worker processes compile them once on import.
+    """
+
+    def __init__(self, fields: Dict[str, Field], root: Optional[str] = None):
+        self.fields = fields
+        self.root = compile_xpath(root) if root is not None else None
+
+    def extract(self, node) -> dict:
+        return {name: field.extract(node) for name, field in self.fields.items()}
+
+    def extract_all(self, node) -> List[dict]:
+        if self.root is None:
+            return [self.extract(node)]
+        return [self.extract(item) for item in self.root(node)]
+
+    def __str__(self) -> str:
+        return f"<Extractor: {list(self.fields)}>"
+
+    def __repr__(self) -> str:
+        return self.__str__()
@@ -0,0 +1,148 @@
+import math
+import struct
+import hashlib
+import sqlite3
+from pathlib import Path
+from typing import Iterator, Optional, Set, Union
+
+from loguru import logger
+
+
+BLOOM_HEADER = struct.Struct('<QI')
+
+
+class BloomFilter:
+    # `capacity` keys at `error_rate` take about 1.44 * log2(1 / error_rate)
+    # bits each, ~1.8MB per million keys at 0.1%
+    def __init__(self, capacity: int, error_rate: float = 0.001):
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.num_bits = max(8, int(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.num_hashes = max(1, round(self.num_bits / capacity * math.log(2)))
+        self.bits = bytearray((self.num_bits + 7) // 8)
+
+    def add(self, key: str):
+        for position in self._positions(key):
+            self.bits[position >> 3] |= 1 << (position & 7)
+
+    def __contains__(self, key: str) -> bool:
+        return all(self.bits[position >> 3] & (1 << (position & 7)) for position in self._positions(key))
+
+    def save(self, path: Path):
+        with path.open('wb') as fout:
+            fout.write(BLOOM_HEADER.pack(self.num_bits, self.num_hashes))
+            fout.write(self.bits)
+
+    def load(self, path: Path) -> bool:
+        with path.open('rb') as fin:
+            header = fin.read(BLOOM_HEADER.size)
+            if len(header) != BLOOM_HEADER.size or BLOOM_HEADER.unpack(header) != (self.num_bits, self.num_hashes):
+                return False
+            bits = fin.read()
+        if len(bits) != len(self.bits):
+            return False
+        self.bits = bytearray(bits)
+        return True
+
+    def _positions(self, key: str) -> Iterator[int]:
+        # double hashing, k positions out of a single blake2b digest
+        digest = hashlib.blake2b(key.encode(), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:], 'little') | 1
+        for i in range(self.num_hashes):
+            yield (h1 + i * h2) % self.num_bits
+
+    def __str__(self) -> str:
+        return f"<BloomFilter: bits={self.num_bits}, hashes={self.num_hashes}>"
+
+    def __repr__(self) -> str:
+        return self.__str__()
+
+
+class DedupIndex:
+    # a Bloom filter in front of an exact SQLite set: unseen keys, the common
+    # case while discovering, are answered from memory, only possible
+    # duplicates are looked up on disk. Without `path` it lives for one run.
+    def __init__(
+        self,
+        path: Optional[Union[str, Path]] = None,
+        capacity: int = 1000000,
+        error_rate: float = 0.001,
+        batch_size: int = 1000
+    ):
+        self.path = Path(path) if path is not None else None
+        self.batch_size = batch_size
+        self.bloom = BloomFilter(capacity, error_rate)
+
+        self.conn = sqlite3.connect(str(self.path) if self.path is not None else ':memory:', isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS seen (key TEXT PRIMARY KEY) WITHOUT ROWID")
+        # keys not written yet, flushed in one transaction per batch
+        self._pending: Set[str] = set()
+
+        self._load_bloom()
+
+    @property
+    def bloom_path(self) -> Optional[Path]:
+        return self.path.with_suffix('.bloom') if self.path is not None else None
+
+    def __contains__(self, key: str) -> bool:
+        # a Bloom filter has no false negatives
+        return key in self.bloom and self._contains_exact(key)
+
+    def __len__(self) -> int:
+        return self.conn.execute("SELECT COUNT(*) FROM seen").fetchone()[0] + len(self._pending)
+
+    def add(self, key: str) -> bool:
+        # True when `key` was not seen before
+        if key in self:
+            return False
+        self.bloom.add(key)
+        self._pending.add(key)
+        if len(self._pending) >= self.batch_size:
+            self.flush()
+        return True
+
+    def flush(self):
+        if not self._pending:
+            return
+        pending, self._pending = self._pending, set()
+        self.conn.execute("BEGIN")
+        self.conn.executemany("INSERT OR IGNORE INTO seen (key) VALUES (?)", ((key,) for key in pending))
+        self.conn.execute("COMMIT")
+
+    def close(self):
+        self.flush()
+        if self.bloom_path is not None:
+            self.bloom.save(self.bloom_path)
+        self.conn.close()
+
+    def _contains_exact(self, key: str) -> bool:
+        if key in self._pending:
+            return True
+        return self.conn.execute("SELECT 1 FROM seen WHERE key = ?", (key,)).fetchone() is not None
+
+    def _load_bloom(self):
+        bloom_path = self.bloom_path
+        if bloom_path is None:
+            return
+        if bloom_path.exists():
+            loaded = self.bloom.load(bloom_path)
+            # only a clean close leaves a filter behind, after a crash it
+            # would miss the last keys and is rebuilt instead
+            bloom_path.unlink()
+            if loaded:
+                return
+        num = 0
+        for key, in self.conn.execute("SELECT key FROM seen"):
+            self.bloom.add(key)
+            num += 1
+        if num > 0:
+            logger.info(f"Rebuilt dedup filter from {num} keys in {self.path}")
+
+    def __str__(self) -> str:
+        return f"<DedupIndex: {self.path or ':memory:'}>"
+
+    def __repr__(self) -> str:
+        return self.__str__()
@@ -0,0 +1,314 @@
+import os
+import re
+import json
+import uuid
+import shutil
+import asyncio
+import hashlib
+from pathlib import Path
+from typing import NamedTuple, Optional, Union
+
+import aiohttp
+from loguru import logger
+
+from tspider.http.cache import CachedResponse
+from tspider.utils.tracing import span
+
+
+CONTENT_RANGE_PATTERN = re.compile(r'bytes (\d+)-\d+/(\d+|\*)')
+
+
+class SavedFile(NamedTuple):
+    filename: str
+    filepath: Path
+    digest: str
+    size: int
+    blob_path: Optional[Path] = None
+    # where the record starts in `filepath`, for segments
+    offset: Optional[int] = None
+
+
+class StreamingSink:
+    # streams response bodies into `directory` chunk by chunk, so memory per
+    # download is bounded by `chunk_size` and disk writes stay off the loop.
+    # Downloads saved under a `key` keep their `.part` file and a checkpoint
+    # when interrupted, and are resumed with a `Range` request next time.
+    def __init__(
+        self,
+        directory: Union[str, Path],
+        chunk_size: int = 64 * 1024,
+        hash_name: str = 'sha256',
+        resume: bool = True,
+        checkpoint_interval: int = 1024 * 1024
+    ):
+        self.directory = Path(directory)
+        self.chunk_size = chunk_size
+        self.hash_name = hash_name
+        self.resume = resume
+        self.checkpoint_interval = checkpoint_interval
+        # a counter by host, set by the spider's metrics
+        self.received_bytes = None
+
+    def get_part_path(self, key: Optional[str] = None) -> Path:
+        key = key.replace('/', '_') if key else uuid.uuid4().hex
+        return self.directory.joinpath(f".{key}.part")
+
+    def get_checkpoint_path(self, key: str) -> Path:
+        return self.get_part_path(key).with_suffix('.part.json')
+
+    def get_resume_headers(self, key: str) -> dict:
+        # for every download under `key`, they override the spider's headers:
+        # offsets count the bytes written, which are the bytes on the wire
+        # only without compression
+        if not self.resume:
+            return {}
+        headers = {"Accept-Encoding": "identity"}
+        checkpoint = self._load_checkpoint(key)
+        if checkpoint is None:
+            return headers
+        total = checkpoint.get('total')
+        offset = checkpoint['offset']
+        if offset <= 0 or (total is not None and offset >= total):
+            return headers
+        validator = checkpoint.get('etag') or checkpoint.get('last_modified')
+        if validator is None and total is None:
+            # nothing to tell whether the remote file changed since
+            return headers
+        headers["Range"] = f"bytes={offset}-"
+        if validator is not None:
+            headers["If-Range"] = validator
+        return headers
+
+    def check_range(self, response, key: str):
+        # call before `raise_for_status`, a stale `.part` file restarts from zero
+        if response.status == 416:
+            self.discard(key)
+            raise aiohttp.ClientPayloadError(f"Range not satisfiable for {key}, restarting download")
+
+    def discard(self, key: str):
+        self.get_part_path(key).unlink(missing_ok=True)
+        self.get_checkpoint_path(key).unlink(missing_ok=True)
+
+    async def save(self, response, filename: str, key: Optional[str] = None) -> SavedFile:
+        # streaming the body, so this is the download time of the response
+        with span('sink.save', filename=filename):
+            return await self._save(response, filename, key)
+
+    async def _save(self, response, filename: str, key: Optional[str]) -> SavedFile:
+        loop = asyncio.get_event_loop()
+        # a server compressing anyway can't be resumed, see `get_resume_headers`
+        resumable = self.resume and key is not None and 'Content-Encoding' not in response.headers
+        part_path = self.get_part_path(key)
+        hasher = hashlib.new(self.hash_name)
+        offset, total = self._get_range(response, key)
+        if offset > 0:
+            fout = await loop.run_in_executor(None, self._open_resumed, part_path, hasher, offset)
+        else:
+            fout = await loop.run_in_executor(None, part_path.open, 'wb')
+        checkpoint = {
+            "url": str(response.url),
+            "offset": offset,
+            "total": total,
+            "etag": response.headers.get('ETag'),
+            "last_modified": response.headers.get('Last-Modified'),
+        }
+        size = offset
+        unsaved = 0
+        # aiohttp's trace hooks only see bodies taken with `read()`, cached
+        # responses were read that way
+        received_bytes = self.received_bytes if not isinstance(response, CachedResponse) else None
+        try:
+            async for chunk in response.content.iter_chunked(self.chunk_size):
+                if received_bytes is not None:
+                    received_bytes.inc(response.url.host, amount=len(chunk))
+                await loop.run_in_executor(None, self._write, fout, hasher, chunk)
+                size += len(chunk)
+                unsaved += len(chunk)
+                if resumable and unsaved >= self.checkpoint_interval:
+                    checkpoint["offset"] = size
+                    await loop.run_in_executor(None, self._write_checkpoint, fout, key, checkpoint)
+                    unsaved = 0
+        except BaseException:
+            if resumable:
+                checkpoint["offset"] = size
+                self._write_checkpoint(fout, key, checkpoint)
+                fout.close()
+            else:
+                fout.close()
+                part_path.unlink()
+            raise
+        fout.close()
+        if key is not None:
+            # also a stale one, when the server answered with the whole file
+            self.get_checkpoint_path(key).unlink(missing_ok=True)
+        return await self.commit(part_path, filename, hasher.hexdigest(), size, key=key, response=response)
+
+    async def save_bytes(self, content: bytes, filename: str, key: Optional[str] = None, response=None) -> SavedFile:
+        # `response` is what `content` was extracted from, kept by sinks storing responses
+        loop = asyncio.get_event_loop()
+        part_path = self.get_part_path(key)
+        hasher = hashlib.new(self.hash_name)
+        with span('sink.save_bytes', filename=filename):
+            await loop.run_in_executor(None, self._write_file, part_path, hasher, content)
+            return await self.commit(part_path, filename, hasher.hexdigest(), len(content), key=key)
+
+    async def commit(self, part_path: Path, filename: str, digest: str, size: int, key: Optional[str] = None, response=None) -> SavedFile:
+        # the rename is atomic, readers never see a partially written file
+        filepath = self.directory.joinpath(filename)
+        part_path.replace(filepath)
+        return SavedFile(filename, filepath, digest, size)
+
+    def _get_range(self, response, key: Optional[str]):
+        # lengths and ranges of compressed responses count compressed bytes
+        encoded = 'Content-Encoding' in response.headers
+        if response.status != 206:
+            total = response.headers.get('Content-Length')
+            return 0, int(total) if total is not None and not encoded else None
+        if encoded:
+            if key is not None:
+                self.discard(key)
+            raise aiohttp.ClientPayloadError(f"Compressed range response for {key}, restarting download")
+        content_range = response.headers.get('Content-Range', '')
+        matched = CONTENT_RANGE_PATTERN.match(content_range)
+        checkpoint = self._load_checkpoint(key) if key is not None else None
+        if matched is None or checkpoint is None or int(matched.group(1)) != checkpoint['offset']:
+            if key is not None:
+                self.discard(key)
+            raise aiohttp.ClientPayloadError(f"Unexpected Content-Range {content_range!r} for {key}")
+        total = matched.group(2)
+        return int(matched.group(1)), int(total) if total != '*' else checkpoint.get('total')
+
+    def _load_checkpoint(self, key: str) -> Optional[dict]:
+        checkpoint_path = self.get_checkpoint_path(key)
+        part_path = self.get_part_path(key)
+        if not self.resume or not checkpoint_path.exists() or not part_path.exists():
+            return None
+        try:
+            checkpoint = json.loads(checkpoint_path.read_text())
+        except ValueError:
+            return None
+        # never trust more bytes than actually reached the disk
+        checkpoint['offset'] = min(checkpoint.get('offset', 0), part_path.stat().st_size)
+        return checkpoint
+
+    def _write_checkpoint(self, fout, key: str, checkpoint: dict):
+        fout.flush()
+        checkpoint_path = self.get_checkpoint_path(key)
+        temp_path = checkpoint_path.with_suffix('.tmp')
+        temp_path.write_text(json.dumps(checkpoint))
+        temp_path.replace(checkpoint_path)
+
+    def _open_resumed(self, part_path: Path, hasher, offset: int):
+        fout = part_path.open('r+b')
+        fout.truncate(offset)
+        # re-hash the bytes already on disk, cheaper than fetching them again
+        while True:
+            chunk = fout.read(self.chunk_size)
+            if not chunk:
+                break
+            hasher.update(chunk)
+        return fout
+
+    def close(self):
+        pass
+
+    @staticmethod
+    def _write(fout, hasher, chunk: bytes):
+        hasher.update(chunk)
+        fout.write(chunk)
+
+    @staticmethod
+    def _write_file(path: Path, hasher, content: bytes):
+        hasher.update(content)
+        with path.open('wb') as fout:
+            fout.write(content)
+
+    def __str__(self) -> str:
+        return f"<StreamingSink: {self.directory}>"
+
+    def __repr__(self) -> str:
+        return self.__str__()
+
+
+class ContentAddressedSink(StreamingSink):
+    """Stores every distinct content once, under `blobs/ab/cd/<digest>`, and
+    gives it its friendly filename with a link.
+
+    link:
+        hardlink: a hard link, falls back to a copy across file systems
+        symlink: a relative symbolic link
+        copy: a full copy
+        none: no friendly name, `filepath` is the blob itself
+    """
+
+    def __init__(self, directory: Union[str, Path], link: str = 'hardlink', **kwargs):
+        if link not in ('hardlink', 'symlink', 'copy', 'none'):
+            raise ValueError(f"Unknown link mode: {link}")
+        super().__init__(directory, **kwargs)
+        self.link = link
+        self.blob_directory = self.directory.joinpath('blobs')
+
+    def get_blob_path(self, digest: str) -> Path:
+        # two levels of 256 shards keep directories small
+        return self.blob_directory.joinpath(digest[:2], digest[2:4], digest)
+
+    async def commit(self, part_path: Path, filename: str, digest: str, size: int, key: Optional[str] = None, response=None) -> SavedFile:
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(None, self._commit, part_path, filename, digest, size)
+
+    def _commit(self, part_path: Path, filename: str, digest: str, size: int) -> SavedFile:
+        blob_path = self.get_blob_path(digest)
+        if blob_path.exists():
+            # the content is already stored, the streamed copy is dropped
+            part_path.unlink()
+            logger.info(f"Blob {digest} exists, skip writing {filename}")
+        else:
+            blob_path.parent.mkdir(parents=True, exist_ok=True)
+            part_path.replace(blob_path)
+        if self.link == 'none':
+            return SavedFile(filename, blob_path, digest, size, blob_path)
+        filepath = self.get_link_path(filename, blob_path, digest)
+        if not filepath.exists():
+            self._link(blob_path, filepath)
+        return SavedFile(filepath.name, filepath, digest, size, blob_path)
+
+    def get_link_path(self, filename: str, blob_path: Path, digest: str) -> Path:
+        # a different document with the same name gets the short digest appended
+        filepath = self.directory.joinpath(filename)
+        if filepath.exists() and not self._same_file(filepath, blob_path):
+            filepath = filepath.with_name(f"{filepath.stem}.{digest[:8]}{filepath.suffix}")
+        return filepath
+
+    def _same_file(self, filepath: Path, blob_path: Path) -> bool:
+        if self.link == 'symlink':
+            return filepath.is_symlink() and filepath.resolve() == blob_path.resolve()
+        if self.link == 'hardlink' and filepath.samefile(blob_path):
+            return True
+        # copies, including hard links that fell back to a copy
+        return filepath.stat().st_size == blob_path.stat().st_size and self._hash_file(filepath) == blob_path.name
+
+    def _link(self, blob_path: Path, filepath: Path):
+        temp_path = filepath.with_name(f".{uuid.uuid4().hex}.link")
+        if self.link == 'symlink':
+            temp_path.symlink_to(os.path.relpath(blob_path, filepath.parent))
+        elif self.link == 'hardlink':
+            try:
+                os.link(blob_path, temp_path)
+            except OSError:
+                shutil.copyfile(blob_path, temp_path)
+        else:
+            shutil.copyfile(blob_path, temp_path)
+        temp_path.replace(filepath)
+
+    def _hash_file(self, path: Path) -> str:
+        hasher = hashlib.new(self.hash_name)
+        with path.open('rb') as fin:
+            while True:
+                chunk = fin.read(self.chunk_size)
+                if not chunk:
+                    break
+                hasher.update(chunk)
+        return hasher.hexdigest()
+
+    def __str__(self) -> str:
+        return f"<ContentAddressedSink: {self.directory}, link={self.link}>"
@@ -0,0 +1,237 @@
+import time
+import bisect
+from pathlib import Path
+from typing import Callable, Dict, Iterable, List, Optional, Tuple, Union
+
+import aiohttp
+from aiohttp import web
+
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+def _escape(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(labelnames: Tuple[str, ...], labels: tuple, extra: str = '') -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(labelnames, labels)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _format_value(value: float) -> str:
+    return str(int(value)) if float(value).is_integer() else f"{value:.6g}"
+
+
+class Counter:
+    kind = 'counter'
+
+    def __init__(self, name: str, documentation: str, labelnames: Iterable[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.values: Dict[tuple, float] = {}
+        self._last_total = 0.0
+        self._last_time = time.monotonic()
+
+    def inc(self, *labels, amount: float = 1.0):
+        self.values[labels] = self.values.get(labels, 0.0) + amount
+
+    def total(self) -> float:
+        return sum(self.values.values())
+
+    def render(self) -> List[str]:
+        return [f"{self.name}{_format_labels(self.labelnames, labels)} {_format_value(value)}" for labels, value in self.values.items()]
+
+    def summary(self) -> str:
+        now = time.monotonic()
+        total = self.total()
+        rate = (total - self._last_total) / max(now - self._last_time, 1e-9)
+        self._last_total, self._last_time = total, now
+        return f"{self.name}={_format_value(total)} ({rate:.1f}/s)"
+
+
+class Gauge:
+    kind = 'gauge'
+
+    def __init__(self, name: str, documentation: str, labelnames: Iterable[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.values: Dict[tuple, float] = {}
+        self.function: Optional[Callable[[], Union[float, Dict[tuple, float]]]] = None
+
+    def set(self, value: float, *labels):
+        self.values[labels] = value
+
+    def set_function(self, function: Callable[[], Union[float, Dict[tuple, float]]]):
+        # evaluated when collected, so hot paths pay nothing
+        self.function = function
+
+    def collect(self) -> Dict[tuple, float]:
+        if self.function is None:
+            return self.values
+        value = self.function()
+        return value if isinstance(value, dict) else {(): value}
+
+    def render(self) -> List[str]:
+        return [f"{self.name}{_format_labels(self.labelnames, labels)} {_format_value(value)}" for labels, value in self.collect().items()]
+
+    def summary(self) -> str:
+        values = self.collect()
+        if list(values) == [()]:
+            return f"{self.name}={_format_value(values[()])}"
+        return f"{self.name}={_format_value(sum(values.values()))}"
+
+
+class Histogram:
+    kind = 'histogram'
+
+    def __init__(self, name: str, documentation: str, labelnames: Iterable[str] = (), buckets: Iterable[float] = DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets))
+        # per label values: a count per bucket plus one for +Inf, and the sum
+        self.counts: Dict[tuple, List[int]] = {}
+        self.sums: Dict[tuple, float] = {}
+
+    def observe(self, value: float, *labels):
+        counts = self.counts.get(labels)
+        if counts is None:
+            counts = self.counts[labels] = [0] * (len(self.buckets) + 1)
+            self.sums[labels] = 0.0
+        counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sums[labels] += value
+
+    def quantile(self, q: float, *labels) -> Optional[float]:
+        # estimated within the bucket, across all label values when none are given
+        if labels:
+            counts = self.counts.get(labels)
+        else:
+            counts = [sum(column) for column in zip(*self.counts.values())] or None
+        if not counts or sum(counts) == 0:
+            return None
+        rank = q * sum(counts)
+        cumulative = 0
+        for i, count in enumerate(counts):
+            if count and cumulative + count >= rank:
+                lower = self.buckets[i - 1] if i > 0 else 0.0
+                upper = self.buckets[i] if i < len(self.buckets) else self.buckets[-1]
+                return lower + (upper - lower) * (rank - cumulative) / count
+            cumulative += count
+        return self.buckets[-1]
+
+    def render(self) -> List[str]:
+        lines = []
+        for labels, counts in self.counts.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += count
+                le = '+Inf' if bound == float('inf') else _format_value(bound)
+                bucket_labels = _format_labels(self.labelnames, labels, f'le="{le}"')
+                lines.append(f"{self.name}_bucket{bucket_labels} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labelnames, labels)} {_format_value(self.sums[labels])}")
+            lines.append(f"{self.name}_count{_format_labels(self.labelnames, labels)} {cumulative}")
+        return lines
+
+    def summary(self) -> str:
+        count = sum(sum(counts) for counts in self.counts.values())
+        if count == 0:
+            return f"{self.name}: n=0"
+        return f"{self.name}: n={count} p50={self.quantile(0.5):.3f} p95={self.quantile(0.95):.3f}"
+
+
+class MetricsRegistry:
+    """Counters, gauges and histograms kept in plain dicts, cheap enough for
+    hot paths, exposed in the Prometheus text format and as a log summary."""
+
+    def __init__(self):
+        self.metrics: Dict[str, Union[Counter, Gauge, Histogram]] = {}
+        self._runner: Optional[web.AppRunner] = None
+
+    def counter(self, name: str, documentation: str = '', labelnames: Iterable[str] = ()) -> Counter:
+        return self._get_or_create(Counter, name, documentation, labelnames)
+
+    def gauge(self, name: str, documentation: str = '', labelnames: Iterable[str] = ()) -> Gauge:
+        return self._get_or_create(Gauge, name, documentation, labelnames)
+
+    def histogram(self, name: str, documentation: str = '', labelnames: Iterable[str] = (), **kwargs) -> Histogram:
+        return self._get_or_create(Histogram, name, documentation, labelnames, **kwargs)
+
+    def render(self) -> str:
+        lines = []
+        for metric in self.metrics.values():
+            lines.append(f"# HELP {metric.name} {metric.documentation}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+    def summary(self) -> str:
+        return ', '.join(metric.summary() for metric in self.metrics.values())
+
+    def write(self, path: Union[str, Path]):
+        # for node_exporter's textfile collector, replaced atomically
+        path = Path(path)
+        temp_path = path.with_suffix('.tmp')
+        temp_path.write_text(self.render())
+        temp_path.replace(path)
+
+    async def serve(self, host: str = '0.0.0.0', port: int = 9100):
+        async def handle(request):
+            return web.Response(text=self.render(), content_type='text/plain', charset='utf-8')
+
+        app = web.Application()
+        app.router.add_get('/metrics', handle)
+        self._runner = web.AppRunner(app)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, host, port).start()
+
+    async def close(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+    def make_trace_config(self) -> aiohttp.TraceConfig:
+        requests = self.counter('http_requests_total', 'HTTP responses by host and status', ('host', 'status'))
+        errors = self.counter('http_request_errors_total', 'HTTP requests failed without a response', ('host', 'error'))
+        latency = self.histogram('http_request_duration_seconds', 'Time to response headers by host', ('host',))
+        received = self.counter('http_response_bytes_total', 'Response body bytes received by host', ('host',))
+        trace_config = aiohttp.TraceConfig()
+
+        async def on_request_start(session, ctx, params):
+            ctx.metrics_start_time = time.monotonic()
+
+        async def on_request_end(session, ctx, params):
+            host = params.url.host
+            latency.observe(time.monotonic() - ctx.metrics_start_time, host)
+            requests.inc(host, params.response.status)
+
+        async def on_request_exception(session, ctx, params):
+            errors.inc(params.url.host, type(params.exception).__name__)
+
+        async def on_response_chunk_received(session, ctx, params):
+            # fired by `read()` only, the download sink counts streamed bodies
+            received.inc(params.url.host, amount=len(params.chunk))
+
+        trace_config.on_request_start.append(on_request_start)
+        trace_config.on_request_end.append(on_request_end)
+        trace_config.on_request_exception.append(on_request_exception)
+        trace_config.on_response_chunk_received.append(on_response_chunk_received)
+        return trace_config
+
+    def _get_or_create(self, cls, name: str, documentation: str, labelnames: Iterable[str], **kwargs):
+        metric = self.metrics.get(name)
+        if metric is None:
+            metric = self.metrics[name] = cls(name, documentation, labelnames, **kwargs)
+        elif not isinstance(metric, cls):
+            raise ValueError(f"Metric {name} is already a {metric.kind}")
+        return metric
+
+    def __str__(self) -> str:
+        return f"<MetricsRegistry: {len(self.metrics)} metrics>"
+
+    def __repr__(self) -> str:
+        return self.__str__()
@@ -0,0 +1,67 @@
+import os
+import asyncio
+import functools
+import multiprocessing
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Callable, Optional, TypeVar
+
+
+T = TypeVar('T')
+
+
+class ParseExecutor:
+    """Runs CPU-bound parsing off the event loop.
+
+    backend:
+        process: a process pool, parsing scales across cores. Functions and
+            arguments must be picklable, i.e. module-level functions fed raw bytes,
+            and workers are spawned, so entry scripts need a `__main__` guard.
+        thread: a thread pool, lxml releases the GIL while parsing.
+        inline: on the loop itself, for debugging.
+    """
+
+    def __init__(
+        self,
+        backend: str = 'process',
+        max_workers: Optional[int] = None,
+        start_method: Optional[str] = 'spawn'
+    ):
+        if backend not in ('process', 'thread', 'inline'):
+            raise ValueError(f"Unknown parse backend: {backend}")
+        self.backend = backend
+        self.max_workers = max_workers or os.cpu_count() or 1
+        # forking a process that already runs threads (the DB pool, the
+        # resolver) may deadlock the children, so workers are spawned
+        self.start_method = start_method
+
+        self._executor: Optional[Executor] = None
+
+    @property
+    def executor(self) -> Optional[Executor]:
+        # created on first use, spiders that never parse start no workers
+        if self._executor is None and self.backend != 'inline':
+            if self.backend == 'process':
+                self._executor = ProcessPoolExecutor(
+                    self.max_workers,
+                    mp_context=multiprocessing.get_context(self.start_method)
+                )
+            else:
+                self._executor = ThreadPoolExecutor(self.max_workers, thread_name_prefix="parse")
+        return self._executor
+
+    async def run(self, func: Callable[..., T], *args, **kwargs) -> T:
+        if self.backend == 'inline':
+            return func(*args, **kwargs)
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(self.executor, functools.partial(func, *args, **kwargs))
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+
+    def __str__(self) -> str:
+        return f"<ParseExecutor: {self.backend}, max_workers={self.max_workers}>"
+
+    def __repr__(self) -> str:
+        return self.__str__()
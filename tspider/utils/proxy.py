@@ -1,34 +1,301 @@
+import time
+import random
 import asyncio
+from typing import Dict, List, Optional
+
 import aiohttp
+from loguru import logger
+
+from tspider.http.session import SessionManager
+from tspider.utils.tracing import span
+
+
+class ProxyStats:
+    __slots__ = ('proxy', 'latency', 'success', 'failures', 'quarantined_until')
+
+    def __init__(self, proxy: str, latency: float = 1.0) -> None:
+        self.proxy = proxy
+        # EWMAs of request latency in seconds and of the success rate
+        self.latency = latency
+        self.success = 1.0
+        self.failures = 0
+        self.quarantined_until = 0.0
+
+    @property
+    def score(self) -> float:
+        return self.success / max(self.latency, 0.05)
+
+    def __str__(self) -> str:
+        return f"<Proxy: {self.proxy}, latency={self.latency:.3f}, success={self.success:.3f}>"
+
+    def __repr__(self) -> str:
+        return self.__str__()
 
 
 class ProxyManager:
-    def __init__(self, host: str, port: str) -> None:
+    def __init__(
+        self,
+        host: str,
+        port: str,
+        session_manager: Optional[SessionManager] = None,
+        pool_size: int = 50,
+        refill_threshold: int = 10,
+        refill_interval: float = 30.0,
+        alpha: float = 0.3,
+        quarantine_time: float = 60.0,
+        max_failures: int = 3,
+        wait_timeout: float = 30.0,
+    ) -> None:
         self.host = host
         self.port = port
+        self._own_session = session_manager is None
+        self.session_manager = session_manager or SessionManager()
+
+        self.pool_size = pool_size
+        self.refill_threshold = refill_threshold
+        self.refill_interval = refill_interval
+        self.alpha = alpha
+        self.quarantine_time = quarantine_time
+        self.max_failures = max_failures
+        self.wait_timeout = wait_timeout
+
+        self._stats: Dict[str, ProxyStats] = {}
+        # active proxies, kept in a list with an index map for O(1) sampling and removal
+        self._active: List[str] = []
+        self._index: Dict[str, int] = {}
+        self._quarantined: Dict[str, ProxyStats] = {}
+
+        self._available: Optional[asyncio.Event] = None
+        self._need_refill: Optional[asyncio.Event] = None
+        self._refill_task: Optional[asyncio.Task] = None
+        self._has_all_api = True
+        self._num_shares = 0
 
-    async def get_proxy(self):
-        async with aiohttp.ClientSession() as session:
-            async with session.get(f'http://{self.host}:{self.port}/get/') as response:
-                result = await response.json()
-                proxy = f"http://{result.get('proxy')}"
-                return proxy
+    def __len__(self) -> int:
+        return len(self._active)
+
+    def share(self) -> 'ProxyShare':
+        # one per spider when several spiders use this pool
+        share = ProxyShare(self, self._num_shares)
+        self._num_shares += 1
+        return share
+
+    def share_size(self, share: int) -> int:
+        # active proxies at indexes share, share + n, share + 2n, ...
+        if self._num_shares <= 1 or len(self._active) < self._num_shares:
+            return len(self._active)
+        return (len(self._active) - share + self._num_shares - 1) // self._num_shares
+
+    async def get_proxy(self, share: Optional[int] = None) -> str:
+        self._ensure_refill_task()
+        if len(self._active) < self.refill_threshold:
+            self._need_refill.set()
+        if not self._active:
+            with span('proxy.wait'):
+                while not self._active:
+                    self._available.clear()
+                    await asyncio.wait_for(self._available.wait(), self.wait_timeout)
+        # power of two choices: sample two proxies and keep the healthier one,
+        # which weights the choice by health score without scanning the pool
+        first = self._sample(share)
+        second = self._sample(share)
+        if self._stats[second].score > self._stats[first].score:
+            return second
+        return first
+
+    def report_success(self, proxy: str, latency: float):
+        stats = self._stats.get(proxy)
+        if stats is None:
+            return
+        stats.latency += self.alpha * (latency - stats.latency)
+        stats.success += self.alpha * (1.0 - stats.success)
+        stats.failures = 0
+
+    def report_failure(self, proxy: str, quarantine: bool = True):
+        stats = self._stats.get(proxy)
+        if stats is None:
+            return
+        stats.success -= self.alpha * stats.success
+        if not quarantine:
+            return
+        stats.failures += 1
+        self._deactivate(proxy)
+        if stats.failures >= self.max_failures:
+            logger.warning(f"Proxy evicted: {proxy}")
+            self._quarantined.pop(proxy, None)
+            self._stats.pop(proxy, None)
+            asyncio.ensure_future(self._delete_quietly(proxy))
+        else:
+            logger.warning(f"Proxy quarantined: {proxy}")
+            stats.quarantined_until = time.monotonic() + self.quarantine_time * stats.failures
+            self._quarantined[proxy] = stats
 
     async def delete_proxy(self, proxy: str):
+        proxy = self._strip_scheme(proxy)
+        async with self.session_manager.session.get(f"http://{self.host}:{self.port}/delete/?proxy={proxy}") as response:
+            result = await response.json()
+            return result
+
+    async def fetch_proxies(self) -> List[str]:
+        if self._has_all_api:
+            try:
+                async with self.session_manager.session.get(f"http://{self.host}:{self.port}/all/") as response:
+                    response.raise_for_status()
+                    result = await response.json()
+                    return [f"http://{ins.get('proxy')}" for ins in result if ins.get('proxy')]
+            except aiohttp.ClientResponseError:
+                logger.warning(f"Proxy pool {self.host}:{self.port} has no /all/ endpoint")
+                self._has_all_api = False
+        results = await asyncio.gather(
+            *[self._fetch_one() for _ in range(self.pool_size - len(self._active))],
+            return_exceptions=True
+        )
+        return [proxy for proxy in results if isinstance(proxy, str)]
+
+    async def _fetch_one(self) -> Optional[str]:
+        async with self.session_manager.session.get(f'http://{self.host}:{self.port}/get/') as response:
+            result = await response.json()
+            if result.get('proxy') is None:
+                return None
+            return f"http://{result.get('proxy')}"
+
+    async def refill(self):
+        now = time.monotonic()
+        for proxy, stats in list(self._quarantined.items()):
+            if stats.quarantined_until <= now:
+                del self._quarantined[proxy]
+                self._activate(proxy)
+        if len(self._active) >= self.pool_size:
+            return
+        for proxy in await self.fetch_proxies():
+            if len(self._active) >= self.pool_size:
+                break
+            if proxy not in self._stats:
+                self._stats[proxy] = ProxyStats(proxy)
+                self._activate(proxy)
+
+    async def close(self):
+        if self._refill_task is not None:
+            self._refill_task.cancel()
+            await asyncio.gather(self._refill_task, return_exceptions=True)
+            self._refill_task = None
+        if self._own_session:
+            await self.session_manager.close()
+
+    def _ensure_refill_task(self):
+        if self._refill_task is None or self._refill_task.done():
+            self._available = asyncio.Event()
+            self._need_refill = asyncio.Event()
+            self._need_refill.set()
+            if self._active:
+                self._available.set()
+            self._refill_task = asyncio.ensure_future(self._refill_loop())
+
+    async def _refill_loop(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._need_refill.wait(), self.refill_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._need_refill.clear()
+            try:
+                await self.refill()
+            except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as err:
+                logger.warning(f"Refilling proxies failed: {type(err).__name__} {err}")
+                await asyncio.sleep(1.0)
+                self._need_refill.set()
+
+    def _sample(self, share: Optional[int]) -> str:
+        if share is None or self._num_shares <= 1 or len(self._active) < self._num_shares:
+            return random.choice(self._active)
+        return self._active[random.randrange(self.share_size(share)) * self._num_shares + share]
+
+    def _activate(self, proxy: str):
+        if proxy in self._index:
+            return
+        self._index[proxy] = len(self._active)
+        self._active.append(proxy)
+        self._available.set()
+
+    def _deactivate(self, proxy: str):
+        index = self._index.pop(proxy, None)
+        if index is None:
+            return
+        last = self._active.pop()
+        if last != proxy:
+            self._active[index] = last
+            self._index[last] = index
+        if len(self._active) < self.refill_threshold and self._need_refill is not None:
+            self._need_refill.set()
+
+    async def _delete_quietly(self, proxy: str):
+        try:
+            await self.delete_proxy(proxy)
+        except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as err:
+            logger.warning(f"Deleting proxy {proxy} failed: {type(err).__name__} {err}")
+
+    @staticmethod
+    def _strip_scheme(proxy: str) -> str:
         if proxy.startswith('http://'):
             proxy = proxy[7:]
         elif proxy.startswith('https://'):
             proxy = proxy[8:]
-        async with aiohttp.ClientSession() as session:
-            async with session.get(f"http://{self.host}:{self.port}/delete/?proxy={proxy}") as response:
-                result = await response.json()
-                return result
+        return proxy
+
+    def __str__(self) -> str:
+        return f"<ProxyManager: {self.host}:{self.port}, active={len(self._active)}>"
+
+    def __repr__(self) -> str:
+        return self.__str__()
+
+
+class ProxyShare:
+    """A spider's fair part of a `ProxyManager` shared by several spiders.
+
+    Each of n shares draws from every n-th active proxy, so a busy spider
+    cannot wear out the whole pool, and from all of them while there are
+    fewer proxies than shares. Health reports go to the shared pool.
+    """
+
+    def __init__(self, manager: ProxyManager, index: int):
+        self.manager = manager
+        self.index = index
+
+    def __len__(self) -> int:
+        return self.manager.share_size(self.index)
+
+    async def get_proxy(self) -> str:
+        return await self.manager.get_proxy(self.index)
+
+    def report_success(self, proxy: str, latency: float):
+        self.manager.report_success(proxy, latency)
+
+    def report_failure(self, proxy: str, quarantine: bool = True):
+        self.manager.report_failure(proxy, quarantine)
+
+    async def delete_proxy(self, proxy: str):
+        return await self.manager.delete_proxy(proxy)
+
+    async def close(self):
+        # the shared manager is closed by its owner
+        pass
+
+    def __str__(self) -> str:
+        return f"<ProxyShare: {self.index} of {self.manager}>"
+
+    def __repr__(self) -> str:
+        return self.__str__()
 
 
 if __name__ == "__main__":
-    loop = asyncio.get_event_loop()
-    pm = ProxyManager("localhost", "26888")
-    proxy = asyncio.run(pm.get_proxy())
-    print(proxy)
-    result = asyncio.run(pm.delete_proxy(proxy))
-    print(result)
+    async def main():
+        pm = ProxyManager("localhost", "26888")
+        try:
+            proxy = await pm.get_proxy()
+            print(proxy, len(pm))
+            result = await pm.delete_proxy(proxy)
+            print(result)
+        finally:
+            await pm.close()
+
+    asyncio.run(main())
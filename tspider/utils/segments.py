@@ -0,0 +1,413 @@
+import time
+import uuid
+import zlib
+import hashlib
+import sqlite3
+import asyncio
+import datetime
+import mimetypes
+from http import HTTPStatus
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Iterator, List, Optional, Tuple, Union
+
+from loguru import logger
+
+from tspider.utils.download import SavedFile, StreamingSink
+from tspider.utils.tracing import span
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+# Documents appended as WARC 1.1 records to rotating segment files, each
+# record compressed on its own (one gzip member or zstd frame), so that a
+# record can be read back from its offset alone:
+#
+#   response     the HTTP response, status line, headers and decoded body
+#   conversion   content extracted from a response, e.g. an article's table
+#   resource     content saved without its response
+#
+# Records carry `TSpider-Document-ID` and `TSpider-Filename`, and
+# `index.sqlite3` maps document ids to (segment, offset, length).
+
+SEGMENT_SUFFIXES = {"gzip": ".warc.gz", "zstd": ".warc.zst"}
+READ_SIZE = 64 * 1024
+# dropped from stored responses, whose bodies are stored decoded
+HOP_HEADERS = ('Content-Encoding', 'Transfer-Encoding', 'Content-Length')
+
+
+def make_compressor(compression: str):
+    if compression == "gzip":
+        return zlib.compressobj(6, zlib.DEFLATED, 31)
+    return zstandard.ZstdCompressor().compressobj()
+
+
+def make_decompressor(compression: str):
+    if compression == "gzip":
+        return zlib.decompressobj(31)
+    return zstandard.ZstdDecompressor().decompressobj()
+
+
+def get_compression(path: Path) -> str:
+    for compression, suffix in SEGMENT_SUFFIXES.items():
+        if path.name.endswith(suffix):
+            return compression
+    raise ValueError(f"Not a segment: {path}")
+
+
+def get_warc_date() -> str:
+    return datetime.datetime.now(datetime.timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ')
+
+
+def format_warc_headers(headers: List[Tuple[str, str]]) -> bytes:
+    lines = ["WARC/1.1"] + [f"{name}: {value}" for name, value in headers]
+    return ('\r\n'.join(lines) + '\r\n\r\n').encode()
+
+
+def format_http_head(response) -> bytes:
+    try:
+        reason = HTTPStatus(response.status).phrase
+    except ValueError:
+        reason = ''
+    lines = [f"HTTP/1.1 {response.status} {reason}".rstrip()]
+    lines.extend(f"{name}: {value}" for name, value in response.headers.items() if name not in HOP_HEADERS)
+    return ('\r\n'.join(lines) + '\r\n\r\n').encode()
+
+
+class WarcRecord:
+    def __init__(self, headers: dict, block: bytes, segment: Path, offset: int, length: int):
+        self.headers = headers
+        self.block = block
+        self.segment = segment
+        self.offset = offset
+        self.length = length
+
+    @property
+    def record_type(self) -> str:
+        return self.headers.get('WARC-Type', '')
+
+    @property
+    def document_id(self) -> Optional[str]:
+        return self.headers.get('TSpider-Document-ID')
+
+    @property
+    def payload(self) -> bytes:
+        # the body of responses, the whole block of other records
+        if self.record_type == 'response':
+            return self.block.split(b'\r\n\r\n', 1)[-1]
+        return self.block
+
+    @property
+    def http_headers(self) -> dict:
+        if self.record_type != 'response':
+            return {}
+        lines = self.block.split(b'\r\n\r\n', 1)[0].decode('latin-1').split('\r\n')[1:]
+        return dict(line.split(': ', 1) for line in lines if ': ' in line)
+
+    @classmethod
+    def parse(cls, data: bytes, segment: Path, offset: int, length: int) -> 'WarcRecord':
+        head, _, rest = data.partition(b'\r\n\r\n')
+        lines = head.decode('utf-8').split('\r\n')
+        if not lines[0].startswith('WARC/'):
+            raise ValueError(f"No WARC record at {segment}:{offset}")
+        headers = dict(line.split(': ', 1) for line in lines[1:])
+        return cls(headers, rest[:int(headers['Content-Length'])], segment, offset, length)
+
+    def __str__(self) -> str:
+        return f"<WarcRecord: {self.record_type} {self.document_id} @ {self.segment.name}:{self.offset}>"
+
+    def __repr__(self) -> str:
+        return self.__str__()
+
+
+class SegmentSink(StreamingSink):
+    """Appends documents as records to rotating, compressed WARC segments
+    under `directory/segments` instead of writing one file per document.
+
+    Bodies are still streamed into `.part` files, so downloads resume as
+    before, and are appended once complete. Appends run on one writer
+    thread, sequential I/O however many downloads run at once. The saved
+    file's `filepath` is the segment and `offset` the record's offset.
+    """
+
+    def __init__(
+        self,
+        directory: Union[str, Path],
+        segment_size: int = 1024 * 1024 * 1024,
+        compression: str = 'gzip',
+        batch_size: int = 100,
+        **kwargs
+    ):
+        if compression not in SEGMENT_SUFFIXES:
+            raise ValueError(f"Unknown segment compression: {compression}")
+        if compression == 'zstd' and zstandard is None:
+            raise ImportError("segment compression 'zstd' requires the zstandard package")
+        super().__init__(directory, **kwargs)
+        self.segment_size = segment_size
+        self.compression = compression
+        self.batch_size = batch_size
+        self.segment_directory = self.directory.joinpath('segments')
+        self.segment_directory.mkdir(parents=True, exist_ok=True)
+
+        self.index = sqlite3.connect(str(self.segment_directory.joinpath('index.sqlite3')), check_same_thread=False)
+        create_index_tables(self.index)
+        self._executor = ThreadPoolExecutor(1, thread_name_prefix="segments")
+        self._segment_path: Optional[Path] = None
+        self._fout = None
+        self._unindexed = 0
+
+    async def commit(self, part_path: Path, filename: str, digest: str, size: int, key: Optional[str] = None, response=None) -> SavedFile:
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(self._executor, self._append_part, part_path, filename, digest, size, key, response)
+
+    async def save_bytes(self, content: bytes, filename: str, key: Optional[str] = None, response=None) -> SavedFile:
+        # with the response, it is stored too and `content` refers to it
+        body = await response.read() if response is not None else None
+        loop = asyncio.get_event_loop()
+        with span('sink.save_bytes', filename=filename):
+            return await loop.run_in_executor(self._executor, self._append_bytes, content, filename, key, response, body)
+
+    def close(self):
+        self._executor.shutdown(wait=True)
+        if self._fout is not None:
+            self._fout.close()
+            self._fout = None
+        self.index.commit()
+        self.index.close()
+
+    def _append_part(self, part_path: Path, filename: str, digest: str, size: int, key: Optional[str], response) -> SavedFile:
+        key = key or uuid.uuid4().hex
+        head = format_http_head(response) if response is not None else b''
+        headers = self._make_headers(
+            'response' if response is not None else 'resource', key, filename,
+            str(response.url) if response is not None else None,
+            'application/http;msgtype=response' if response is not None else self._guess_type(filename),
+            len(head) + size, digest
+        )
+        with part_path.open('rb') as fin:
+            chunks = iter(lambda: fin.read(self.chunk_size), b'')
+            offset, length = self._append(headers, [head], chunks)
+        part_path.unlink()
+        self._add_to_index(headers, offset, length)
+        return SavedFile(filename, self._segment_path, digest, size, offset=offset)
+
+    def _append_bytes(self, content: bytes, filename: str, key: Optional[str], response, body: Optional[bytes]) -> SavedFile:
+        key = key or uuid.uuid4().hex
+        refers_to = []
+        if response is not None:
+            head = format_http_head(response)
+            headers = self._make_headers(
+                'response', key, filename, str(response.url), 'application/http;msgtype=response',
+                len(head) + len(body), self._hash(body)
+            )
+            offset, length = self._append(headers, [head, body])
+            self._add_to_index(headers, offset, length)
+            refers_to = [('WARC-Refers-To', dict(headers)['WARC-Record-ID'])]
+        digest = self._hash(content)
+        headers = self._make_headers(
+            'conversion' if response is not None else 'resource', key, filename,
+            str(response.url) if response is not None else None,
+            self._guess_type(filename), len(content), digest
+        ) + refers_to
+        offset, length = self._append(headers, [content])
+        self._add_to_index(headers, offset, length)
+        return SavedFile(filename, self._segment_path, digest, len(content), offset=offset)
+
+    def _make_headers(self, record_type: str, key: str, filename: str, url: Optional[str], content_type: str, length: int, digest: Optional[str]) -> List[Tuple[str, str]]:
+        headers = [
+            ('WARC-Type', record_type),
+            ('WARC-Record-ID', f"<urn:uuid:{uuid.uuid4()}>"),
+            ('WARC-Date', get_warc_date()),
+            # resource records need a target, documents without a url get a urn
+            ('WARC-Target-URI', url or f"urn:tspider:{key}"),
+            ('Content-Type', content_type),
+            ('Content-Length', str(length)),
+            ('TSpider-Document-ID', key),
+            ('TSpider-Filename', filename),
+        ]
+        if digest is not None:
+            headers.append(('WARC-Payload-Digest', f"{self.hash_name}:{digest}"))
+        return headers
+
+    def _append(self, headers: List[Tuple[str, str]], parts: List[bytes], chunks: Iterator[bytes] = iter(())) -> Tuple[int, int]:
+        self._ensure_segment()
+        return self._write_record(headers, parts, chunks)
+
+    def _write_record(self, headers: List[Tuple[str, str]], parts: List[bytes], chunks: Iterator[bytes] = iter(())) -> Tuple[int, int]:
+        # one compressed member per record, returns its offset and length
+        offset = self._fout.tell()
+        compressor = make_compressor(self.compression)
+        self._fout.write(compressor.compress(format_warc_headers(headers)))
+        for part in parts:
+            self._fout.write(compressor.compress(part))
+        for chunk in chunks:
+            self._fout.write(compressor.compress(chunk))
+        self._fout.write(compressor.compress(b'\r\n\r\n'))
+        self._fout.write(compressor.flush())
+        # whole records reach the file, a crash tears the last one at most
+        self._fout.flush()
+        return offset, self._fout.tell() - offset
+
+    def _ensure_segment(self):
+        if self._fout is not None and self._fout.tell() < self.segment_size:
+            return
+        if self._fout is not None:
+            self._fout.close()
+            logger.info(f"Closed segment {self._segment_path}")
+        # a new segment per run, never appending to one a crash may have torn
+        name = f"{datetime.datetime.now():%Y%m%d%H%M%S%f}-{uuid.uuid4().hex[:8]}{SEGMENT_SUFFIXES[self.compression]}"
+        self._segment_path = self.segment_directory.joinpath(name)
+        self._fout = self._segment_path.open('ab')
+        self._write_record([
+            ('WARC-Type', 'warcinfo'),
+            ('WARC-Record-ID', f"<urn:uuid:{uuid.uuid4()}>"),
+            ('WARC-Date', get_warc_date()),
+            ('WARC-Filename', name),
+            ('Content-Type', 'application/warc-fields'),
+            ('Content-Length', str(len(b'software: tspider\r\n'))),
+        ], [b'software: tspider\r\n'])
+
+    def _add_to_index(self, headers: List[Tuple[str, str]], offset: int, length: int):
+        add_to_index(self.index, dict(headers), self._segment_path.name, offset, length)
+        self._unindexed += 1
+        if self._unindexed >= self.batch_size:
+            self.index.commit()
+            self._unindexed = 0
+
+    def _hash(self, content: bytes) -> str:
+        hasher = hashlib.new(self.hash_name)
+        hasher.update(content)
+        return hasher.hexdigest()
+
+    @staticmethod
+    def _guess_type(filename: str) -> str:
+        return mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+
+    def __str__(self) -> str:
+        return f"<SegmentSink: {self.segment_directory}, compression={self.compression}>"
+
+
+def create_index_tables(conn: sqlite3.Connection):
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS records ("
+        " document_id TEXT NOT NULL,"
+        " record_type TEXT NOT NULL,"
+        " segment TEXT NOT NULL,"
+        " offset INTEGER NOT NULL,"
+        " length INTEGER NOT NULL,"
+        " digest TEXT,"
+        " filename TEXT,"
+        " stored_time REAL NOT NULL"
+        ")"
+    )
+    conn.execute("CREATE INDEX IF NOT EXISTS records_document_id ON records (document_id)")
+    conn.commit()
+
+
+def add_to_index(conn: sqlite3.Connection, headers: dict, segment: str, offset: int, length: int):
+    digest = headers.get('WARC-Payload-Digest', '').split(':', 1)[-1] or None
+    conn.execute(
+        "INSERT INTO records VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+        (
+            headers['TSpider-Document-ID'], headers['WARC-Type'], segment, offset, length,
+            digest, headers.get('TSpider-Filename'), time.time()
+        )
+    )
+
+
+class SegmentReader:
+    """Reads records back from the segments of a `SegmentSink`: streamed
+    in write order, or one document at a time through the index."""
+
+    def __init__(self, directory: Union[str, Path]):
+        # the sink's directory, or its `segments` directory
+        directory = Path(directory)
+        if directory.joinpath('segments').is_dir():
+            directory = directory.joinpath('segments')
+        self.directory = directory
+        self.index = sqlite3.connect(str(self.directory.joinpath('index.sqlite3')))
+        create_index_tables(self.index)
+
+    @property
+    def segments(self) -> List[Path]:
+        # names start with their creation time
+        return sorted(
+            path for path in self.directory.iterdir()
+            if any(path.name.endswith(suffix) for suffix in SEGMENT_SUFFIXES.values())
+        )
+
+    def get(self, document_id: str, record_type: Optional[str] = None) -> Optional[WarcRecord]:
+        # the latest record of the document, for extracted content its conversion
+        query = "SELECT segment, offset, length FROM records WHERE document_id = ?"
+        args = [document_id]
+        if record_type is not None:
+            query += " AND record_type = ?"
+            args.append(record_type)
+        row = self.index.execute(query + " ORDER BY rowid DESC LIMIT 1", args).fetchone()
+        if row is None:
+            return None
+        return self.read_record(self.directory.joinpath(row[0]), row[1], row[2])
+
+    def read_record(self, segment: Path, offset: int, length: int) -> WarcRecord:
+        with segment.open('rb') as fin:
+            fin.seek(offset)
+            data = make_decompressor(get_compression(segment)).decompress(fin.read(length))
+        return WarcRecord.parse(data, segment, offset, length)
+
+    def iter_records(self, segment: Optional[Path] = None, record_type: Optional[str] = None) -> Iterator[WarcRecord]:
+        for path in [segment] if segment is not None else self.segments:
+            for offset, length, data in self._iter_members(path):
+                record = WarcRecord.parse(data, path, offset, length)
+                if record_type is None or record.record_type == record_type:
+                    yield record
+
+    def reindex(self) -> int:
+        # rebuilds the index from the segments, e.g. after a crash lost its last batch
+        self.index.execute("DELETE FROM records")
+        num = 0
+        for record in self.iter_records():
+            if record.document_id is None:
+                continue
+            add_to_index(self.index, record.headers, record.segment.name, record.offset, record.length)
+            num += 1
+        self.index.commit()
+        logger.info(f"Reindexed {num} records of {self.directory}")
+        return num
+
+    def close(self):
+        self.index.close()
+
+    @staticmethod
+    def _iter_members(path: Path) -> Iterator[Tuple[int, int, bytes]]:
+        compression = get_compression(path)
+        offset = 0
+        buffer = b''
+        with path.open('rb') as fin:
+            while True:
+                if not buffer:
+                    buffer = fin.read(READ_SIZE)
+                    if not buffer:
+                        return
+                decompressor = make_decompressor(compression)
+                start = offset
+                parts = []
+                while not decompressor.eof:
+                    if not buffer:
+                        buffer = fin.read(READ_SIZE)
+                        if not buffer:
+                            logger.warning(f"Torn record at {path}:{start}, stop reading")
+                            return
+                    parts.append(decompressor.decompress(buffer))
+                    consumed = len(buffer) - len(decompressor.unused_data)
+                    offset += consumed
+                    buffer = decompressor.unused_data
+                yield start, offset - start, b''.join(parts)
+
+    def __str__(self) -> str:
+        return f"<SegmentReader: {self.directory}>"
+
+    def __repr__(self) -> str:
+        return self.__str__()
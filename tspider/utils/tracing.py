@@ -0,0 +1,254 @@
+import os
+import json
+import time
+import random
+import contextlib
+import contextvars
+from pathlib import Path
+from typing import Dict, Iterator, List, Optional, Union
+
+import aiohttp
+
+
+# the innermost open span of the running task, tasks inherit it when created
+_current_span: contextvars.ContextVar[Optional['Span']] = contextvars.ContextVar('tspider_span', default=None)
+
+
+class Span:
+    __slots__ = ('tracer', 'name', 'trace_id', 'parent', 'args', 'start', 'end', 'child_time')
+
+    def __init__(self, tracer: 'Tracer', name: str, trace_id: int, parent: Optional['Span'] = None, args: Optional[dict] = None, start: Optional[float] = None):
+        self.tracer = tracer
+        self.name = name
+        self.trace_id = trace_id
+        self.parent = parent
+        self.args = args
+        self.start = time.perf_counter() if start is None else start
+        self.end: Optional[float] = None
+        self.child_time = 0.0
+
+    @property
+    def duration(self) -> float:
+        return (self.end if self.end is not None else time.perf_counter()) - self.start
+
+    def child(self, name: str, start: Optional[float] = None, **args) -> 'Span':
+        return Span(self.tracer, name, self.trace_id, self, args or None, start)
+
+    def finish(self, **args):
+        if self.end is not None:
+            return
+        self.end = time.perf_counter()
+        if args:
+            self.args = {**(self.args or {}), **args}
+        if self.parent is not None:
+            self.parent.child_time += self.end - self.start
+        self.tracer.record(self)
+
+    def __str__(self) -> str:
+        return f"<Span: {self.name}, trace={self.trace_id}, duration={self.duration:.6f}>"
+
+    def __repr__(self) -> str:
+        return self.__str__()
+
+
+def start_span(name: str, **args) -> Optional[Span]:
+    # a child of the current span, or `None` outside of sampled traces;
+    # for callbacks like aiohttp's trace hooks, the caller finishes it
+    parent = _current_span.get()
+    if parent is None:
+        return None
+    return parent.child(name, **args)
+
+
+@contextlib.contextmanager
+def span(name: str, **args) -> Iterator[Optional[Span]]:
+    # costs a context variable lookup when the item is not sampled
+    parent = _current_span.get()
+    if parent is None:
+        yield None
+        return
+    child = parent.child(name, **args)
+    token = _current_span.set(child)
+    try:
+        yield child
+    finally:
+        _current_span.reset(token)
+        child.finish()
+
+
+class StageStats:
+    __slots__ = ('count', 'total', 'self_time', 'max')
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.self_time = 0.0
+        self.max = 0.0
+
+    def observe(self, duration: float, self_time: float):
+        self.count += 1
+        self.total += duration
+        # concurrent children may overlap their parent's own time
+        self.self_time += max(self_time, 0.0)
+        self.max = max(self.max, duration)
+
+
+class Tracer:
+    """Samples a share of crawled items and times the stages of each, from
+    waiting for a proxy to the DB write, as nested spans.
+
+    Spans are exported as a Chrome trace (chrome://tracing, Perfetto), one
+    track per item, and summed by stage name into a report where each
+    stage's self time excludes its instrumented children.
+    """
+
+    def __init__(self, sample_rate: float = 0.1, max_spans: int = 100000):
+        self.sample_rate = sample_rate
+        # kept for the export, later spans are only counted in the report
+        self.max_spans = max_spans
+        self.spans: List[Span] = []
+        self.stages: Dict[str, StageStats] = {}
+        self.keys: Dict[int, str] = {}
+        self.num_traces = 0
+        self.num_dropped = 0
+        self.traced_time = 0.0
+        self._origin = time.perf_counter()
+
+    @contextlib.contextmanager
+    def trace(self, name: str, key: Optional[str] = None) -> Iterator[Optional[Span]]:
+        # the sampling decision is taken once per item, for all its spans
+        if _current_span.get() is not None or random.random() >= self.sample_rate:
+            with span(name, key=key) as child:
+                yield child
+            return
+        self.num_traces += 1
+        root = Span(self, name, self.num_traces)
+        if key is not None:
+            self.keys[root.trace_id] = str(key)
+        token = _current_span.set(root)
+        try:
+            yield root
+        finally:
+            _current_span.reset(token)
+            root.finish()
+            self.traced_time += root.end - root.start
+
+    def record(self, span: Span):
+        duration = span.end - span.start
+        stats = self.stages.get(span.name)
+        if stats is None:
+            stats = self.stages[span.name] = StageStats()
+        stats.observe(duration, duration - span.child_time)
+        if len(self.spans) < self.max_spans:
+            self.spans.append(span)
+        else:
+            self.num_dropped += 1
+
+    def report(self) -> str:
+        traced = self.traced_time
+        lines = [f"time by stage over {self.num_traces} traced items, {traced:.3f}s:"]
+        for name, stats in sorted(self.stages.items(), key=lambda item: item[1].self_time, reverse=True):
+            share = stats.self_time / traced if traced > 0 else 0.0
+            lines.append(
+                f"  {name:<20} self={stats.self_time:9.3f}s {share:6.1%}  total={stats.total:9.3f}s  "
+                f"n={stats.count:<7} mean={stats.total / stats.count * 1000:9.1f}ms  max={stats.max * 1000:9.1f}ms"
+            )
+        if self.num_dropped:
+            lines.append(f"  {self.num_dropped} spans beyond max_spans={self.max_spans} are left out of the trace file")
+        return '\n'.join(lines)
+
+    def export(self) -> dict:
+        # complete events in microseconds, one thread track per traced item
+        pid = os.getpid()
+        events = [
+            {"name": "thread_name", "ph": "M", "pid": pid, "tid": trace_id, "args": {"name": key}}
+            for trace_id, key in self.keys.items()
+        ]
+        for span_ in self.spans:
+            event = {
+                "name": span_.name,
+                "cat": span_.name.split('.', 1)[0],
+                "ph": "X",
+                "ts": round((span_.start - self._origin) * 1e6, 1),
+                "dur": round((span_.end - span_.start) * 1e6, 1),
+                "pid": pid,
+                "tid": span_.trace_id,
+            }
+            if span_.args:
+                event["args"] = {name: str(value) for name, value in span_.args.items()}
+            events.append(event)
+        return {"traceEvents": events, "displayTimeUnit": "ms"}
+
+    def write(self, path: Union[str, Path]):
+        path = Path(path)
+        temp_path = path.with_suffix('.tmp')
+        temp_path.write_text(json.dumps(self.export()))
+        temp_path.replace(path)
+
+    def make_trace_config(self) -> aiohttp.TraceConfig:
+        # waiting for a rate limit token is a span of its own, before these
+        trace_config = aiohttp.TraceConfig()
+
+        async def on_request_start(session, ctx, params):
+            ctx.trace_span = start_span('http.request', method=params.method, host=params.url.host)
+            ctx.trace_connect_span = None
+
+        async def on_connection_queued_start(session, ctx, params):
+            if ctx.trace_span is not None:
+                ctx.trace_queued_span = ctx.trace_span.child('http.pool_wait')
+
+        async def on_connection_queued_end(session, ctx, params):
+            if ctx.trace_span is not None:
+                ctx.trace_queued_span.finish()
+
+        async def on_connection_create_start(session, ctx, params):
+            if ctx.trace_span is not None:
+                ctx.trace_connect_span = ctx.trace_span.child('http.connect')
+
+        async def on_connection_create_end(session, ctx, params):
+            if ctx.trace_connect_span is not None:
+                ctx.trace_connect_span.finish()
+
+        async def on_dns_resolvehost_start(session, ctx, params):
+            if ctx.trace_span is not None:
+                ctx.trace_dns_span = (ctx.trace_connect_span or ctx.trace_span).child('http.dns')
+
+        async def on_dns_resolvehost_end(session, ctx, params):
+            if ctx.trace_span is not None:
+                ctx.trace_dns_span.finish()
+
+        async def on_request_end(session, ctx, params):
+            if ctx.trace_span is not None:
+                ctx.trace_span.finish(status=params.response.status)
+
+        async def on_request_exception(session, ctx, params):
+            if ctx.trace_span is not None:
+                if ctx.trace_connect_span is not None:
+                    ctx.trace_connect_span.finish()
+                ctx.trace_span.finish(error=type(params.exception).__name__)
+
+        async def on_response_chunk_received(session, ctx, params):
+            # fired once by `read()` with the whole body, so the body took
+            # from the response headers until now; streamed bodies are
+            # timed by whoever streams them, e.g. the download sink
+            request_span = ctx.trace_span
+            if request_span is not None and request_span.end is not None and request_span.parent is not None:
+                request_span.parent.child('http.body', start=request_span.end, size=len(params.chunk)).finish()
+
+        trace_config.on_request_start.append(on_request_start)
+        trace_config.on_connection_queued_start.append(on_connection_queued_start)
+        trace_config.on_connection_queued_end.append(on_connection_queued_end)
+        trace_config.on_connection_create_start.append(on_connection_create_start)
+        trace_config.on_connection_create_end.append(on_connection_create_end)
+        trace_config.on_dns_resolvehost_start.append(on_dns_resolvehost_start)
+        trace_config.on_dns_resolvehost_end.append(on_dns_resolvehost_end)
+        trace_config.on_request_end.append(on_request_end)
+        trace_config.on_request_exception.append(on_request_exception)
+        trace_config.on_response_chunk_received.append(on_response_chunk_received)
+        return trace_config
+
+    def __str__(self) -> str:
+        return f"<Tracer: sample_rate={self.sample_rate}, {self.num_traces} traces, {len(self.spans)} spans>"
+
+    def __repr__(self) -> str:
+        return self.__str__()